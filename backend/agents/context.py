@@ -0,0 +1,125 @@
+from dataclasses import dataclass, field
+from types import MappingProxyType
+from typing import Any, Mapping
+
+from langchain_core.messages import HumanMessage
+
+
+@dataclass(frozen=True)
+class NodeContext:
+	# Everything a node needs that does not depend on the state, derived once at graph construction
+	models: Mapping[str, Any] = field(default_factory=dict)  # model name -> chat model with the node's tools bound
+	system_messages: Mapping[str, tuple] = field(default_factory=dict)  # prompt name -> rendered messages (on first use)
+	tools_by_name: Mapping[str, Any] = field(default_factory=dict)
+	tool_args: Mapping[str, frozenset] = field(default_factory=dict)  # tool name -> properties of its args schema
+
+
+class RenderedPrompts(Mapping):
+	# Prompt name -> rendered messages. Each prompt is rendered (and loaded, see LazyPrompt) on first use,
+	# not when the graph is built.
+	def __init__(self, prompts: dict):
+		self._prompts = dict(prompts)
+		self._rendered = {}
+
+	def __getitem__(self, name: str) -> tuple:
+		if name not in self._rendered:
+			self._rendered[name] = tuple(self._prompts[name].invoke({}).messages)
+		return self._rendered[name]
+
+	def __iter__(self):
+		return iter(self._prompts)
+
+	def __len__(self) -> int:
+		return len(self._prompts)
+
+
+def build_node_context(gateway=None, tools: list = None, prompts: dict = None) -> NodeContext:
+	# Without a gateway (nodes that call no LLM) no models are bound
+	tools = list(tools or [])
+	models = { model_name: gateway.model(model_name, tools or None) for model_name in gateway.llm_dict } if gateway else {}
+	return NodeContext(
+		models=MappingProxyType(models),
+		system_messages=RenderedPrompts(prompts or {}),
+		tools_by_name=MappingProxyType({ tool.name: tool for tool in tools }),
+		tool_args=MappingProxyType({
+			tool.name: frozenset(tool.args_schema.schema()["properties"].keys())
+			for tool in tools if getattr(tool, "args_schema", None) is not None and hasattr(tool.args_schema, "schema")
+		}),
+	)
+
+
+def eval_message(context: NodeContext, eval_type: str) -> HumanMessage:
+	# The evaluation prompts are sent as the last human turn
+	return HumanMessage(content=context.system_messages[eval_type][0].content)
+
+
+if __name__ == "__main__":
+	# Microbenchmark of the per-call node overhead, before (derived on every call) and after
+	# (read from the precompiled context): python -m agents.context [--offline]
+	# With --offline, stub models, prompts and tools (func/stubs.py) stand in for Vertex, the hub and the tool backends.
+	import sys, timeit
+	if "--offline" in sys.argv:
+		from func.stubs import install_offline_stubs, stub_llm_dict
+		from func.gateway import LLMGateway
+		install_offline_stubs()
+		gateway = LLMGateway(stub_llm_dict())
+	else:
+		from func.llm import gateway
+	from agents.prompts import research_manager_prompt, specialist_prompt_dict
+	from agents.prompts import tool_eval_prompt, visual_eval_prompt, task_eval_prompt
+	from agents.specialists import database_specialist as DS, analytics_specialist as AS, literature_specialist as LS
+	from agents.specialists import evaluation_specialist as ES
+
+	model_name = next(iter(gateway.llm_dict))
+	toolset = [*DS.tools, *AS.tools, *LS.tools]
+	eval_prompts = {"tool_eval": tool_eval_prompt, "visual_eval": visual_eval_prompt, "task_eval": task_eval_prompt}
+
+	manager_context = build_node_context(gateway, [DS, AS, LS], {"research_manager": research_manager_prompt})
+	specialist_context = build_node_context(gateway, DS.tools + [ES], specialist_prompt_dict)
+	eval_context = build_node_context(gateway, DS.tools, eval_prompts)
+	toolset_context = build_node_context(tools=toolset)
+
+	def before_research_manager():
+		tools_by_name = {tool.name: tool for tool in [DS, AS, LS]}
+		research_manager_prompt.invoke({}).messages
+		gateway.model(model_name, list(tools_by_name.values()))
+
+	def after_research_manager():
+		manager_context.system_messages["research_manager"]
+		manager_context.models[model_name]
+
+	def before_specialist():
+		specialist_prompt_dict["database_specialist"].invoke({}).messages
+		gateway.model(model_name, DS.tools + [ES])
+
+	def after_specialist():
+		specialist_context.system_messages["database_specialist"]
+		specialist_context.models[model_name]
+
+	def before_evaluation():
+		{specialist.name: specialist for specialist in [DS, AS, LS]}
+		gateway.model(model_name, DS.tools)
+		HumanMessage(content=tool_eval_prompt.invoke({}).messages[0].content)
+
+	def after_evaluation():
+		eval_context.models[model_name]
+		eval_message(eval_context, "tool_eval")
+
+	def before_toolset():
+		tools_by_name = {tool.name: tool for tool in toolset}
+		tools_by_name["sql_query"].args_schema.schema()["properties"].keys()
+
+	def after_toolset():
+		toolset_context.tools_by_name["sql_query"]
+		toolset_context.tool_args["sql_query"]
+
+	number = 200
+	for node, before, after in [
+		("research_manager", before_research_manager, after_research_manager),
+		("specialist", before_specialist, after_specialist),
+		("evaluation", before_evaluation, after_evaluation),
+		("toolset", before_toolset, after_toolset),
+	]:
+		t_before = min(timeit.repeat(before, number=number, repeat=3)) / number
+		t_after = min(timeit.repeat(after, number=number, repeat=3)) / number
+		print(f"{node:>16} | before: {t_before * 1e6:10.1f} us | after: {t_after * 1e6:8.2f} us")
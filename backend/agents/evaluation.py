@@ -1,32 +1,43 @@
-from langchain_core.messages import HumanMessage, AIMessage, SystemMessage
+from langchain_core.messages import HumanMessage, AIMessage, SystemMessage, ToolMessage
 import json
+from functools import partial
 
 from agents.nodes import AgentState
-from agents.prompts import tool_eval_prompt, visual_eval_prompt, task_eval_prompt
-from agents.utils.messages import _extract_task_from_message, _extract_workflows_from_messages, _format_workflow
+from agents.context import eval_message
+from agents.utils.messages import _extract_task_from_index, _extract_workflows_from_index, _format_workflow
 from agents.utils.messages import _extract_xml_tags_from_text
 
 from agents.utils.images import _multimodal_message
 from agents.utils.messages import return_messages
+from agents.utils.prompt_cache import add_cache_breakpoints, prompt_cache_usage
+from agents.utils.evaluation_policy import _last_tool_messages
 
 
-async def call_evaluation(llm_dict, specialists, pruning_func, state: AgentState):
-	llm = llm_dict[state["metadata"]["model_name"]]
-	specialists_by_name = {specialist.name: specialist for specialist in specialists}
+async def call_evaluation(gateway, contexts, pruning_func, evaluation_policy, state: AgentState):
+	model_name = state["metadata"]["model_name"]
 
-	task = _extract_task_from_message(state["messages"])
-	specialist = task["specialist"]
+	task = _extract_task_from_index(state["messages"], state.get("index", None))
+	specialist, task, memory = task["specialist"], task["task"], task["memory"]
 
-	model = llm.bind_tools(specialists_by_name[specialist].tools)
+	# One context per specialist, with the models bound to the tools of that specialist
+	context = contexts[specialist]
+	model = partial(gateway.ainvoke, model_name, model=context.models[model_name])
 
 	eval_type = state["next"].split(":")[1]
 	assert eval_type in ["task_eval", "visual_eval", "tool_eval"], f"Invalid evaluation type: {eval_type}"
 
+	# Tool responses whose deterministic checks are conclusive skip the LLM evaluator
+	if eval_type in ["tool_eval", "visual_eval"]:
+		evaluate, checks = evaluation_policy.decide(eval_type, _last_tool_messages(state["messages"]))
+		evaluation_policy.record(state["metadata"].get("session_id", None), evaluate, checks)
+		if not evaluate:
+			message = evaluation_policy.evaluation_message(checks)
+			message.tags = ["node_evaluation_specialist", eval_type]
+			message.response_metadata["evaluation_policy"] = { "skipped": True, "verdicts": [c["verdict"] for c in checks] }
+			next = f"node_{specialist}" if not specialist.startswith("node_") else specialist
+			return return_messages([message], eval_type, next, "call_evaluation")
 
-	task = _extract_task_from_message(state["messages"])
-	specialist, task, memory = task["specialist"], task["task"], task["memory"]
-
-	workflows = _extract_workflows_from_messages(state["messages"], specialist, newest=False)
+	workflows = _extract_workflows_from_index(state["messages"], state.get("index", None), specialist)
 	workflows = [_format_workflow(w) for w in workflows]
 	historical_workflows, newest_workflow = workflows[:-1], workflows[-1]
 	historical_messages = [m for w in historical_workflows for m in w] if memory else []
@@ -34,37 +45,46 @@ async def call_evaluation(llm_dict, specialists, pruning_func, state: AgentState
 
 	match eval_type:
 		case "task_eval":
-			input_messages = pruning_func([*historical_messages, *newest_messages])
-			message = await task_evaluation(model, input_messages)
+			input_messages, pruning = pruning_func([*historical_messages, *newest_messages], model_name)
+			message = await task_evaluation(model, add_cache_breakpoints(input_messages, [-1]), eval_message(context, "task_eval"))
+			message.response_metadata["pruning"] = pruning
+			message.response_metadata["prompt_cache"] = prompt_cache_usage(message)
 			return return_messages([message], "task_eval", "node_research_manager", "call_evaluation")
 		case "visual_eval":
-			input_messages = pruning_func([*newest_messages])
-			message = await visual_evaluation(model, input_messages)
+			input_messages, pruning = pruning_func([*newest_messages], model_name)
+			message = await visual_evaluation(model, input_messages, eval_message(context, "visual_eval"))
+			message.response_metadata["pruning"] = pruning
+			message.response_metadata["prompt_cache"] = prompt_cache_usage(message)
 			next = f"node_{specialist}" if not specialist.startswith("node_") else specialist
 			return return_messages([message], "visual_eval", next, "call_evaluation")
 		case "tool_eval":
-			input_messages = pruning_func([*newest_messages])
-			message = await tool_evaluation(model, input_messages)
+			input_messages, pruning = pruning_func([*newest_messages], model_name)
+			message = await tool_evaluation(model, add_cache_breakpoints(input_messages, [-1]), eval_message(context, "tool_eval"))
+			message.response_metadata["pruning"] = pruning
+			message.response_metadata["prompt_cache"] = prompt_cache_usage(message)
 			next = f"node_{specialist}" if not specialist.startswith("node_") else specialist
 			return return_messages([message], "tool_eval", next, "call_evaluation")
 
 
-async def tool_evaluation(model, input_messages):
-	system_message = HumanMessage(content=tool_eval_prompt.invoke({}).messages[0].content)
-
+async def tool_evaluation(model, input_messages, system_message):
 	tags = ["node_evaluation_specialist", "tool_eval"]
-	response = await model.ainvoke( [*input_messages, system_message], config={"tags": tags} )
+	response = await model( [*input_messages, system_message], config={"tags": tags} )
 	response.tags = tags
 	
 	response.tool_calls = []
 	response.content = _extract_xml_tags_from_text(response.text(), ["reflection", "reward"])
 	return response
 
-async def visual_evaluation(model, input_messages):
-	system_message = HumanMessage(content=visual_eval_prompt.invoke({}).messages[0].content)
+async def visual_evaluation(model, input_messages, system_message):
+	# The tool responses of the last batch, with their images
+	batch = []
+	for message in input_messages[:0:-1]:
+		if batch and not isinstance(message, ToolMessage):
+			break
+		batch.insert(0, _multimodal_message(message))
 
 	tags = ["node_evaluation_specialist", "visual_eval"]
-	response = await model.ainvoke( [input_messages[0], _multimodal_message(input_messages[-1]), system_message], config={"tags": tags} )
+	response = await model( [input_messages[0], *batch, system_message], config={"tags": tags} )
 	response.tags = tags
 
 	response.tool_calls = []
@@ -73,11 +93,9 @@ async def visual_evaluation(model, input_messages):
 
 
 
-async def task_evaluation(model, input_messages):
-	system_message = HumanMessage(content=task_eval_prompt.invoke({}).messages[0].content)
-	
+async def task_evaluation(model, input_messages, system_message):
 	tags = ["node_evaluation_specialist", "task_eval"]
-	response = await model.ainvoke( [*input_messages, system_message], config={"tags": tags} )
+	response = await model( [*input_messages, system_message], config={"tags": tags} )
 	response.tags = tags
 
 	response.tool_calls = []
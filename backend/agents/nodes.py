@@ -1,5 +1,6 @@
 import json
 import random
+import asyncio
 from typing import Annotated, Dict, Any, TypedDict, Literal
 
 from langgraph.graph import END, START, StateGraph
@@ -9,35 +10,43 @@ from langchain_core.messages import AnyMessage, HumanMessage, ToolMessage, AIMes
 # from func.messages import reformat_messages
 # reformat_messages = lambda x: x
 
-from agents.prompts import research_manager_prompt, specialist_prompt_dict
 from agents.utils.agent_state import AgentState
-from agents.utils.messages import _extract_task_from_message, _extract_workflows_from_messages, _format_workflow
-from agents.utils.messages import _remove_xml_tags_from_messages, _extract_xml_tags_from_text
+from agents.utils.messages import _extract_task_from_index, _extract_workflows_from_index, _format_workflow
+from agents.utils.messages import _extract_xml_tags_from_text
 from langchain_core.load import dumps
 
-from agents.utils.messages import return_messages
+from agents.utils.messages import return_messages, return_merged_messages, _format_message
+from agents.utils.messages import _index_messages, _index_is_valid
+from langchain_core.runnables import RunnableConfig
+from langchain_core.runnables.config import merge_configs
+from func.prefetch import prefetcher
+from agents.utils.prompt_cache import add_cache_breakpoints, prompt_cache_usage
 
 
-async def call_research_manager(llm_dict, tools, pruning_func, state: AgentState):
+async def call_research_manager(gateway, context, pruning_func, state: AgentState):
 	profile = {"current": "research_manager", "name": "call_research_manager"}
 	try:
-		llm = llm_dict[state["metadata"]["model_name"]]
-		tools_by_name = {tool.name: tool for tool in tools}
+		model_name = state["metadata"]["model_name"]
 
 		human_message = HumanMessage(content="""
 		1. If further response is needed, assign a task to one of: database_specialist, analytics_specialist, literature_specialist
 		2. If user request has been fully addressed, synthesize a final answer.""")
 
-		input_messages = pruning_func([
-			*research_manager_prompt.invoke({}).messages, 
-			*_remove_xml_tags_from_messages(state['messages'], ["thinking"]), 
+		system_messages = context.system_messages["research_manager"]
+		input_messages, pruning = pruning_func([
+			*system_messages, 
+			*state['messages'], 
 			human_message
-		])
+		], model_name)
+		# Cache the tools + system prompt, and the history up to its last message
+		input_messages = add_cache_breakpoints(input_messages, [len(system_messages) - 1, -2])
 
 		tags = ["node_research_manager"]
-		response = llm.bind_tools(list(tools_by_name.values())).invoke(
-			input_messages, config={"tags": tags})
+		response = await gateway.ainvoke(
+			model_name, input_messages, config={"tags": tags}, model=context.models[model_name])
 		response.tags = tags
+		response.response_metadata["pruning"] = pruning
+		response.response_metadata["prompt_cache"] = prompt_cache_usage(response)
 
 		if len(response.tool_calls) == 0:
 			next = END
@@ -52,34 +61,40 @@ async def call_research_manager(llm_dict, tools, pruning_func, state: AgentState
 
 
 from functools import reduce
-async def call_specialist(llm_dict, tools, pruning_func, state: AgentState):
-	task = _extract_task_from_message(state["messages"])
+async def call_specialist(gateway, context, pruning_func, state: AgentState):
+	task = _extract_task_from_index(state["messages"], state.get("index", None))
 	specialist, task, memory = task["specialist"], task["task"], task["memory"]
 	profile = {"current": specialist, "name": "call_specialist"}
 
 	try:
-		llm = llm_dict[state["metadata"]["model_name"]]
+		model_name = state["metadata"]["model_name"]
 		
-		workflows = _extract_workflows_from_messages(state["messages"], specialist, newest=False)
+		workflows = _extract_workflows_from_index(state["messages"], state.get("index", None), specialist)
 		historical_workflows, newest_workflow = workflows[:-1], workflows[-1]
 		historical_workflows = [_format_workflow(w) for w in historical_workflows]
 		historical_messages = [m for w in historical_workflows for m in w] if memory else []
 		newest_messages = _format_workflow(newest_workflow)
 
-		assert specialist in specialist_prompt_dict, f"Invalid specialist: {specialist}. Only {list(specialist_prompt_dict.keys())} are allowed."
-		system_messages = specialist_prompt_dict[specialist].invoke({}).messages
-		input_messages = pruning_func([ *system_messages, *historical_messages, *newest_messages ])
+		assert specialist in context.system_messages, f"Invalid specialist: {specialist}. Only {list(context.system_messages.keys())} are allowed."
+		system_messages = context.system_messages[specialist]
+		input_messages, pruning = pruning_func(
+			[ *system_messages, *historical_messages, *newest_messages ], model_name)
+		input_messages = add_cache_breakpoints(input_messages, [len(system_messages) - 1, -1])
 
 		tags = [specialist]
-		response = llm.bind_tools(tools).invoke( input_messages, config={ "tags": tags } )
+		response = await gateway.ainvoke(model_name, input_messages, config={ "tags": tags }, model=context.models[model_name])
 		response.content = response.text()
 		response.tags = tags
+		response.response_metadata["pruning"] = pruning
+		response.response_metadata["prompt_cache"] = prompt_cache_usage(response)
 
-		# If any tool call generated, continue the task (reasoning - tool call iteration)
-		if response.tool_calls and response.tool_calls[0]["name"] != "evaluation_specialist":
+		# If any tool call generated, continue the task (reasoning - tool call iteration).
+		# All tool calls run as one batch, a call to evaluation_specialist alongside them is implied by it
+		tool_calls = [tool_call for tool_call in response.tool_calls if tool_call["name"] != "evaluation_specialist"]
+		if tool_calls:
 			next = "node_toolset"
 
-			tool_name = response.tool_calls[0]["name"]
+			response.tool_calls = tool_calls
 			messages = [response]
 
 		# If no further tool call, end this task, pass to evaluation_specialist
@@ -107,47 +122,59 @@ async def call_specialist(llm_dict, tools, pruning_func, state: AgentState):
 
 
 from func.image import if_message_contains_image
-async def call_toolset(tools, state: AgentState):
+async def _call_tool(context, tool_call, state: AgentState, tool_limiter) -> ToolMessage:
+	tool_name, tool_call_id, tool_args = tool_call["name"], tool_call["id"], tool_call["args"]
 	try:
-		tools_by_name = {tool.name: tool for tool in tools}
-		tool_call = state["messages"][-1].tool_calls[0]
-		tool_name, tool_call_id, tool_args = tool_call["name"], tool_call["id"], tool_call["args"]
-
-		profile = {"current": tool_name, "name": "call_toolset"}
-
+		tools_by_name = context.tools_by_name
 		assert tool_name in tools_by_name, f"Invalid tool: {tool_name}. Only {list(tools_by_name.keys())} are allowed."
-		required_args = tools_by_name[tool_name].args_schema.schema()["properties"].keys()
+		required_args = context.tool_args[tool_name]
 		tool_args = {k: v for k, v in tool_args.items() if k in required_args}
 		tool_args["state"] = state
 
-		tags = ["toolset", tool_name]
-		results = tools_by_name[tool_name].invoke(tool_args, config={ "tags": tags })
+		tags, current = ["toolset", tool_name], tool_name
+		session_id = state["metadata"]["session_id"] if state else "test"
+		async with tool_limiter.limit(session_id, tool_name):
+			results = await tools_by_name[tool_name].ainvoke(tool_args, config={ "tags": tags })
 		results = json.loads(results) if isinstance(results, str) else results
-		tool_message = ToolMessage(content=[{"type": "text", "text": json.dumps(results)}], tool_call_id=tool_call_id, tags=tags)
-
-		visual = if_message_contains_image(tool_message)
-		next = "node_evaluation_specialist:visual_eval" if visual else "node_evaluation_specialist:tool_eval"
 
 	except Exception as e:
-		profile = {"current": "toolset", "name": "call_toolset"}
-
+		tags, current = ["toolset"], "toolset"
 		results = { "response": "{}: {}".format(type(e).__name__, str(e)) }
-		tool_message = ToolMessage(content=[{"type": "text", "text": json.dumps(results)}], tool_call_id=tool_call_id, tags=["toolset"])
-		next = "node_evaluation_specialist:tool_eval"
 
-	return return_messages([tool_message], next=next, **profile)
+	tool_message = ToolMessage(content=[{"type": "text", "text": json.dumps(results)}], tool_call_id=tool_call_id, tags=tags)
+	tool_message.metadata = { "current": current, "name": "call_toolset" }
+	return tool_message
+
+
+async def call_toolset(context, tool_limiter, state: AgentState):
+	# Runs all tool calls of the last AIMessage concurrently, within the per-session limits of `tool_limiter`
+	# (e.g. the cells of a Jupyter kernel run one at a time, across batches and sub-workflows), and evaluates the batch once
+	tool_calls = state["messages"][-1].tool_calls
+	tool_messages = await asyncio.gather(*[
+		_call_tool(context, tool_call, state, tool_limiter) for tool_call in tool_calls])
 
+	visual = any(if_message_contains_image(tool_message) for tool_message in tool_messages)
+	next = "node_evaluation_specialist:visual_eval" if visual else "node_evaluation_specialist:tool_eval"
+	current = tool_messages[0].metadata["current"] if len(tool_messages) == 1 else "toolset"
 
-async def call_specialistset(specialists, state: AgentState):
+	for tool_message in tool_messages:
+		tool_message.metadata["next"] = next
+	return return_merged_messages(tool_messages, current, next, "call_toolset")
+
+
+async def call_specialistset(context, specialist_graph, state: AgentState, config: RunnableConfig):
 	profile = {"current": "specialistset", "name": "call_specialistset"}
+	if len(state["messages"][-1].tool_calls) > 1:
+		return await fan_out_specialists(context, specialist_graph, state, config)
 
 	try:
-		specialists_by_name = {specialist.name: specialist for specialist in specialists}
+		specialists_by_name = context.tools_by_name
 		specialist_call = state["messages"][-1].tool_calls[0]
 		specialist_name, specialist_call_id, specialist_args = specialist_call["name"], specialist_call["id"], specialist_call["args"]
 
 		assert specialist_name in specialists_by_name, f"Invalid specialist: {specialist_name}. Only {list(specialists_by_name.keys())} are allowed."
 		results = specialists_by_name[specialist_name].invoke(specialist_args)
+		prefetcher.prefetch(specialist_name, specialist_args.get("task", ""), state)
 
 		specialist_message = ToolMessage(content=[{"type": "text", "text": json.dumps(results)}], tool_call_id=specialist_call_id)
 		next = f"node_{specialist_name}"
@@ -157,4 +184,55 @@ async def call_specialistset(specialists, state: AgentState):
 		specialist_message = ToolMessage(content=[{"type": "text", "text": json.dumps(results)}], tool_call_id=specialist_call_id)
 		next = "node_evaluation_specialist:task_eval"
 
-	return return_messages([specialist_message], next=next, **profile)
\ No newline at end of file
+	return return_messages([specialist_message], next=next, **profile)
+
+
+async def fan_out_specialists(context, specialist_graph, state: AgentState, config: RunnableConfig):
+	# Every task of the research manager's turn runs concurrently as its own sub-workflow
+	# (specialist - toolset - evaluation, up to its task_eval). The sub-workflows are merged back
+	# in the order of the tool calls: all ToolMessages first, then each workflow, contiguous and
+	# opened by a task marker, so that the workflow / task extraction is unchanged.
+	specialists_by_name = context.tools_by_name
+	tool_messages, markers = [], []
+
+	for specialist_call in state["messages"][-1].tool_calls:
+		specialist_name, specialist_call_id, specialist_args = specialist_call["name"], specialist_call["id"], specialist_call["args"]
+		try:
+			assert specialist_name in specialists_by_name, f"Invalid specialist: {specialist_name}. Only {list(specialists_by_name.keys())} are allowed."
+			results = specialists_by_name[specialist_name].invoke(specialist_args)
+			prefetcher.prefetch(specialist_name, specialist_args.get("task", ""), state)
+
+			task = { "specialist": specialist_name, "task": specialist_args.get("task", ""), "memory": specialist_args.get("memory", None) }
+			marker = AIMessage(content=task["task"], response_metadata={"task": task})
+			marker.metadata = { "current": "research_manager", "next": f"node_{specialist_name}", "name": "call_specialistset" }
+			markers.append(_format_message(marker))
+
+		except Exception as e:
+			results = { "response": "{}: {}".format(type(e).__name__, str(e)) }
+
+		tool_message = ToolMessage(content=[{"type": "text", "text": json.dumps(results)}], tool_call_id=specialist_call_id)
+		tool_message.metadata = { "current": "specialistset", "next": "node_research_manager", "name": "call_specialistset" }
+		tool_messages.append(_format_message(tool_message))
+
+	messages = state["messages"]
+	index = state["index"] if _index_is_valid(messages, state.get("index", None)) else _index_messages(messages)
+
+	async def run_workflow(marker):
+		prefix = [*tool_messages, marker]
+		sub_state = {
+			"messages": [*messages, *prefix], "index": _index_messages(prefix, index), "metadata": state["metadata"],
+			"current": "research_manager", "next": marker.metadata["next"]
+		}
+		sub_config = merge_configs(config, {"metadata": {"subworkflow": marker.response_metadata["task"]["specialist"]}})
+		try:
+			result = await specialist_graph.ainvoke(sub_state, sub_config)
+			return [marker, *result["messages"][len(sub_state["messages"]):]]
+		except Exception as e:
+			# Close the workflow so that the research manager sees the failure as its evaluation
+			message = AIMessage(content="{}: {}".format(type(e).__name__, str(e)))
+			message.metadata = { "current": "task_eval", "next": "node_research_manager", "name": "call_specialistset" }
+			return [marker, message]
+
+	workflows = await asyncio.gather(*[run_workflow(marker) for marker in markers])
+	merged = [*tool_messages, *[m for workflow in workflows for m in workflow]]
+	return return_merged_messages(merged, "specialistset", "node_research_manager", "call_specialistset")
@@ -1,13 +1,14 @@
-from langchain.hub import pull
+from func.prompt_registry import prompt_registry
 
-tool_eval_prompt = pull("erzhuoshao/sciscigpt-tool-eval:3452c5e1")
-visual_eval_prompt = pull("erzhuoshao/sciscigpt-visual-eval:4be9277a")
-task_eval_prompt = pull("erzhuoshao/sciscigpt-task-eval:7d5d09e8")
+# Resolved from the local prompt bundle (`python -m func.prompt_registry sync`) on first use
+tool_eval_prompt = prompt_registry.lazy("erzhuoshao/sciscigpt-tool-eval:3452c5e1")
+visual_eval_prompt = prompt_registry.lazy("erzhuoshao/sciscigpt-visual-eval:4be9277a")
+task_eval_prompt = prompt_registry.lazy("erzhuoshao/sciscigpt-task-eval:7d5d09e8")
 
-research_manager_prompt = pull("erzhuoshao/sciscigpt_research_manager:1e49a915")
+research_manager_prompt = prompt_registry.lazy("erzhuoshao/sciscigpt_research_manager:1e49a915")
 
 specialist_prompt_dict = {
-    "literature_specialist": pull("erzhuoshao/sciscigpt_literature_specialist:93d1f28f"),
-    "database_specialist": pull("erzhuoshao/sciscigpt_database_specialist:b8fb5bcb"),
-    "analytics_specialist": pull("erzhuoshao/sciscigpt_analytics_specialist:30738185"),
-}
\ No newline at end of file
+    "literature_specialist": prompt_registry.lazy("erzhuoshao/sciscigpt_literature_specialist:93d1f28f"),
+    "database_specialist": prompt_registry.lazy("erzhuoshao/sciscigpt_database_specialist:b8fb5bcb"),
+    "analytics_specialist": prompt_registry.lazy("erzhuoshao/sciscigpt_analytics_specialist:30738185"),
+}
@@ -12,6 +12,20 @@ def select_next(state: AgentState, verbose: bool = False) -> Literal[
 	current, next = state["current"], state["next"]
 	return next.split(":")[0]
 
+def select_next_in_workflow(state: AgentState):
+	# A sub-workflow ends where control returns to the research manager
+	next = select_next(state)
+	return END if next == "node_research_manager" else next
+
+def define_specialist_graph(nodes: dict):
+	# Specialist - toolset - evaluation loop of a single task, run by the specialistset to fan out several tasks
+	specialist_graph = StateGraph(AgentState)
+	for name, node in nodes.items():
+		specialist_graph.add_node(name, node)
+		specialist_graph.add_conditional_edges(name, select_next_in_workflow)
+	specialist_graph.add_conditional_edges(START, select_next_in_workflow)
+	return specialist_graph
+
 from agents.specialists import database_specialist as DS
 from agents.specialists import analytics_specialist as AS
 from agents.specialists import literature_specialist as LS
@@ -21,23 +35,50 @@ all_tools = [ *DS.tools, *AS.tools, *LS.tools, *ES.tools ]
 all_specialists = [DS, AS, LS, ES]
 
 
-from agents.utils.messages import _remove_xml_tags_from_messages
-pruning_func = partial(_remove_xml_tags_from_messages, tags=["thinking"])
-identity_func = lambda x: x
+from agents.utils.pruning import ContextPruner
+from agents.utils.evaluation_policy import EvaluationPolicy
+
+# Concurrent calls per tool and session, across the batches of tool calls and the sub-workflows. The Jupyter tools
+# of a session share a kernel, which runs one cell at a time. The other tools are not limited per session
+# (the tool executors bound each tool class).
+from agents.utils.tool_limits import ToolLimiter
+tool_limiter = ToolLimiter(
+	limits={ "kernel": 1 }, groups={ "python": "kernel", "r": "kernel", "julia": "kernel" }, default=None)
+from agents.context import build_node_context
+from agents.prompts import research_manager_prompt, specialist_prompt_dict
+from agents.prompts import tool_eval_prompt, visual_eval_prompt, task_eval_prompt
+
 
+def define_sciscigpt_graph(gateway, token_budgets: dict = None, evaluation_policy: EvaluationPolicy = None):
+	# The research manager never sees the specialists' <thinking>; all prompts are pruned to the model's token budget
+	manager_pruner = ContextPruner(token_budgets, tags=["thinking"])
+	specialist_pruner = ContextPruner(token_budgets)
+
+	# Bound models, rendered prompts and tool lookups are derived once here, not on every node call
+	eval_prompts = {"tool_eval": tool_eval_prompt, "visual_eval": visual_eval_prompt, "task_eval": task_eval_prompt}
+	manager_context = build_node_context(gateway, [DS, AS, LS], {"research_manager": research_manager_prompt})
+	eval_contexts = { specialist.name: build_node_context(gateway, specialist.tools, eval_prompts) for specialist in [DS, AS, LS] }
 
-def define_sciscigpt_graph(llm_dict):
 	node_research_manager = partial(
-		call_research_manager, llm_dict, [DS, AS, LS], pruning_func)
+		call_research_manager, gateway, manager_context, manager_pruner)
 
 	# Allowing all specialists to see the full workflow
-	node_database_specialist = partial(call_specialist, llm_dict, DS.tools + [ES], identity_func)
-	node_analytics_specialist = partial(call_specialist, llm_dict, AS.tools + [ES], identity_func)
-	node_literature_specialist = partial(call_specialist, llm_dict, LS.tools + [ES], identity_func)
-	node_evaluation_specialist = partial(call_evaluation, llm_dict, [DS, AS, LS], identity_func)
-
-	node_specialistset = partial(call_specialistset, [DS, AS, LS])
-	node_toolset = partial(call_toolset, [ *DS.tools, *AS.tools, *LS.tools ])
+	node_database_specialist = partial(call_specialist, gateway, build_node_context(gateway, DS.tools + [ES], specialist_prompt_dict), specialist_pruner)
+	node_analytics_specialist = partial(call_specialist, gateway, build_node_context(gateway, AS.tools + [ES], specialist_prompt_dict), specialist_pruner)
+	node_literature_specialist = partial(call_specialist, gateway, build_node_context(gateway, LS.tools + [ES], specialist_prompt_dict), specialist_pruner)
+	node_evaluation_specialist = partial(call_evaluation, gateway, eval_contexts, specialist_pruner, evaluation_policy or EvaluationPolicy())
+
+	node_toolset = partial(call_toolset, build_node_context(tools=[ *DS.tools, *AS.tools, *LS.tools ]), tool_limiter)
+
+	# Concurrent sub-workflows have no checkpoints of their own, the merged result is checkpointed by the parent graph
+	specialist_graph = define_specialist_graph({
+		"node_database_specialist": node_database_specialist,
+		"node_analytics_specialist": node_analytics_specialist,
+		"node_literature_specialist": node_literature_specialist,
+		"node_evaluation_specialist": node_evaluation_specialist,
+		"node_toolset": node_toolset,
+	}).compile(checkpointer=False)
+	node_specialistset = partial(call_specialistset, build_node_context(tools=[DS, AS, LS]), specialist_graph)
 
 	sciscigpt_graph = StateGraph(AgentState)
 	sciscigpt_graph.add_node("node_research_manager", node_research_manager)
@@ -61,5 +102,5 @@ def define_sciscigpt_graph(llm_dict):
 
 
 __all__ = [
-	"AgentState", "all_tools", "all_specialists", "define_sciscigpt_graph"
+	"AgentState", "all_tools", "all_specialists", "define_sciscigpt_graph", "define_specialist_graph"
 ]
\ No newline at end of file
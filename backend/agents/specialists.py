@@ -2,7 +2,7 @@ from pydantic import BaseModel, Field
 from typing import Type
 from langchain.tools import BaseTool
 from tools import sql_list_table_tool, sql_get_schema_tool, sql_query_tool
-from tools import python_jupyter_tool, r_jupyter_tool, julia_jupyter_tool
+from tools import python_jupyter_tool, r_jupyter_tool, julia_jupyter_tool, kernel_warmups
 from tools import search_name_tool, search_literature_advanced_tool
 
 
@@ -78,4 +78,9 @@ analytics_specialist = AnalyticsSpecialist(tools=[python_jupyter_tool, r_jupyter
 literature_specialist = LiteratureSpecialist(tools=[search_literature_advanced_tool])
 evaluation_specialist = EvaluationSpecialist(tools=[])
 
+# Warmups started in the background as soon as a task is assigned to the specialist
+from func.prefetch import prefetcher
+prefetcher.register(database_specialist.name, sql_get_schema_tool.warmups)
+prefetcher.register(analytics_specialist.name, kernel_warmups)
+
 __all__ = [database_specialist, analytics_specialist, literature_specialist, evaluation_specialist]
\ No newline at end of file
@@ -2,6 +2,7 @@ from typing import Any, List, Annotated, Dict, Any, TypedDict, Literal
 from langchain_core.messages import AIMessage, HumanMessage, ToolMessage, AnyMessage
 from typing_extensions import Annotated
 from langgraph.graph import add_messages
+from agents.utils.messages import update_index
 
 
 class AgentState(TypedDict):
@@ -9,4 +10,5 @@ class AgentState(TypedDict):
 	messages_str: str
 	metadata: Dict[str, Any]
 	current: str
-	next: str
\ No newline at end of file
+	next: str
+	index: Annotated[Dict[str, Any], update_index]
\ No newline at end of file
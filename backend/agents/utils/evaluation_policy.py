@@ -0,0 +1,133 @@
+from langchain_core.messages import AIMessage, AnyMessage, ToolMessage
+from collections import OrderedDict
+import json, re, threading
+
+
+JUPYTER_TOOLS = ["python", "r", "julia"]
+
+# Tools whose successful responses still go to the LLM evaluator in `adaptive` mode.
+# Lookups (sql_list_table, sql_get_schema, search_name) succeed or fail in an obvious way.
+LLM_EVALUATED_TOOLS = ["sql_query", "search_literature", *JUPYTER_TOOLS]
+
+TIMEOUT_PATTERN = re.compile(r"Execution timeout after \d+ seconds|FunctionTimedOut|TimeoutError")
+# Tracebacks of the Python (IPython), R and Julia kernels
+JUPYTER_ERROR_PATTERN = re.compile(r"Traceback \(most recent call last\)|^\w+(Error|Exception)\b.*$|^Error( in .*)?:|^ERROR: ", re.MULTILINE)
+# "{}: {}".format(type(e).__name__, str(e)), as returned by the tools on failure
+TOOL_ERROR_PATTERN = re.compile(r"^[A-Za-z0-9_.]*(Error|Exception|Exited|Timeout|TimedOut|BadRequest|NotFound|Forbidden|Unauthorized)\w*: ")
+EMPTY_DATAFRAME_PATTERN = re.compile(r"\[0 rows x \d+ columns\]|^Empty DataFrame", re.MULTILINE)
+
+
+def _tool_results(message: ToolMessage) -> dict:
+	content = message.content
+	text = content if isinstance(content, str) else "".join(item.get("text", "") for item in content if item.get("type", None) == "text")
+	try:
+		results = json.loads(text)
+		return results if isinstance(results, dict) else {"response": text}
+	except Exception:
+		return {"response": text}
+
+
+def check_tool_message(message: ToolMessage) -> dict:
+	# Cheap deterministic checks of a tool response: `error`, `timeout`, `empty` or `ok`
+	tool_name = getattr(message, "metadata", {}).get("current", "toolset")
+	results = _tool_results(message)
+	response = str(results.get("response", ""))
+
+	if TIMEOUT_PATTERN.search(response):
+		verdict = "timeout"
+	elif tool_name == "toolset" or TOOL_ERROR_PATTERN.match(response.strip()):
+		verdict = "error"
+	elif tool_name in JUPYTER_TOOLS and JUPYTER_ERROR_PATTERN.search(response):
+		verdict = "error"
+	elif EMPTY_DATAFRAME_PATTERN.search(response) or not (response.strip() or results.get("files") or results.get("images")):
+		# A cell without output has run without error
+		verdict = "ok" if tool_name in JUPYTER_TOOLS else "empty"
+	else:
+		verdict = "ok"
+	return { "tool": tool_name, "verdict": verdict, "response": response }
+
+
+class EvaluationPolicy:
+	def __init__(self, mode: str = "adaptive", llm_evaluated_tools: list[str] = LLM_EVALUATED_TOOLS, max_sessions: int = 10000):
+		"""
+		Decides whether a batch of tool responses (tool_eval / visual_eval) needs the LLM evaluator
+
+		Parameters:
+		mode (str): `always` runs the LLM evaluator after every batch. `adaptive` skips it when the
+			deterministic checks are conclusive: errors, timeouts and empty results, or successful
+			responses of tools missing from `llm_evaluated_tools`. `never` only runs the checks.
+		llm_evaluated_tools (list): Tools whose successful responses are evaluated by the LLM in `adaptive` mode
+		max_sessions (int): Number of sessions whose statistics are kept
+		"""
+		assert mode in ["always", "adaptive", "never"], f"Invalid evaluation policy: {mode}"
+		self.mode = mode
+		self.llm_evaluated_tools = list(llm_evaluated_tools)
+		self.max_sessions = max_sessions
+		self.sessions = OrderedDict()
+		self._lock = threading.Lock()
+
+	def decide(self, eval_type: str, tool_messages: list[ToolMessage]) -> tuple[bool, list[dict]]:
+		"""
+		Returns:
+		tuple: Whether to run the LLM evaluator, and the checks of each tool response
+		"""
+		checks = [check_tool_message(message) for message in tool_messages]
+		if self.mode == "always" or not checks:
+			return True, checks
+		if self.mode == "never":
+			return False, checks
+
+		ok = [check for check in checks if check["verdict"] == "ok"]
+		# Figures are always captioned by the evaluator
+		if eval_type == "visual_eval" and ok:
+			return True, checks
+		return any(check["tool"] in self.llm_evaluated_tools for check in ok), checks
+
+	def evaluation_message(self, checks: list[dict]) -> AIMessage:
+		# The evaluation of a batch whose LLM evaluation was skipped, in the format of the LLM evaluator
+		lines = []
+		for check in checks:
+			if check["verdict"] == "ok":
+				lines.append(f"`{check['tool']}` completed successfully.")
+			else:
+				response = check["response"] if len(check["response"]) <= 500 else "..." + check["response"][-500:]
+				lines.append(f"`{check['tool']}` failed ({check['verdict']}): {response.strip()}")
+		reward = sum(check["verdict"] == "ok" for check in checks) / len(checks)
+
+		reflection = "\n".join(lines)
+		return AIMessage(content=f"<reflection>{reflection}</reflection>\n<reward>{reward:.1f}</reward>")
+
+	def record(self, session_id: str, evaluated: bool, checks: list[dict]):
+		with self._lock:
+			if session_id not in self.sessions:
+				self.sessions[session_id] = {"evaluated": 0, "skipped": 0, "verdicts": {}}
+			self.sessions.move_to_end(session_id)
+			if len(self.sessions) > self.max_sessions:
+				self.sessions.popitem(last=False)
+
+			stats = self.sessions[session_id]
+			stats["evaluated" if evaluated else "skipped"] += 1
+			for check in checks:
+				stats["verdicts"][check["verdict"]] = stats["verdicts"].get(check["verdict"], 0) + 1
+
+	def stats(self, session_id: str = None) -> dict:
+		# Evaluator calls run / saved ("skipped"), per session
+		with self._lock:
+			if session_id is not None:
+				return dict(self.sessions.get(session_id, {"evaluated": 0, "skipped": 0, "verdicts": {}}))
+			return {
+				"mode": self.mode,
+				"evaluated": sum(s["evaluated"] for s in self.sessions.values()),
+				"skipped": sum(s["skipped"] for s in self.sessions.values()),
+				"sessions": { k: dict(v) for k, v in self.sessions.items() },
+			}
+
+
+def _last_tool_messages(messages: list[AnyMessage]) -> list[ToolMessage]:
+	# The ToolMessages of the last batch of tool calls
+	batch = []
+	for message in messages[::-1]:
+		if not isinstance(message, ToolMessage):
+			break
+		batch.insert(0, message)
+	return batch
@@ -1,5 +1,4 @@
 from langchain_core.messages import HumanMessage, AIMessage, AnyMessage, ToolMessage
-from copy import deepcopy
 import re
 
 
@@ -22,23 +21,34 @@ def _extract_xml_tags_from_text(text: str, tags: list[str]) -> str:
 
 
 def _remove_xml_tags_from_messages(messages: list[AnyMessage], tags: list[str]):
-	messages = deepcopy(messages)
-	
-	for tag in tags:
-		pattern = re.compile(fr'<{tag}>(.*?)</{tag}>', re.DOTALL)
-		for message in messages:
-			if isinstance(message, AIMessage):
-				message.content = pattern.sub("", message.text()).strip()
+	# Copy-on-write: messages are never mutated, only the ones whose content changes are
+	# (shallowly) copied, everything else is shared with the input list
+	patterns = [re.compile(fr'<{tag}>(.*?)</{tag}>', re.DOTALL) for tag in tags]
 
-	messages = [_format_message(message) for message in messages]
-	return messages
+	pruned_messages = []
+	for message in messages:
+		content = message.content
+		if isinstance(message, AIMessage) and patterns:
+			content = message.text()
+			for pattern in patterns:
+				content = pattern.sub("", content).strip()
+
+		content = _format_content(content)
+		if content is not message.content:
+			message = message.model_copy(update={"content": content})
+		pruned_messages.append(message)
+	return pruned_messages
 
 
 def _extract_task_from_message(message: AIMessage | list[AnyMessage]):
     current = getattr(message, "metadata", {}).get("current", "")
     
     if isinstance(message, AIMessage) and "research_manager" in current:
-        if not message.tool_calls or len(message.tool_calls) == 0:
+        # Task marker of a fanned-out sub-workflow (see `call_specialistset`)
+        if "task" in message.response_metadata:
+            return dict(message.response_metadata["task"])
+        # A turn assigning several tasks is not a task itself, each starts at its own marker
+        if not message.tool_calls or len(message.tool_calls) != 1:
             return None
         else:
             specialist = message.tool_calls[0]["name"]
@@ -81,6 +91,53 @@ def _extract_workflows_from_messages(messages: list[AnyMessage], specialist: str
 		return workflows
 
 
+def _index_messages(messages: list[AnyMessage], index: dict = None) -> dict:
+	# Extends the conversation index with newly appended messages (without mutating `index`).
+	# `task`: the current task. `workflows`: per specialist, the [start, end] offsets of each
+	# workflow, where `end` is the offset of its task_eval (None while the workflow is open).
+	index = index or { "length": 0, "task": None, "workflows": {} }
+	task = index["task"]
+	workflows = { specialist: [list(w) for w in ws] for specialist, ws in index["workflows"].items() }
+
+	for i, message in enumerate(messages, start=index["length"]):
+		metadata = getattr(message, "metadata", {})
+		new_task = _extract_task_from_message(message)
+		if new_task:
+			task = new_task
+			workflows.setdefault(new_task["specialist"], []).append([i, None])
+
+		if metadata.get("current", None) == "task_eval":
+			for w in [w for ws in workflows.values() for w in ws if w[1] is None]:
+				w[1] = i
+
+	return { "length": index["length"] + len(messages), "task": task, "workflows": workflows }
+
+
+def update_index(index: dict, update: dict | list[AnyMessage]) -> dict:
+	# Reducer of AgentState["index"]: a dict replaces the index, a list of messages extends it
+	if isinstance(update, dict):
+		return update
+	return _index_messages(update, index)
+
+
+def _index_is_valid(messages: list[AnyMessage], index: dict) -> bool:
+	return bool(index) and index.get("length", None) == len(messages)
+
+
+def _extract_task_from_index(messages: list[AnyMessage], index: dict):
+	if not _index_is_valid(messages, index):
+		return _extract_task_from_message(messages)
+	return index["task"]
+
+
+def _extract_workflows_from_index(messages: list[AnyMessage], index: dict, specialist: str) -> list[list[AnyMessage]]:
+	if not _index_is_valid(messages, index):
+		return _extract_workflows_from_messages(messages, specialist, newest=False)
+
+	bounds = sorted([w for name, ws in index["workflows"].items() if name in specialist for w in ws], key=lambda w: w[0])
+	return [messages[start:(end + 1 if end is not None else len(messages))] for start, end in bounds]
+
+
 def _format_workflow(workflow: list[AnyMessage]) -> list[AnyMessage]:
 	task = _extract_task_from_message(workflow)
 	messages = [HumanMessage(content=task["task"])]
@@ -94,25 +151,39 @@ def _format_workflow(workflow: list[AnyMessage]) -> list[AnyMessage]:
 
 
 from langchain_core.callbacks.manager import dispatch_custom_event
+from langchain_core.runnables.config import ensure_config
 from langchain_core.load import dumps
 
+def _dispatch_messages(state: dict):
+	# Sub-workflows run concurrently, their messages are dispatched once merged, in order
+	if not ensure_config().get("metadata", {}).get("subworkflow", None):
+		dispatch_custom_event(state["name"], dumps(state))
+
 def return_messages(messages: list[AnyMessage], current: str, next: str, name: str):
 	for message in messages:
 		message.metadata = { "current": current, "next": next, "name": name }
-		
 	messages = [_format_message(message) for message in messages]
 	state = { "messages": messages, "current": current, "next": next, "name": name }
+	_dispatch_messages(state)
+	return state | { "index": messages }
 
-	dispatch_custom_event(name, dumps(state))
-	return state
+def return_merged_messages(messages: list[AnyMessage], current: str, next: str, name: str):
+	# Like `return_messages`, for messages that already carry their own metadata (e.g. merged sub-workflows,
+	# a batch of tool calls): one event per message, with its own metadata, which the events format restores
+	messages = [_format_message(message) for message in messages]
+	for message in messages:
+		_dispatch_messages({ "messages": [message], **message.metadata })
+	return { "messages": messages, "current": current, "next": next, "name": name, "index": messages }
 
-def _format_message(message: AnyMessage):
-	content = message.content
+def _format_content(content: str | list) -> list:
+	# Returns `content` itself if it is already well-formed
 	if isinstance(content, str):
 		content = [{"text": content, "type": "text"}]
 
 	if ("text" not in content[0]) or (content[0]["text"].strip() == ""):
 		content = [{"text": "EMPTY MESSAGE", "type": "text"}] + content
+	return content
 
-	message.content = content
-	return message
\ No newline at end of file
+def _format_message(message: AnyMessage):
+	message.content = _format_content(message.content)
+	return message
@@ -0,0 +1,41 @@
+from langchain_core.messages import AnyMessage, ToolMessage
+from agents.utils.messages import _format_content
+
+
+CACHE_CONTROL = {"type": "ephemeral"}
+
+
+def _with_cache_breakpoint(message: AnyMessage) -> AnyMessage:
+	# Copy-on-write: returns a copy of `message` that ends a cacheable prompt prefix.
+	# ChatAnthropicVertex reads `cache_control` from the additional_kwargs of a ToolMessage,
+	# and from the content blocks of any other message.
+	if isinstance(message, ToolMessage):
+		additional_kwargs = {**message.additional_kwargs, "cache_control": CACHE_CONTROL}
+		return message.model_copy(update={"additional_kwargs": additional_kwargs})
+
+	content = _format_content(message.content)
+	positions = [i for i, block in enumerate(content) if block.get("type", None) == "text" and block.get("text", "").strip()]
+	if not positions:
+		return message
+
+	i = positions[-1]
+	content = [*content[:i], {**content[i], "cache_control": CACHE_CONTROL}, *content[i + 1:]]
+	return message.model_copy(update={"content": content})
+
+
+def add_cache_breakpoints(messages: list[AnyMessage], positions: list[int]) -> list[AnyMessage]:
+	# Anthropic caches the prompt prefix (tools, system, messages) up to each breakpoint, at most 4 per request
+	messages = list(messages)
+	for i in sorted({i % len(messages) for i in positions if -len(messages) <= i < len(messages)}):
+		messages[i] = _with_cache_breakpoint(messages[i])
+	return messages
+
+
+def prompt_cache_usage(response: AnyMessage) -> dict:
+	usage = getattr(response, "usage_metadata", None) or {}
+	details = usage.get("input_token_details", None) or {}
+	return {
+		"input_tokens": usage.get("input_tokens", 0),
+		"cache_read": details.get("cache_read", 0),
+		"cache_creation": details.get("cache_creation", 0),
+	}
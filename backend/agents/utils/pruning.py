@@ -0,0 +1,151 @@
+from langchain_core.messages import AnyMessage, ToolMessage
+from collections import OrderedDict
+from functools import partial
+import json
+
+from agents.utils.messages import _remove_xml_tags_from_messages
+
+
+CHARS_PER_TOKEN = 4
+IMAGE_TOKENS = 1600
+DEFAULT_TOKEN_BUDGET = 100_000
+
+
+# Token counts keyed by the identity of the content object. Copy-on-write copies share their
+# content, so a message is only measured once. The content is kept alive next to its count so
+# that its id cannot be reused while it is cached.
+_token_cache: OrderedDict = OrderedDict()
+_token_cache_maxsize = 50000
+
+def _content_tokens(content: str | list) -> int:
+	if isinstance(content, str):
+		return len(content) // CHARS_PER_TOKEN + 1
+
+	tokens = 0
+	for item in content:
+		if item.get("type", None) == "text":
+			tokens += len(item.get("text", "")) // CHARS_PER_TOKEN + 1
+		elif item.get("type", None) == "image_url":
+			tokens += IMAGE_TOKENS
+		else:
+			tokens += len(json.dumps(item, default=str)) // CHARS_PER_TOKEN + 1
+	return tokens
+
+def _message_tokens(message: AnyMessage) -> int:
+	key = id(message.content)
+	cached = _token_cache.get(key)
+	if cached is None or cached[0] is not message.content:
+		cached = (message.content, _content_tokens(message.content))
+		_token_cache[key] = cached
+		if len(_token_cache) > _token_cache_maxsize:
+			_token_cache.popitem(last=False)
+	else:
+		_token_cache.move_to_end(key)
+
+	tool_calls = getattr(message, "tool_calls", None)
+	tool_call_tokens = len(json.dumps(tool_calls, default=str)) // CHARS_PER_TOKEN if tool_calls else 0
+	return cached[1] + tool_call_tokens
+
+
+def _current(message: AnyMessage) -> str:
+	return getattr(message, "metadata", {}).get("current", None) or ""
+
+
+def _collapse_tool_message(message: ToolMessage, head: int = 500, tail: int = 500) -> ToolMessage | None:
+	# Collapse a tool response to the head/tail of its `response`, keeping the file paths
+	# (e.g. the parquet file of a SQL query) so that the result can still be loaded
+	content = message.content
+	text = content if isinstance(content, str) else "".join(item.get("text", "") for item in content if item.get("type", None) == "text")
+	if len(text) <= head + tail:
+		return None
+
+	try:
+		results = json.loads(text)
+		results = results if isinstance(results, dict) else {"response": text}
+	except Exception:
+		results = {"response": text}
+
+	response = str(results.get("response", ""))
+	if len(response) > head + tail:
+		response = f"{response[:head]}\n... [{len(response) - head - tail} characters omitted] ...\n{response[-tail:]}"
+
+	stub = {"response": response}
+	for key in ["files", "images"]:
+		if isinstance(results.get(key, None), list):
+			stub[key] = [
+				{k: v for k, v in f.items() if k in ["name", "file_path", "mime_type", "download_link"]}
+				for f in results[key] if isinstance(f, dict)
+			]
+	stub["note"] = "This earlier tool response has been collapsed to save context. Load `files` (if any) to get the complete result."
+	return message.model_copy(update={"content": [{"type": "text", "text": json.dumps(stub)}]})
+
+
+# Eviction policies: generators of (position, replacement) over `messages`, oldest first.
+# A replacement of None drops the message. Positions already dropped are None in `messages`.
+
+def drop_finished_evaluations(messages: list[AnyMessage]):
+	# tool_eval / visual_eval chatter of workflows that already reached their task_eval
+	last_task_eval = max([i for i, m in enumerate(messages) if m is not None and _current(m) == "task_eval"], default=-1)
+	for i in range(last_task_eval):
+		if messages[i] is not None and _current(messages[i]) in ["tool_eval", "visual_eval"]:
+			yield i, None
+
+def collapse_old_tool_messages(messages: list[AnyMessage], keep_recent: int = 2, head: int = 500, tail: int = 500):
+	# The tool responses after the last evaluation are still being evaluated (e.g. the figures of a visual_eval):
+	# never collapsed, nor are the `keep_recent` latest ones before them
+	last_eval = max([i for i, m in enumerate(messages) if m is not None and _current(m) in ["tool_eval", "visual_eval", "task_eval"]], default=-1)
+	positions = [i for i, m in enumerate(messages) if isinstance(m, ToolMessage) and i < last_eval]
+	positions = positions[:-keep_recent] if keep_recent > 0 else positions
+	for i in positions:
+		collapsed = _collapse_tool_message(messages[i], head, tail)
+		if collapsed is not None:
+			yield i, collapsed
+
+
+class ContextPruner:
+	def __init__(self, token_budgets: dict = None, default_budget: int = DEFAULT_TOKEN_BUDGET, tags: list[str] = None, policies: list = None):
+		"""
+		Prune the input messages of an LLM call to the token budget of its model
+
+		Parameters:
+		token_budgets (dict): Input token budget per model name
+		default_budget (int): Budget of models missing from `token_budgets`
+		tags (list): XML tags always removed from AIMessages (e.g. `thinking`)
+		policies (list): Eviction policies, applied in order while over budget
+		"""
+		self.token_budgets = token_budgets or {}
+		self.default_budget = default_budget
+		self.tags = tags or []
+		self.policies = policies if policies is not None else [
+			drop_finished_evaluations, partial(collapse_old_tool_messages, keep_recent=2)]
+
+	def __call__(self, messages: list[AnyMessage], model_name: str = None) -> tuple[list[AnyMessage], dict]:
+		"""
+		Returns:
+		tuple: The pruned messages, and a report of the tokens before / after pruning
+		"""
+		budget = self.token_budgets.get(model_name, self.default_budget)
+		tokens_before = sum(_message_tokens(m) for m in messages)
+
+		messages = _remove_xml_tags_from_messages(messages, self.tags) if self.tags else list(messages)
+		total = sum(_message_tokens(m) for m in messages)
+
+		evicted = {}
+		for policy in self.policies:
+			if total <= budget:
+				break
+			name = getattr(policy, "func", policy).__name__
+			for i, replacement in policy(messages):
+				if total <= budget:
+					break
+				total -= _message_tokens(messages[i])
+				total += _message_tokens(replacement) if replacement is not None else 0
+				messages[i] = replacement
+				evicted[name] = evicted.get(name, 0) + 1
+
+		messages = [m for m in messages if m is not None]
+		report = {
+			"budget": budget, "tokens_before": tokens_before, "tokens_after": total,
+			"tokens_saved": tokens_before - total, "evicted": evicted
+		}
+		return messages, report
@@ -0,0 +1,33 @@
+import asyncio, weakref
+from contextlib import asynccontextmanager
+
+
+class ToolLimiter:
+	def __init__(self, limits: dict, groups: dict = None, default: int = None):
+		"""
+		Concurrent calls of each tool (or group of tools) per session, shared by all the batches of tool
+		calls and the concurrent sub-workflows of the session
+
+		Parameters:
+		limits (dict): Maximum concurrent calls per tool / group name
+		groups (dict): Tool name -> group name, for the tools sharing a resource (e.g. the Jupyter kernel of the session)
+		default (int): Limit of the tools missing from `limits`, None for no limit (the tool executors still bound each tool class)
+		"""
+		self.limits = limits
+		self.groups = groups or {}
+		self.default = default
+		# (session id, group) -> semaphore, dropped once no call holds it
+		self._semaphores = weakref.WeakValueDictionary()
+
+	@asynccontextmanager
+	async def limit(self, session_id: str, tool_name: str):
+		group = self.groups.get(tool_name, tool_name)
+		limit = self.limits.get(group, self.default)
+		if limit is None:
+			yield
+			return
+		semaphore = self._semaphores.get((session_id, group), None)
+		if semaphore is None:
+			semaphore = self._semaphores[(session_id, group)] = asyncio.Semaphore(limit)
+		async with semaphore:
+			yield
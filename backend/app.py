@@ -1,9 +1,10 @@
 from typing import Any, List, Dict, Any, Optional
 from langchain_core.messages import AnyMessage
 from pydantic import BaseModel
-import httpx, json, os
+import asyncio, httpx, json, logging, os
 from dotenv import load_dotenv
 load_dotenv()
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"), format="%(asctime)s %(levelname)s %(name)s: %(message)s")
 
 from fastapi import FastAPI
 from langserve import add_routes
@@ -13,25 +14,13 @@ app = FastAPI(
 	description="Spin up a simple api server using LangChain's Runnable interfaces",
 )
 
-# All claude models: https://docs.anthropic.com/en/docs/about-claude/models
-from langchain_google_vertexai.model_garden import ChatAnthropicVertex
-# Initialise the Model
-model_config = {
-	"project": "ksm-rch-sciscigpt",
-	"location": "us-east5",
-	"temperature": 0.0
-}
+from func.llm import llm_dict, gateway
 
-llm_dict = {
-	"claude-3.5": ChatAnthropicVertex(
-		model_name="claude-3-5-sonnet-v2@20241022", max_output_tokens=8192, **model_config
-	),
-	"claude-3.7": ChatAnthropicVertex(
-		model_name="claude-3-7-sonnet@20250219", max_output_tokens=8192 * 4, **model_config
-	),
-	"claude-4.0": ChatAnthropicVertex(
-		model_name="claude-sonnet-4@20250514", max_output_tokens=8192 * 4, **model_config
-	)
+# Input token budget of each model (context window minus max output tokens, with headroom)
+token_budgets = {
+	"claude-3.5": 150_000,
+	"claude-3.7": 120_000,
+	"claude-4.0": 120_000,
 }
 
 from agents.sciscigpt import AgentState, all_tools, all_specialists, define_sciscigpt_graph
@@ -39,8 +28,28 @@ for tool in all_tools:
     add_routes(app, tool, path=f"/tools/{tool.name}")
 
 # from langchain.globals import set_debug
-sciscigpt_graph = define_sciscigpt_graph(llm_dict)
-sciscigpt = sciscigpt_graph.compile(debug=False)
+from func.checkpoint import open_checkpointer, thread_config, EventRecorder, extend_history
+# `always` / `adaptive` / `never` run the LLM evaluator after each batch of tool calls
+from agents.utils.evaluation_policy import EvaluationPolicy
+evaluation_policy = EvaluationPolicy(mode=os.getenv("EVALUATION_POLICY", "adaptive"))
+sciscigpt_graph = define_sciscigpt_graph(gateway, token_budgets, evaluation_policy)
+sciscigpt = None  # compiled on startup, with the checkpointer
+
+from contextlib import AsyncExitStack
+from func.prompt_registry import prompt_registry
+@app.on_event("startup")
+async def compile_sciscigpt():
+	global sciscigpt
+	# Fails the startup, rather than the first requests, if the prompt bundle is incomplete
+	prompt_registry.check()
+	app.state.exit_stack = AsyncExitStack()
+	app.state.checkpointer = await app.state.exit_stack.enter_async_context(open_checkpointer())
+	sciscigpt = sciscigpt_graph.compile(checkpointer=app.state.checkpointer, debug=False)
+
+
+@app.on_event("shutdown")
+async def close_checkpointer():
+	await app.state.exit_stack.aclose()
 
 class Input(BaseModel):
 	messages_str: Optional[str]
@@ -52,25 +61,133 @@ class Output(BaseModel):
 
 
 from langchain_core.runnables import RunnableLambda
+from langchain_core.runnables.config import merge_configs
+from langchain_core.messages import RemoveMessage
+from langchain_core.callbacks.manager import adispatch_custom_event
+from langgraph.graph.message import REMOVE_ALL_MESSAGES
 from func.messages import convert_to_langchain_messages, remove_bad_tool_call_responses
-def node_sciscigpt(agent_state):
-	agent_state["metadata"] = json.loads(agent_state["metadata_str"])
+from agents.utils.messages import _index_messages
+from func.prefetch import prefetcher
+async def node_sciscigpt(agent_state, config):
+	metadata = json.loads(agent_state["metadata_str"])
+	messages = convert_to_langchain_messages(agent_state["messages_str"], metadata["format"])
+	session_config = thread_config(config, metadata["session_id"])
+
+	# `delta`: the client only sent the new turn, and the fingerprint (`history`) of the events it holds before it.
+	# The history is restored from the checkpoint, if it was taken after the same events (no turn lost, edited or
+	# sent from another tab since). Otherwise, or without a checkpointer, the client resends the full history.
+	delta = metadata.get("delta", False)
+	if delta:
+		history = []
+		if app.state.checkpointer is not None:
+			checkpoint = await sciscigpt.aget_state(session_config)
+			if checkpoint.values.get("metadata", {}).get("history", None) == metadata.get("history", None):
+				history = checkpoint.values.get("messages", [])
+		if not history:
+			await adispatch_custom_event(
+				"checkpoint_miss", json.dumps({"session_id": metadata["session_id"]}), config=config)
+			return {}
+		messages = [*history, *messages]
+
+	# The full (repaired) history replaces whatever the checkpoint holds for this thread
+	messages = remove_bad_tool_call_responses(messages)
+	state = {
+		"messages": [RemoveMessage(id=REMOVE_ALL_MESSAGES), *messages], 
+		"index": _index_messages(messages), 
+		"metadata": metadata
+	}
+	recorder = EventRecorder()
+	try:
+		result = await sciscigpt.ainvoke(state, merge_configs(session_config, {"callbacks": [recorder]}))
+	finally:
+		# Warmups the turn did not get to use are dropped
+		prefetcher.cancel(metadata["session_id"])
 
-	agent_state["messages"] = remove_bad_tool_call_responses(convert_to_langchain_messages(
-		agent_state["messages_str"], agent_state["metadata"]["format"]))
-		
-	return agent_state
+	# Fingerprint of the client's history once it holds the events of this turn, for its next `delta`
+	if app.state.checkpointer is not None and metadata["format"] == "events":
+		sent = [json.loads(event_str)["data"] for event_str in json.loads(agent_state["messages_str"])]
+		history = extend_history(metadata.get("history", None) if delta else None, [*sent, *recorder.data])
+		await sciscigpt.aupdate_state(
+			session_config, {"metadata": {**metadata, "history": history}}, as_node="node_research_manager")
+	return result
 
 from langchain_core.runnables.config import RunnableConfig
 config = RunnableConfig(recursion_limit=500, run_name="SciSciGPT")
 
 add_routes(
 	app,
-	RunnableLambda(node_sciscigpt) | sciscigpt.with_types(input_type=Input).with_config(config),
+	RunnableLambda(node_sciscigpt).with_types(input_type=Input).with_config(config),
 	path="/sciscigpt",
 )
 
 
+from fastapi.responses import JSONResponse
+from func.resources import resources
+@app.on_event("startup")
+async def warmup_resources():
+	# The tools' dependencies (database, vector stores, sandbox) connect in the background, in parallel
+	app.state.warmup = asyncio.create_task(resources.warmup())
+
+
+@app.get("/ready")
+async def ready():
+	# Status and build time of each dependency of the tools, 503 until all are ready. `checkpointer`: whether the
+	# client may send only the new turn of a session (`delta`)
+	stats = resources.stats()
+	return JSONResponse(
+		{**stats, "checkpointer": app.state.checkpointer is not None}, status_code=200 if stats["ready"] else 503)
+
+
+@app.get("/llm/stats")
+async def llm_stats():
+	# Queue depth, in-flight requests, retries and failures per model
+	return gateway.stats()
+
+
+from func.executors import tool_executors
+@app.get("/toolset/stats")
+async def toolset_stats():
+	# Queued / running / completed / failed calls and wait / run time per tool class
+	return tool_executors.stats()
+
+
+from tools.sandbox import jupyter_sandbox, kernel_reaper
+@app.get("/sandbox/stats")
+async def sandbox_stats():
+	# Kernel pool hits / misses, and time to first execution of the new sessions (of this worker)
+	if jupyter_sandbox.status != "ready":
+		return jupyter_sandbox.stats()
+	return jupyter_sandbox.get().stats()
+
+
+@app.on_event("shutdown")
+def snapshot_sessions():
+	# The variables of the sessions of the kernels started by this worker are restored when they return after the
+	# restart. The kernels of the other workers are left running.
+	if jupyter_sandbox.status == "ready":
+		jupyter_sandbox.get().close_all_sessions(snapshot=True)
+
+
+@app.get("/sandbox/kernels")
+async def sandbox_kernels():
+	# Memory (RSS) and CPU of each kernel at the last round of the reaper, and kernels closed by reason
+	if kernel_reaper.status != "ready":
+		return kernel_reaper.stats()
+	return kernel_reaper.get().stats()
+
+
+@app.get("/prefetch/stats")
+async def prefetch_stats():
+	# Warmups started / completed / cancelled, and how many were used by the tools (hit rate)
+	return prefetcher.stats()
+
+
+@app.get("/evaluation/stats")
+async def evaluation_stats(session_id: str = None):
+	# LLM evaluator calls run / skipped by the evaluation policy, per session
+	return evaluation_policy.stats(session_id)
+
+
 if __name__ == "__main__":
 	import uvicorn
 	uvicorn.run(app, host="0.0.0.0", port=8080)
\ No newline at end of file
@@ -0,0 +1,144 @@
+"""
+Runs a batch of research questions through the SciSciGPT graph, in-process
+
+	python batch.py questions.jsonl results.jsonl --events events.jsonl --concurrency 4
+	python batch.py questions.jsonl results.jsonl --offline  # stub models and tools, no network
+
+Each line of the input is {"id": ..., "question": ..., "model_name": ... (optional)}. Each line of the
+output is the final answer of a question; questions already answered in the output are skipped, so an
+interrupted batch is resumed by running the same command again. The custom events of each question
+(the messages of every node, as streamed to the frontend) are written to `--events`.
+"""
+import argparse, asyncio, json, os, time, uuid
+from dotenv import load_dotenv
+load_dotenv()
+
+
+def load_questions(path: str) -> list[dict]:
+	questions = []
+	with open(path) as f:
+		for i, line in enumerate(f):
+			if line.strip():
+				question = json.loads(line)
+				question.setdefault("id", str(i))
+				questions.append(question)
+	return questions
+
+
+def load_completed(path: str) -> set:
+	# Ids of the questions answered without error
+	completed = set()
+	if os.path.exists(path):
+		with open(path) as f:
+			for line in f:
+				try:
+					result = json.loads(line)
+				except json.JSONDecodeError:
+					continue  # a line cut short by an interruption
+				if result.get("status", None) == "ok":
+					completed.add(str(result["id"]))
+	return completed
+
+
+def append_lines(path: str, records: list[dict]):
+	if path and records:
+		with open(path, "a") as f:
+			for record in records:
+				f.write(json.dumps(record, default=str) + "\n")
+
+
+async def run_question(sciscigpt, question: dict, args) -> tuple[dict, list[dict]]:
+	from langchain_core.messages import HumanMessage
+	from agents.utils.messages import _index_messages
+
+	session_id = f"{args.session_prefix}-{question['id']}-{uuid.uuid4().hex[:8]}"
+	metadata = {"session_id": session_id, "model_name": question.get("model_name", args.model_name), "db_name": args.db_name}
+	messages = [HumanMessage(content=question["question"])]
+	state = {"messages": messages, "index": _index_messages(messages), "metadata": metadata}
+	config = {"recursion_limit": args.recursion_limit, "run_name": "SciSciGPT", "configurable": {"thread_id": session_id}}
+
+	events, answer, error = [], None, None
+	started = time.monotonic()
+	try:
+		async for event in sciscigpt.astream_events(state, config, version="v2"):
+			if event["event"] == "on_custom_event" and event["name"] != "tool_output":
+				# The partial outputs of the running tools are transient
+				events.append({"id": question["id"], "session_id": session_id, "name": event["name"], "data": event["data"]})
+			elif event["event"] == "on_chain_end" and not event.get("parent_ids", None):
+				output = event["data"].get("output", None) or {}
+				answer = output["messages"][-1].text() if output.get("messages", None) else None
+	except Exception as e:
+		error = "{}: {}".format(type(e).__name__, str(e))
+
+	result = {
+		"id": question["id"], "session_id": session_id, "question": question["question"],
+		"model_name": metadata["model_name"], "status": "error" if error else "ok",
+		"answer": answer, "error": error, "seconds": round(time.monotonic() - started, 3),
+	}
+	return result, events
+
+
+async def run_batch(sciscigpt, questions: list[dict], args):
+	completed = load_completed(args.output)
+	pending = [q for q in questions if str(q["id"]) not in completed]
+	print(f"{len(questions)} questions, {len(questions) - len(pending)} already answered, {len(pending)} to run")
+
+	semaphore = asyncio.Semaphore(args.concurrency)
+	done = {"ok": 0, "error": 0}
+
+	async def run(question):
+		async with semaphore:
+			result, events = await run_question(sciscigpt, question, args)
+		# Written once a question is complete, so that an interrupted question is rerun from scratch
+		append_lines(args.events, events)
+		append_lines(args.output, [result])
+		done[result["status"]] += 1
+		print(f"[{done['ok'] + done['error']}/{len(pending)}] {question['id']}: {result['status']} ({result['seconds']} s)")
+
+	await asyncio.gather(*[run(question) for question in pending])
+	return done
+
+
+def build_graph(args):
+	# The offline stubs must be installed before the graph (and its tools) are imported
+	if args.offline:
+		from func.stubs import install_offline_stubs, stub_llm_dict
+		install_offline_stubs()
+		llm_dict = stub_llm_dict()
+	else:
+		from func.llm import llm_dict
+
+	from func.gateway import LLMGateway
+	from agents.sciscigpt import define_sciscigpt_graph
+	from agents.utils.evaluation_policy import EvaluationPolicy
+
+	gateway = LLMGateway(
+		llm_dict,
+		max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", 8)),
+		requests_per_minute=float(os.getenv("LLM_REQUESTS_PER_MINUTE", 60)) if not args.offline else 1e6,
+		processes=int(os.getenv("LLM_PROCESSES") or 1),
+	)
+	evaluation_policy = EvaluationPolicy(mode=os.getenv("EVALUATION_POLICY", "adaptive"))
+	return define_sciscigpt_graph(gateway, evaluation_policy=evaluation_policy).compile()
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Run a batch of research questions through SciSciGPT")
+	parser.add_argument("input", help="JSONL of questions: {\"id\", \"question\", \"model_name\" (optional)}")
+	parser.add_argument("output", help="JSONL of final answers, appended to (completed questions are skipped)")
+	parser.add_argument("--events", default=None, help="JSONL of the custom events of each question")
+	parser.add_argument("--concurrency", type=int, default=4, help="Questions run at the same time")
+	parser.add_argument("--model-name", default="claude-4.0")
+	parser.add_argument("--db-name", default="SciSciNet_US_V4", help="Database of the SQL tools (the one the frontend uses)")
+	parser.add_argument("--session-prefix", default="batch")
+	parser.add_argument("--recursion-limit", type=int, default=500)
+	parser.add_argument("--offline", action="store_true", help="Use stub models and tools (no network access)")
+	args = parser.parse_args()
+
+	sciscigpt = build_graph(args)
+	done = asyncio.run(run_batch(sciscigpt, load_questions(args.input), args))
+	print(f"Done: {done['ok']} ok, {done['error']} errors")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,56 @@
+import hashlib, os
+from contextlib import asynccontextmanager
+from langchain_core.callbacks import BaseCallbackHandler
+
+
+@asynccontextmanager
+async def open_checkpointer(db_path: str = None):
+	# Per-session graph state, keyed by `thread_id` (= metadata.session_id), in the SQLite database of
+	# CHECKPOINT_DB_PATH, shared by the workers. Without it there is no checkpointer: the graph keeps no
+	# state between requests, and the client always sends the full history.
+	# Entered from the startup of the app, as the saver must be created on the running event loop.
+	db_path = db_path or os.getenv("CHECKPOINT_DB_PATH")
+	if not db_path:
+		yield None
+		return
+
+	from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
+
+	os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+	async with AsyncSqliteSaver.from_conn_string(db_path) as saver:
+		yield saver
+
+
+def thread_config(config: dict, session_id: str) -> dict:
+	configurable = {**config.get("configurable", {}), "thread_id": session_id}
+	return {**config, "configurable": configurable}
+
+
+class EventRecorder(BaseCallbackHandler):
+	# The `data` of the custom events of a turn that the client keeps in its history (all but the transient ones)
+	run_inline = True
+	transient = ["tool_output", "checkpoint_miss"]
+
+	def __init__(self):
+		self.data = []
+
+	def on_custom_event(self, name, data, **kwargs):
+		if name not in self.transient:
+			self.data.append(data)
+
+
+def extend_history(history: dict, data: list) -> dict:
+	"""
+	Fingerprint of the client's events history, as computed by the client (frontend/lib/chat/actions.tsx)
+
+	Parameters:
+	history (dict): Fingerprint of the history so far, None if empty
+	data (list): The `data` of the events appended to it
+
+	Returns:
+	dict: The number of events of the history, and the SHA-256 of the `data` of its last event
+	"""
+	history = history or { "length": 0, "last": None }
+	if not data:
+		return history
+	return { "length": history["length"] + len(data), "last": hashlib.sha256(data[-1].encode()).hexdigest() }
@@ -0,0 +1,67 @@
+import os, time, threading
+from concurrent.futures import ThreadPoolExecutor
+from langchain_core.runnables.config import run_in_executor
+from dotenv import load_dotenv
+load_dotenv()
+
+
+class ToolExecutors:
+	def __init__(self, max_workers: dict):
+		"""
+		Bounded thread pools, one per tool class, so that a slow class (e.g. a 240 s BigQuery
+		query or a long Jupyter cell) cannot starve the others
+
+		Parameters:
+		max_workers (dict): Number of worker threads per tool class
+		"""
+		self.max_workers = dict(max_workers)
+		self.executors = {
+			name: ThreadPoolExecutor(max_workers=n, thread_name_prefix=f"tool-{name}")
+			for name, n in max_workers.items()
+		}
+		self.counters = {
+			name: {"queued": 0, "running": 0, "completed": 0, "failed": 0, "wait_seconds": 0.0, "run_seconds": 0.0}
+			for name in max_workers
+		}
+		self._lock = threading.Lock()
+
+	def _count(self, tool_class: str, **deltas):
+		with self._lock:
+			for k, v in deltas.items():
+				self.counters[tool_class][k] += v
+
+	async def run(self, tool_class: str, func, *args, **kwargs):
+		# Runs `func` in the pool of `tool_class`, with the caller's context (callbacks, config)
+		executor = self.executors[tool_class]
+		submitted = time.monotonic()
+		self._count(tool_class, queued=1)
+
+		def timed():
+			started = time.monotonic()
+			self._count(tool_class, queued=-1, running=1, wait_seconds=started - submitted)
+			try:
+				result = func(*args, **kwargs)
+				self._count(tool_class, completed=1)
+				return result
+			except Exception:
+				self._count(tool_class, failed=1)
+				raise
+			finally:
+				self._count(tool_class, running=-1, run_seconds=time.monotonic() - started)
+
+		return await run_in_executor(executor, timed)
+
+	def stats(self) -> dict:
+		with self._lock:
+			return { name: {**c, "max_workers": self.max_workers[name]} for name, c in self.counters.items() }
+
+	def shutdown(self, wait: bool = False):
+		for executor in self.executors.values():
+			executor.shutdown(wait=wait, cancel_futures=True)
+
+
+tool_executors = ToolExecutors({
+	"sql": int(os.getenv("TOOL_SQL_WORKERS", 8)),
+	"sandbox": int(os.getenv("TOOL_SANDBOX_WORKERS", 8)),
+	"vector_search": int(os.getenv("TOOL_VECTOR_SEARCH_WORKERS", 8)),
+})
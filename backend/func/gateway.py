@@ -0,0 +1,165 @@
+import asyncio, random, threading, time, weakref
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.runnables.config import ensure_config
+
+
+class TokenBucket:
+	def __init__(self, requests_per_minute: float, burst: int = None):
+		"""Rate limiter shared by every thread / event loop of the process"""
+		self.rate = requests_per_minute / 60
+		self.capacity = burst or max(1, round(self.rate * 10))
+		self.tokens = self.capacity
+		self.updated = time.monotonic()
+		self.lock = threading.Lock()
+
+	def reserve(self) -> float:
+		# Takes a token and returns the number of seconds to wait until it is actually available
+		with self.lock:
+			now = time.monotonic()
+			self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+			self.updated = now
+			self.tokens -= 1
+			return max(0.0, -self.tokens / self.rate)
+
+
+RETRY_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+
+def _is_retryable(e: Exception) -> bool:
+	# Anthropic errors carry `status_code`, google.api_core errors carry `code`
+	code = getattr(e, "status_code", None) or getattr(e, "code", None)
+	if isinstance(code, int):
+		return code in RETRY_STATUS_CODES
+	return isinstance(e, (TimeoutError, ConnectionError)) or type(e).__name__ in ["APIConnectionError", "APITimeoutError"]
+
+class _EmissionTracker(BaseCallbackHandler):
+	# Whether a call already streamed tokens to the client (it cannot be retried without duplicating them)
+	run_inline = True
+
+	def __init__(self):
+		self.emitted = False
+
+	def on_llm_new_token(self, token, **kwargs):
+		self.emitted = True
+
+def _with_tracker(config: dict, tracker: _EmissionTracker) -> dict:
+	config = ensure_config(config)
+	callbacks = config.get("callbacks", None)
+	if callbacks is None:
+		callbacks = [tracker]
+	elif isinstance(callbacks, list):
+		callbacks = [*callbacks, tracker]
+	else:
+		callbacks = callbacks.copy()
+		callbacks.add_handler(tracker, inherit=True)
+	return {**config, "callbacks": callbacks}
+
+def _per_model(value, model_name: str):
+	return value.get(model_name, value.get("default")) if isinstance(value, dict) else value
+
+
+class LLMGateway:
+	def __init__(self, llm_dict: dict, max_concurrency: int | dict = 8, requests_per_minute: float | dict = 60,
+			max_retries: int = 5, base_delay: float = 1.0, max_delay: float = 60.0, processes: int = 1):
+		"""
+		Single entry point for all LLM calls of the process
+
+		Parameters:
+		llm_dict (dict): Chat models by model name
+		max_concurrency (int | dict): Concurrent requests per model (or a dict by model name, with a `default`)
+		requests_per_minute (float | dict): Request rate per model, matched to the Vertex quota
+		max_retries (int): Retries of 429 / 5xx / connection errors, with jittered exponential backoff, as long as
+			no token reached the client. The retries of the models' own clients should be disabled.
+		processes (int): Number of processes sharing `requests_per_minute` (e.g. the uvicorn workers, and a batch runner
+			next to the server), each limited to its share: the rate limit is per process
+		"""
+		self.llm_dict = llm_dict
+		self.max_concurrency = { m: _per_model(max_concurrency, m) for m in llm_dict }
+		self.buckets = { m: TokenBucket(_per_model(requests_per_minute, m) / processes) for m in llm_dict }
+		self.max_retries = max_retries
+		self.base_delay = base_delay
+		self.max_delay = max_delay
+
+		self.counters = { m: {"queued": 0, "in_flight": 0, "requests": 0, "retries": 0, "failures": 0} for m in llm_dict }
+		self._counters_lock = threading.Lock()
+		# asyncio semaphores are bound to an event loop
+		self._semaphores = weakref.WeakKeyDictionary()
+		self._non_streaming = {}
+		self._loop = None
+
+	def _count(self, model_name: str, **deltas):
+		with self._counters_lock:
+			for k, v in deltas.items():
+				self.counters[model_name][k] += v
+
+	def _semaphore(self, model_name: str) -> asyncio.Semaphore:
+		semaphores = self._semaphores.setdefault(asyncio.get_running_loop(), {})
+		if model_name not in semaphores:
+			semaphores[model_name] = asyncio.Semaphore(self.max_concurrency[model_name])
+		return semaphores[model_name]
+
+	def model(self, model_name: str, tools: list = None, streaming: bool = True):
+		llm = self.llm_dict[model_name]
+		# Non-streaming copies (sharing the clients) for calls whose tokens must not reach the client stream
+		if not streaming and hasattr(llm, "model_copy"):
+			if model_name not in self._non_streaming:
+				self._non_streaming[model_name] = llm.model_copy(update={"disable_streaming": True})
+			llm = self._non_streaming[model_name]
+		return llm.bind_tools(tools) if tools else llm
+
+	async def ainvoke(self, model_name: str, input, config: dict = None, tools: list = None, streaming: bool = True, model=None):
+		# `model` is a chat model of `model_name` prepared ahead (e.g. with its tools already bound)
+		model = model or self.model(model_name, tools, streaming)
+		if self._loop is None or not self._loop.is_running():
+			self._loop = asyncio.get_running_loop()
+
+		for attempt in range(self.max_retries + 1):
+			queued = True
+			tracker = _EmissionTracker()
+			self._count(model_name, queued=1)
+			try:
+				# The rate limit is waited for before taking a concurrency slot, so that it does not hold one
+				await asyncio.sleep(self.buckets[model_name].reserve())
+				async with self._semaphore(model_name):
+					queued = False
+					self._count(model_name, queued=-1, in_flight=1, requests=1)
+					try:
+						return await model.ainvoke(input, config=_with_tracker(config, tracker))
+					finally:
+						self._count(model_name, in_flight=-1)
+
+			except Exception as e:
+				if attempt == self.max_retries or not _is_retryable(e) or tracker.emitted:
+					self._count(model_name, failures=1)
+					raise
+				self._count(model_name, retries=1)
+
+			finally:
+				if queued:
+					self._count(model_name, queued=-1)
+
+			await asyncio.sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)))
+
+	def run_sync(self, coro):
+		# Run a gateway coroutine from synchronous code (e.g. a tool's `_run` in a worker thread),
+		# on the server's event loop if there is one so that the limits are shared
+		try:
+			asyncio.get_running_loop()
+		except RuntimeError:
+			pass
+		else:
+			coro.close()
+			raise RuntimeError("LLMGateway.run_sync cannot be called from a running event loop, await the coroutine instead")
+
+		if self._loop is not None and self._loop.is_running():
+			return asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+		return asyncio.run(coro)
+
+	def invoke(self, model_name: str, input, config: dict = None, tools: list = None, streaming: bool = True):
+		return self.run_sync(self.ainvoke(model_name, input, config=config, tools=tools, streaming=streaming))
+
+	def queue_depth(self) -> dict:
+		return { m: c["queued"] for m, c in self.counters.items() }
+
+	def stats(self) -> dict:
+		with self._counters_lock:
+			return { m: {**c, "max_concurrency": self.max_concurrency[m]} for m, c in self.counters.items() }
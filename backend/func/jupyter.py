@@ -1,17 +1,170 @@
-from jupyter_client import KernelManager
-from queue import Empty
-import time, uuid, re
+import time, uuid, re, threading
 from IPython.core.ultratb import FormattedTB
 from typing import Dict, Optional
-import asyncio
+import asyncio, os, shutil, hashlib, json, logging
+import psutil
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from func.kernel_registry import KernelRegistry
+from func.kernel_router import KernelRouter
+from func.kernel_provider import LocalKernelProvider
+
+logger = logging.getLogger(__name__)
+
+# Initialization of the R and Julia bridges, run in a session before its first R / Julia cell.
+# Idempotent and silent, as the kernel may be shared with (and initialized by) another worker process.
+BRIDGES = {
+    "r": "_ = get_ipython().extension_manager.load_extension('rpy2.ipython')",
+    "julia": "if 'jl' not in globals():\n    from juliacall import Main as jl",
+}
+
+# Run in a kernel before it is closed: saves the user namespace to a snapshot directory. The DataFrames are
+# written as parquet files, the other objects pickled (with cloudpickle if installed, e.g. for the functions
+# and classes defined in the session), the modules recorded by name. The objects that cannot be serialized
+# (e.g. open files, R / Julia objects) are skipped. The manifest is written last, and the directory renamed
+# into place, so that an interrupted snapshot is never restored.
+SNAPSHOT = '''
+def _sandbox_snapshot(path):
+    import json, os, pickle, shutil, types, uuid
+    try:
+        import cloudpickle as serializer
+    except ImportError:
+        serializer = pickle
+    shell = get_ipython()
+    hidden = set(shell.user_ns_hidden) | {"In", "Out", "exit", "quit", "get_ipython", "jl"}
+    tmp = f"{path}.tmp-{uuid.uuid4().hex[:8]}"
+    os.makedirs(tmp)
+    manifest = {"modules": {}, "variables": {}, "skipped": []}
+    for name, value in list(shell.user_ns.items()):
+        if name.startswith("_") or name in hidden:
+            continue
+        if isinstance(value, types.ModuleType):
+            manifest["modules"][name] = value.__name__
+            continue
+        file = os.path.join(tmp, str(len(manifest["variables"])))
+        try:
+            if type(value).__name__ == "DataFrame" and type(value).__module__.startswith("pandas"):
+                try:
+                    value.to_parquet(file + ".parquet")
+                    manifest["variables"][name] = {"format": "parquet", "file": os.path.basename(file) + ".parquet"}
+                    continue
+                except Exception:
+                    pass  # e.g. columns of mixed types: pickled
+            with open(file + ".pkl", "wb") as f:
+                serializer.dump(value, f)
+            manifest["variables"][name] = {"format": "pickle", "file": os.path.basename(file) + ".pkl"}
+        except Exception:
+            for extension in (".parquet", ".pkl"):
+                if os.path.exists(file + extension):
+                    os.remove(file + extension)
+            manifest["skipped"].append(name)
+    summary = {"variables": list(manifest["variables"]), "skipped": manifest["skipped"]}
+    if not manifest["variables"] and not manifest["skipped"]:
+        # Imports only (e.g. of the kernel setup): nothing worth restoring
+        shutil.rmtree(tmp)
+        print(json.dumps(summary))
+        return
+    with open(os.path.join(tmp, "manifest.json"), "w") as f:
+        json.dump(manifest, f)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.rename(tmp, path)
+    print(json.dumps(summary))
+'''
+
+# Run in a new kernel of a session that has a snapshot, before its first cell: loads the snapshot into the user namespace
+RESTORE = '''
+def _sandbox_restore(path):
+    import importlib, json, os, pickle
+    with open(os.path.join(path, "manifest.json")) as f:
+        manifest = json.load(f)
+    shell = get_ipython()
+    restored, skipped = [], list(manifest["skipped"])
+    for name, module in manifest["modules"].items():
+        try:
+            shell.user_ns[name] = importlib.import_module(module)
+        except Exception:
+            skipped.append(name)
+    for name, variable in manifest["variables"].items():
+        file = os.path.join(path, variable["file"])
+        try:
+            if variable["format"] == "parquet":
+                import pandas
+                shell.user_ns[name] = pandas.read_parquet(file)
+            else:
+                # cloudpickle's output is read by pickle (cloudpickle must be installed)
+                with open(file, "rb") as f:
+                    shell.user_ns[name] = pickle.load(f)
+            restored.append(name)
+        except Exception:
+            skipped.append(name)
+    print(json.dumps({"variables": restored, "skipped": skipped}))
+'''
 
 class JupyterSandbox:
-    def __init__(self, working_dir: str, kernel_name: str=None):
-        """Initialize the session manager to handle multiple Jupyter kernels"""
+    def __init__(self, working_dir: str, kernel_name: str=None, registry: KernelRegistry=None, pool_size: int=0,
+                 interrupt_grace: float=10, snapshot_dir: str=None, snapshot_timeout: float=300, provider=None,
+                 queue_timeout: float=600):
+        """
+        Initialize the session manager to handle multiple Jupyter kernels
+
+        Parameters:
+        working_dir (str): Working directory of the kernels
+        kernel_name (str): Name of the kernel spec of the local kernels (default: the default kernel)
+        registry (KernelRegistry): Registry of the kernels shared by the worker processes of the host.
+            Without it, the kernels are only known to this process.
+        pool_size (int): Number of kernels started and initialized ahead of time (on each node of the provider),
+            handed out to new sessions
+        interrupt_grace (float): Number of seconds a cell that timed out is given to stop once interrupted,
+            before its kernel is restarted
+        snapshot_dir (str): Directory of the snapshots of the Python variables of the sessions, taken when their
+            kernel is evicted or shut down, and restored before the next cell of the session (no snapshots if None)
+        snapshot_timeout (float): Number of seconds a snapshot or a restore may take
+        provider (LocalKernelProvider | GatewayKernelProvider): Where the kernels run
+            (default: kernels started on this host)
+        queue_timeout (float): Number of seconds a cell may wait for the kernel to finish the cells submitted
+            before it (e.g. by another worker process), before its own timeout starts
+        """
         self.working_dir = working_dir
-        self.kernel_name = kernel_name
+        self.provider = provider or LocalKernelProvider(kernel_name)
+        self.registry = registry
+        self.interrupt_grace = interrupt_grace
+        self.queue_timeout = queue_timeout
+        self.snapshot_dir = snapshot_dir
+        self.snapshot_timeout = snapshot_timeout
+        if snapshot_dir is not None:
+            os.makedirs(snapshot_dir, exist_ok=True)
         self.sessions: Dict[str, Dict] = {}
         self.tb_formatter = FormattedTB(mode='Plain')
+        # A session may be created by a prefetch and a tool call at the same time
+        self._session_locks: Dict[str, threading.RLock] = {}
+        self._locks_lock = threading.Lock()
+
+        # The kernel routers of all sessions run on one event loop, in a background thread
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name="kernel-router", daemon=True).start()
+
+        # Pool of pre-started kernels, replenished by a background thread
+        self.pool_size = pool_size
+        self.pool: Dict[str, list] = {}  # node -> kernels
+        self.pool_counters = {"hits": 0, "misses": 0, "started": 0, "failed": 0}
+        self.first_execution_seconds = deque(maxlen=1000)  # from the session request to the end of its first cell
+        self._pool_lock = threading.Lock()
+        self._pool_wakeup = threading.Event()
+        self._closed = False
+        if pool_size > 0:
+            threading.Thread(target=self._replenish_pool, name="kernel-pool", daemon=True).start()
+            self._pool_wakeup.set()
+
+    def _run_coroutine(self, coro):
+        # Runs `coro` on the router loop, from any other thread
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    def _session_lock(self, session_id: str):
+        if self.registry is not None:
+            return self.registry.lock(session_id)
+        with self._locks_lock:
+            return self._session_locks.setdefault(session_id, threading.RLock())
 
     def get_or_create_session(self, session_id: str) -> Dict:
         """
@@ -23,33 +176,158 @@ class JupyterSandbox:
         Returns:
         dict: Session information containing kernel manager and client
         """
+        with self._session_lock(session_id):
+            return self._get_or_create_session(session_id)
+
+    def _get_or_create_session(self, session_id: str) -> Dict:
+        if self.registry is not None:
+            entry = self.registry.lookup(session_id)
+            session = self.sessions.get(session_id, None)
+            if session is not None and (entry is None or entry['connection_file'] != session['connection_file']):
+                # The kernel was closed or replaced by another worker
+                self._drop_session(session_id)
+            if session_id not in self.sessions and entry is not None:
+                self._attach_session(session_id, entry['connection_file'])
+
         if session_id not in self.sessions:
-            # Create new kernel and client
-            km = KernelManager(kernel_name=self.kernel_name) if self.kernel_name else KernelManager()
-            km.start_kernel()
-            kc = km.client()
-            kc.start_channels()
-            # Wait for kernel to be ready
-            kc.wait_for_ready()
-            
-            self.sessions[session_id] = {
-                'km': km,
-                'kc': kc,
-                'last_used': time.time()
-            }
+            requested_at = time.monotonic()
+            kernel = self._take_pooled_kernel(session_id)
+            if kernel is None:
+                # Create new kernel and client, on the node of the session
+                connection_file = self.registry.connection_file(session_id) if self.registry is not None else None
+                kernel = self._start_kernel(connection_file, self.provider.nodes(session_id))
 
-            self.execute_code(
-                "%load_ext rpy2.ipython", session_id=session_id, cell_id=str(uuid.uuid4()), timeout=120)
-            self.execute_code(
-                "from juliacall import Main as jl", session_id=session_id, cell_id=str(uuid.uuid4()), timeout=120)
-            self.execute_code(
-                f"import os; os.chdir('{self.working_dir}')", session_id=session_id, cell_id=str(uuid.uuid4()), timeout=120)
+            self.sessions[session_id] = kernel | {
+                'last_used': time.time(),
+                'requested_at': requested_at,
+                'executed': False,
+                'bridges': set()
+            }
+            if self.registry is not None:
+                self.registry.register(session_id, kernel['connection_file'], kernel['pid'])
         else:
             # Update last used timestamp
             self.sessions[session_id]['last_used'] = time.time()
+            if self.registry is not None:
+                self.registry.touch(session_id)
 
         return self.sessions[session_id]
 
+    def _start_kernel(self, connection_file: str, nodes: list[str]) -> Dict:
+        # Starts a kernel on the first of `nodes` that is up, and initializes it (working directory).
+        # The R and Julia bridges are initialized on first use.
+        for node in nodes:
+            try:
+                kernel = self._run_coroutine(self.provider.start(node, connection_file))
+                break
+            except Exception as e:
+                if node == nodes[-1]:
+                    raise
+                logger.warning("Failed to start a kernel on %s: %s: %s", node, type(e).__name__, e)
+
+        self._setup_kernel(kernel['router'])
+        return kernel
+
+    def _setup_kernel(self, router: KernelRouter):
+        self._execute(router, f"import os; os.chdir('{self.working_dir}')", timeout=120)
+
+    def _take_pooled_kernel(self, session_id: str) -> Optional[Dict]:
+        # A kernel of the pool of the node of the session
+        if self.pool_size <= 0:
+            return None
+        node = self.provider.nodes(session_id)[0]
+        with self._pool_lock:
+            pool = self.pool.get(node, [])
+            kernel = pool.pop(0) if pool and not self._closed else None
+            self.pool_counters["hits" if kernel else "misses"] += 1
+        self._pool_wakeup.set()
+        if kernel is not None and self.registry is not None:
+            self.registry.unregister_pooled(kernel['connection_file'])
+        return kernel
+
+    def _replenish_pool(self):
+        while True:
+            self._pool_wakeup.wait()
+            self._pool_wakeup.clear()
+            while not self._closed:
+                node = next((n for n in self.provider.nodes() if len(self.pool.get(n, [])) < self.pool_size), None)
+                if node is None:
+                    break
+                connection_file = None
+                if self.registry is not None:
+                    connection_file = os.path.join(self.registry.dir, f"kernel-pool-{uuid.uuid4().hex[:16]}.json")
+                try:
+                    kernel = self._start_kernel(connection_file, [node])
+                except Exception as e:
+                    with self._pool_lock:
+                        self.pool_counters["failed"] += 1
+                    logger.warning("Kernel pool: failed to start a kernel on %s: %s: %s", node, type(e).__name__, e)
+                    time.sleep(5)
+                    continue
+                if self.registry is not None:
+                    self.registry.register_pooled(kernel['connection_file'], kernel['pid'])
+                with self._pool_lock:
+                    self.pool.setdefault(node, []).append(kernel)
+                    self.pool_counters["started"] += 1
+
+    def pooled_kernels(self) -> list[Dict]:
+        """
+        Returns:
+        list: Kernel pid of each pooled kernel (of all the worker processes, with a registry)
+        """
+        if self.registry is not None:
+            return [
+                {'pid': entry['pid'] if entry['hostname'] == self.registry.hostname else None}
+                for entry in self.registry.pooled()
+            ]
+        with self._pool_lock:
+            return [{'pid': kernel['pid']} for kernels in self.pool.values() for kernel in kernels]
+
+    def stats(self) -> dict:
+        """
+        Returns:
+        dict: Sessions of this process (by node), pool hits / misses, and time to first execution of the new sessions
+        """
+        nodes = {}
+        for session in list(self.sessions.values()):
+            nodes[session['node']] = nodes.get(session['node'], 0) + 1
+        with self._pool_lock:
+            seconds = sorted(self.first_execution_seconds)
+            return {
+                "sessions": len(self.sessions),
+                "nodes": nodes,
+                "pool": {
+                    **self.pool_counters, "size": self.pool_size,
+                    "available": { node: len(kernels) for node, kernels in self.pool.items() }
+                },
+                "first_execution_seconds": {
+                    "count": len(seconds),
+                    "mean": round(sum(seconds) / len(seconds), 3) if seconds else None,
+                    "p50": round(seconds[len(seconds) // 2], 3) if seconds else None,
+                    "max": round(seconds[-1], 3) if seconds else None,
+                },
+            }
+
+    def _attach_session(self, session_id: str, connection_file: str):
+        # Connects to the kernel started by another worker process
+        try:
+            kernel = self._run_coroutine(self.provider.attach(connection_file))
+        except Exception as e:
+            # Unresponsive or unreachable kernel: replaced by a new one
+            logger.warning("Failed to connect to the kernel of %s: %s: %s", session_id, type(e).__name__, e)
+            self.registry.unregister(session_id)
+            return
+        entry = self.registry.lookup(session_id) or {}
+        if kernel['pid'] is None and entry.get('hostname', None) == self.registry.hostname:
+            kernel['pid'] = entry.get('pid', None)
+        self.sessions[session_id] = kernel | {'last_used': time.time()}
+
+    def _drop_session(self, session_id: str):
+        # Forgets the session in this process, without shutting down its kernel
+        session = self.sessions.pop(session_id, None)
+        if session is not None:
+            self._run_coroutine(session['router'].close())
+
     def format_traceback(self, traceback_list):
         """
         Convert traceback information to readable plain text format
@@ -66,7 +344,7 @@ class JupyterSandbox:
         
         return '\n'.join(cleaned_traceback)
 
-    def execute_code(self, code: str, session_id: str, cell_id: str, timeout: int = 120):
+    def execute_code(self, code: str, session_id: str, cell_id: str, timeout: int = 120, bridge: str = None):
         """
         Execute Python code in a specific session and return results
         
@@ -74,98 +352,384 @@ class JupyterSandbox:
         code (str): Python code to execute
         session_id (str): Session identifier for persistent variables
         timeout (int): Execution timeout in seconds
+        bridge (str): `r` / `julia` to initialize the R / Julia bridge of the session (once) before the code
         
         Returns:
         list: List of output results, each element could be:
             - Text output: {'type': 'text', 'text': content}
             - Image output: {'type': 'image_url', 'image_url': {'url': base64_image}}
             - Error output: {'type': 'text', 'text': error_message}
+            - Timing of the cell (last): {'type': 'timing', 'wall_seconds': seconds, 'cpu_seconds': seconds}
+            A cell that times out is interrupted, and its kernel restarted if it does not stop.
         """
-        session = self.get_or_create_session(session_id)
-        kc = session['kc']
-        
-        msg_id = kc.execute(code)
-        outputs = []
-        
-        start_time = time.time()
-        while True:
+        return self._run_coroutine(self._aexecute_code(code, session_id, cell_id, timeout, bridge))
+
+    async def aexecute_code(self, code: str, session_id: str, cell_id: str, timeout: int = 120, bridge: str = None, on_output=None):
+        """
+        Same as `execute_code`, awaitable from any event loop. No thread is blocked while the code runs.
+
+        Parameters:
+        on_output (callable): Called with each output (in the format of the results) as the code runs,
+            from the thread of the router loop
+        """
+        return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(
+            self._aexecute_code(code, session_id, cell_id, timeout, bridge, on_output), self.loop))
+
+    def _prepare_session(self, session_id: str, bridge: str, timeout: int) -> tuple[Dict, list]:
+        # Gets or creates the session, restores its snapshot and initializes its bridge, under the session lock.
+        # Returns the session, and the outputs of a failed bridge initialization. Otherwise the cell is leased
+        # in the registry before the lock is released, so that no worker closes the kernel until it is released.
+        with self._session_lock(session_id):
+            session = self._get_or_create_session(session_id)
+            self._restore_snapshot(session_id, session)
+            bridges = session.setdefault('bridges', set())
+            if bridge is not None and bridge not in bridges:
+                outputs = self._execute(session['router'], BRIDGES[bridge], timeout)
+                if any(o.get('error', False) for o in outputs):
+                    return session, outputs
+                bridges.add(bridge)
+            if self.registry is not None:
+                self.registry.acquire(session_id, self.queue_timeout + timeout + self.interrupt_grace + 60)
+            return session, []
+
+    async def _aexecute_code(self, code: str, session_id: str, cell_id: str, timeout: int = 120, bridge: str = None, on_output=None):
+        # Runs on the router loop. The kernel queues concurrent executions (of all the worker processes), and
+        # the router attributes their outputs, so the execution itself is not under the session lock.
+        session, outputs = await asyncio.to_thread(self._prepare_session, session_id, bridge, timeout)
+        if not outputs:
+            on_message = (lambda msg: [on_output(o) for o in self._format_outputs([msg], True, timeout)]) if on_output else None
+            session['running'] = session.get('running', 0) + 1
             try:
-                msg = kc.get_iopub_msg(timeout=1)
-                msg_type = msg['header']['msg_type']
-                content = msg['content']
-                
-                if msg_type == 'stream':
-                    # Text output
-                    outputs.append({
-                        'type': 'text',
-                        'text': content['text']
-                    })
-                    
-                elif msg_type == 'execute_result':
-                    # Execution result as text output
-                    outputs.append({
-                        'type': 'text',
-                        'text': str(content['data'].get('text/plain', ''))
-                    })
-                    
-                elif msg_type == 'display_data':
-                    # Handle image output
-                    if 'image/png' in content['data']:
-                        image_data = content['data']['image/png']
-                        # Ensure base64 string has correct prefix
-                        if not image_data.startswith('data:image/png;base64,'):
-                            image_data = 'data:image/png;base64,' + image_data
-                        outputs.append({
-                            'type': 'image_url',
-                            'image_url': {
-                                'url': image_data
-                            }
-                        })
-                    elif 'text/plain' in content['data']:
-                        outputs.append({
-                            'type': 'text',
-                            'text': content['data']['text/plain']
-                        })
-                        
-                elif msg_type == 'error':
-                    # Error message as text output
-                    formatted_error = self.format_traceback(content['traceback'])
+                outputs = await self._run_cell(session_id, session, code, timeout, on_message)
+            finally:
+                session['running'] -= 1
+                session['last_used'] = time.time()
+                if self.registry is not None:
+                    await asyncio.to_thread(self.registry.release, session_id)
+        if not session.get('executed', True):
+            session['executed'] = True
+            with self._pool_lock:
+                self.first_execution_seconds.append(time.monotonic() - session['requested_at'])
+        # Told once, with the first cell after the restore
+        if 'restored' in session:
+            outputs = [{'type': 'text', 'text': session.pop('restored')}] + outputs
+        outputs = [o | {'cell_id': cell_id, 'session_id': session_id} for o in outputs]
+        return outputs
+
+    async def _run_cell(self, session_id: str, session: Dict, code: str, timeout: int, on_message=None) -> list:
+        # The timeout starts once the kernel starts the cell, after the cells queued before it. A cell that times
+        # out is interrupted, and its kernel restarted if it does not stop within the grace period: as the cell is
+        # the one running, the interrupt and the restart never hit the cell of another caller.
+        router = session['router']
+        pid = session.get('pid', None)
+        msg_id = router.submit(code, on_message)
+        try:
+            if not await router.wait_started(msg_id, self.queue_timeout):
+                # Still queued: not interrupted, as the running cell is another caller's
+                return [{
+                    'type': 'text',
+                    'text': f'The cell did not start within {self.queue_timeout} seconds, as the kernel is still running '
+                            'other cells of the session. It will run once they finish, its outputs will not be shown.',
+                }]
+            # CPU time of the kernel process that ran the cell (None if it was restarted)
+            started, cpu_started = time.monotonic(), self._cpu_seconds(pid)
+            messages, completed = await router.wait(msg_id, timeout)
+            if completed:
+                outputs = self._format_outputs(messages, completed, timeout)
+            else:
+                # The outputs up to the end of the cell (e.g. its last prints and the KeyboardInterrupt traceback),
+                # then one note of the timeout and of what became of the cell
+                messages, stopped = await self._interrupt(session, router, msg_id)
+                outputs = self._format_outputs(messages, True, timeout)
+                if stopped:
+                    note = 'the cell was interrupted. The variables of the session are kept.'
+                else:
+                    await asyncio.to_thread(self._restart_kernel, session_id)
+                    note = (f'the cell did not stop within {self.interrupt_grace} seconds of the interrupt, the kernel was restarted. '
+                            'All the variables and imports of the session were lost.')
+                outputs.append({'type': 'text', 'text': f'\nExecution timeout after {timeout} seconds: {note}'})
+        finally:
+            router.discard(msg_id)
+
+        cpu_finished = self._cpu_seconds(pid) if session.get('pid', None) == pid else None
+        outputs.append({
+            'type': 'timing',
+            'wall_seconds': round(time.monotonic() - started, 3),
+            'cpu_seconds': round(cpu_finished - cpu_started, 3) if cpu_started is not None and cpu_finished is not None else None,
+        })
+        return outputs
+
+    async def _interrupt(self, session: Dict, router: KernelRouter, msg_id: str) -> tuple[list[dict], bool]:
+        # Returns the messages of the cell, and whether it stopped within the grace period
+        if not router.running(msg_id):
+            return (await router.wait(msg_id, 0))[0], True
+        try:
+            if not await self.provider.interrupt(session):
+                return (await router.wait(msg_id, 0))[0], False
+        except Exception as e:
+            logger.warning("Failed to interrupt the kernel: %s: %s", type(e).__name__, e)
+            return (await router.wait(msg_id, 0))[0], False
+        return await router.wait(msg_id, self.interrupt_grace)
+
+    def _restart_kernel(self, session_id: str):
+        with self._session_lock(session_id):
+            session = self.sessions.get(session_id, None)
+            if session is None:
+                return
+            restarted = self._run_coroutine(self.provider.restart(session))
+            if restarted is not None:
+                session.update(restarted)
+                session['bridges'] = set()
+                self._setup_kernel(session['router'])
+                if self.registry is not None:
+                    self.registry.register(session_id, session['connection_file'], session['pid'])
+            else:
+                # Killed instead (started by another worker process): the next cell starts a new kernel
+                self._drop_session(session_id)
+                if self.registry is not None:
+                    self.registry.unregister(session_id)
+
+    def _cpu_seconds(self, pid: int) -> Optional[float]:
+        # CPU time of the kernel and its child processes
+        if pid is None:
+            return None
+        try:
+            process = psutil.Process(pid)
+            return sum(sum(p.cpu_times()[:2]) for p in [process, *process.children(recursive=True)])
+        except psutil.Error:
+            return None
+
+    def _snapshot_path(self, session_id: str) -> str:
+        return os.path.join(self.snapshot_dir, hashlib.sha1(session_id.encode()).hexdigest()[:16])
+
+    def _take_snapshot(self, session_id: str, session: Dict, timeout: float = None):
+        # Under the session lock, before the kernel is shut down
+        path = self._snapshot_path(session_id)
+        if os.path.exists(os.path.join(path, 'manifest.json')):
+            # Not restored yet: the kernel holds none of the variables of the snapshot
+            return
+        summary = self._run_kernel_function(session, SNAPSHOT, '_sandbox_snapshot', path, timeout)
+        if summary is not None:
+            logger.info("Kernel snapshot of %s: %d variables, skipped %s", session_id, len(summary['variables']), summary['skipped'])
+
+    def _restore_snapshot(self, session_id: str, session: Dict):
+        # Under the session lock. The snapshot is removed once restored (or failed to), as the kernel now holds its variables.
+        if self.snapshot_dir is None:
+            return
+        path = self._snapshot_path(session_id)
+        if not os.path.exists(os.path.join(path, 'manifest.json')):
+            return
+        summary = self._run_kernel_function(session, RESTORE, '_sandbox_restore', path)
+        shutil.rmtree(path, ignore_errors=True)
+        if summary is None:
+            session['restored'] = 'The kernel of the session was closed since its last cell, and its variables could not be restored.\n'
+            return
+        session['restored'] = (
+            'The kernel of the session was closed since its last cell, and its Python variables and imports were restored: '
+            f'{", ".join(summary["variables"]) or "none"}.'
+            + (f' Not restored: {", ".join(summary["skipped"])}.' if summary["skipped"] else '')
+            + ' The R and Julia variables were not kept.\n'
+        )
+
+    def _run_kernel_function(self, session: Dict, source: str, function: str, path: str, timeout: float = None) -> Optional[Dict]:
+        # Defines `function` in the kernel, calls it on `path` and removes it. Returns the JSON it printed, None if it failed.
+        code = f"{source}\ntry:\n    {function}({path!r})\nfinally:\n    del {function}"
+        outputs = self._execute(session['router'], code, timeout or self.snapshot_timeout)
+        text = ''.join(o['text'] for o in outputs if o['type'] == 'text')
+        if any(o.get('error', False) for o in outputs):
+            logger.warning("Kernel %s failed: %s", function, text)
+            return None
+        try:
+            return json.loads(text.strip().splitlines()[-1])
+        except (ValueError, IndexError):
+            logger.warning("Kernel %s failed: %s", function, text)
+            return None
+
+    def prune_snapshots(self, max_age: float) -> int:
+        """
+        Remove the snapshots of the sessions that have not returned within `max_age` seconds
+
+        Returns:
+        int: Number of snapshots removed
+        """
+        if self.snapshot_dir is None:
+            return 0
+        removed = 0
+        for name in os.listdir(self.snapshot_dir):
+            path = os.path.join(self.snapshot_dir, name)
+            try:
+                if time.time() - os.path.getmtime(path) > max_age:
+                    shutil.rmtree(path)
+                    removed += 1
+            except OSError:
+                pass
+        return removed
+
+    def _execute(self, router: KernelRouter, code: str, timeout: int = 120) -> list:
+        # Blocking execution, from a thread other than the router loop's
+        return self._format_outputs(*self._run_coroutine(router.execute(code, timeout)), timeout)
+
+    def _format_outputs(self, messages: list[dict], completed: bool, timeout: int) -> list:
+        outputs = []
+        for msg in messages:
+            msg_type = msg['header']['msg_type']
+            content = msg['content']
+
+            if msg_type == 'stream':
+                # Text output
+                outputs.append({
+                    'type': 'text',
+                    'text': content['text']
+                })
+
+            elif msg_type == 'execute_result':
+                # Execution result as text output
+                outputs.append({
+                    'type': 'text',
+                    'text': str(content['data'].get('text/plain', ''))
+                })
+
+            elif msg_type == 'display_data':
+                # Handle image output
+                if 'image/png' in content['data']:
+                    image_data = content['data']['image/png']
+                    # Ensure base64 string has correct prefix
+                    if not image_data.startswith('data:image/png;base64,'):
+                        image_data = 'data:image/png;base64,' + image_data
                     outputs.append({
-                        'type': 'text',
-                        'text': formatted_error
+                        'type': 'image_url',
+                        'image_url': {
+                            'url': image_data
+                        }
                     })
-                    
-                elif msg_type == 'status' and content['execution_state'] == 'idle':
-                    break
-                    
-            except Empty:
-                if time.time() - start_time > timeout:
+                elif 'text/plain' in content['data']:
                     outputs.append({
                         'type': 'text',
-                        'text': f'Execution timeout after {timeout} seconds'
+                        'text': content['data']['text/plain']
                     })
-                    break
-                continue
-        outputs = [o | {'cell_id': cell_id, 'session_id': session_id} for o in outputs]
+
+            elif msg_type == 'error':
+                # Error message as text output
+                formatted_error = self.format_traceback(content['traceback'])
+                outputs.append({
+                    'type': 'text',
+                    'text': formatted_error,
+                    'error': True
+                })
+
+        if not completed:
+            outputs.append({
+                'type': 'text',
+                'text': f'Execution timeout after {timeout} seconds'
+            })
         return outputs
 
-    def close_session(self, session_id: str):
+    def kernels(self) -> list[Dict]:
+        """
+        Returns:
+        list: Session id, kernel pid, last use, and whether a cell is running of each session
+            (of all the worker processes, with a registry)
+        """
+        running = {session_id for session_id, session in list(self.sessions.items()) if session.get('running', 0) > 0}
+        if self.registry is not None:
+            return [
+                {'session_id': entry['session_id'], 'pid': entry['pid'] if entry['hostname'] == self.registry.hostname else None,
+                 'last_used': entry['last_used'], 'running': self.registry.running(entry) or entry['session_id'] in running}
+                for entry in self.registry.sessions()
+            ]
+        return [
+            {'session_id': session_id, 'pid': session.get('pid', None),
+             'last_used': session['last_used'], 'running': session_id in running}
+            for session_id, session in list(self.sessions.items())
+        ]
+
+    def close_session(self, session_id: str, snapshot: bool = False, snapshot_timeout: float = None, if_idle: bool = False) -> bool:
         """
         Close a specific session and clean up its resources
-        
+
         Parameters:
         session_id (str): Session identifier to close
+        snapshot (bool): Whether to snapshot the variables of the session first (with a `snapshot_dir`),
+            e.g. when its kernel is evicted, to restore them if the session returns
+        snapshot_timeout (float): Number of seconds the snapshot may take (default: `snapshot_timeout` of the sandbox)
+        if_idle (bool): Only if no cell of the session is running (in any worker, with a registry), e.g. when evicted
+
+        Returns:
+        bool: Whether the session was closed
+        """
+        with self._session_lock(session_id):
+            if if_idle and self._running(session_id):
+                return False
+            if self.registry is not None and session_id not in self.sessions:
+                entry = self.registry.lookup(session_id)
+                if entry is not None:
+                    self._attach_session(session_id, entry['connection_file'])
+            if session_id in self.sessions:
+                session = self.sessions[session_id]
+                if snapshot and self.snapshot_dir is not None:
+                    try:
+                        self._take_snapshot(session_id, session, snapshot_timeout)
+                    except Exception as e:
+                        logger.warning("Kernel snapshot of %s failed: %s: %s", session_id, type(e).__name__, e)
+                self._run_coroutine(self.provider.shutdown(session))
+                del self.sessions[session_id]
+            if self.registry is not None:
+                self.registry.unregister(session_id)
+            return True
+
+    def _running(self, session_id: str) -> bool:
+        # Under the session lock, no cell can start meanwhile
+        if self.sessions.get(session_id, {}).get('running', 0) > 0:
+            return True
+        if self.registry is not None:
+            entry = self.registry.lookup(session_id)
+            return entry is not None and self.registry.running(entry)
+        return False
+
+    def _owns(self, session_id: str, session: Dict) -> bool:
+        # Whether this process started the kernel of the session (the others were attached to)
+        if self.registry is None:
+            return True
+        entry = self.registry.lookup(session_id)
+        return (entry is not None and entry['connection_file'] == session['connection_file']
+                and entry['owner_pid'] == os.getpid() and entry['hostname'] == self.registry.hostname)
+
+    def close_all_sessions(self, snapshot: bool = False, timeout: float = None):
+        """
+        Close the sessions whose kernel this process started (after a snapshot of each, if `snapshot`) and the pooled
+        kernels, and clean up resources. The kernels of the other worker processes are only disconnected from.
+
+        Parameters:
+        snapshot (bool): Whether to snapshot the variables of the sessions first (with a `snapshot_dir`)
+        timeout (float): Number of seconds all the snapshots may take, as they are taken concurrently
+            (default: `snapshot_timeout`)
         """
-        if session_id in self.sessions:
-            session = self.sessions[session_id]
-            session['kc'].stop_channels()
-            session['km'].shutdown_kernel()
-            del self.sessions[session_id]
+        self._closed = True
+        owned = []
+        for session_id, session in list(self.sessions.items()):
+            if self._owns(session_id, session):
+                owned.append(session_id)
+            else:
+                with self._session_lock(session_id):
+                    self._drop_session(session_id)
+        if owned:
+            deadline = time.monotonic() + (timeout or self.snapshot_timeout)
+
+            def close(session_id: str):
+                try:
+                    self.close_session(session_id, snapshot=snapshot, snapshot_timeout=max(deadline - time.monotonic(), 1))
+                except Exception as e:
+                    logger.warning("Failed to close the kernel of %s: %s: %s", session_id, type(e).__name__, e)
 
-    def close_all_sessions(self):
-        """Close all active sessions and clean up resources"""
-        for session_id in list(self.sessions.keys()):
-            self.close_session(session_id)
+            with ThreadPoolExecutor(max_workers=len(owned), thread_name_prefix="kernel-close") as executor:
+                list(executor.map(close, owned))
+        with self._pool_lock:
+            pool, self.pool = self.pool, {}
+        for kernel in [kernel for kernels in pool.values() for kernel in kernels]:
+            if self.registry is not None:
+                self.registry.unregister_pooled(kernel['connection_file'])
+            self._run_coroutine(self.provider.shutdown(kernel))
+        self._run_coroutine(self.provider.close())
 
     def cleanup_inactive_sessions(self, max_idle_time: int = 3600):
         """
@@ -175,7 +739,7 @@ class JupyterSandbox:
         max_idle_time (int): Maximum idle time in seconds before session cleanup
         """
         current_time = time.time()
-        for session_id in list(self.sessions.keys()):
-            session = self.sessions[session_id]
-            if current_time - session['last_used'] > max_idle_time:
-                self.close_session(session_id)
\ No newline at end of file
+        # Including the sessions of the other worker processes, with a registry
+        for kernel in self.kernels():
+            if current_time - kernel['last_used'] > max_idle_time and not kernel['running']:
+                self.close_session(kernel['session_id'], snapshot=True, if_idle=True)
\ No newline at end of file
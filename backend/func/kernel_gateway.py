@@ -0,0 +1,183 @@
+import asyncio, hashlib, json, logging, time
+import httpx
+from jupyter_client.jsonutil import json_default
+from jupyter_client.session import Session
+from websockets.asyncio.client import connect
+from func.kernel_router import KernelRouter
+
+logger = logging.getLogger(__name__)
+
+
+class GatewayKernelRouter(KernelRouter):
+	def __init__(self, url: str, kernel_id: str, headers: dict = None):
+		"""
+		Kernel router over the WebSocket of a kernel of a Jupyter Kernel Gateway, which carries the messages
+		of all the channels (as JSON). One connection per kernel, reused by all the executions of the session.
+
+		Parameters:
+		url (str): Base URL of the gateway
+		kernel_id (str): Id of the kernel in the gateway
+		headers (dict): Headers of the connection (e.g. authorization)
+		"""
+		self.url = url.replace("http", "ws", 1) + f"/api/kernels/{kernel_id}/channels"
+		self.headers = headers or {}
+		self.session = Session()
+		self.executions = {}  # msg_id -> {"messages": [...], "done": Future}
+		self.tasks = []
+		self.ws = None
+		self.outbox = None
+
+	async def start(self, timeout: float = 60):
+		self.ws = await connect(self.url, additional_headers=self.headers, max_size=None, open_timeout=timeout)
+		self.outbox = asyncio.Queue()
+		self.tasks = [asyncio.create_task(self._read_websocket()), asyncio.create_task(self._write_websocket())]
+		# Ready once the IOPub messages of a kernel_info request arrive. Repeated, as the first ones may be
+		# published before the gateway is subscribed to the IOPub channel of the kernel.
+		deadline = time.monotonic() + timeout
+		while time.monotonic() < deadline:
+			msg_id = self._track(self._send("shell", "kernel_info_request", {}))
+			try:
+				if (await self.wait(msg_id, 1))[1]:
+					return
+			finally:
+				self.discard(msg_id)
+		raise RuntimeError(f"Kernel didn't respond in {timeout} seconds")
+
+	async def _read_websocket(self):
+		async for data in self.ws:
+			if isinstance(data, bytes):
+				continue  # binary buffers, not used by the outputs of the sandbox
+			try:
+				self._dispatch(json.loads(data))
+			except Exception as e:
+				logger.warning("Kernel router: failed to read a message: %s: %s", type(e).__name__, e)
+
+	async def _write_websocket(self):
+		# Sends the messages in the order they were submitted
+		while True:
+			await self.ws.send(await self.outbox.get())
+
+	def _send(self, channel: str, msg_type: str, content: dict) -> str:
+		msg = self.session.msg(msg_type, content)
+		msg["channel"] = channel
+		self.outbox.put_nowait(json.dumps(msg, default=json_default))
+		return msg["header"]["msg_id"]
+
+	def submit(self, code: str, on_message=None) -> str:
+		content = { "code": code, "silent": False, "store_history": True, "user_expressions": {}, "allow_stdin": False, "stop_on_error": True }
+		return self._track(self._send("shell", "execute_request", content), on_message)
+
+	def shutdown_kernel(self):
+		self._send("control", "shutdown_request", { "restart": False })
+
+	async def close(self):
+		for task in self.tasks:
+			task.cancel()
+		await asyncio.gather(*self.tasks, return_exceptions=True)
+		if self.ws is not None:
+			await self.ws.close()
+
+
+class GatewayKernelProvider:
+	def __init__(self, urls: list[str], kernel_name: str = None, auth_token: str = None, timeout: float = 60):
+		"""
+		Kernels of one or more Jupyter Kernel Gateways (e.g. on dedicated compute nodes), started and
+		managed over HTTP, and reached over WebSocket. The HTTP connections to each gateway are pooled.
+
+		A session's kernel is started on the same node across worker processes and server restarts, by
+		rendezvous hashing of the session id (e.g. for its snapshot and files on the node's disk), or on
+		the next node if that one is down. Adding or removing a node only moves the sessions of that node.
+
+		The nodes must have the working directory of the sandbox at the same path (e.g. a shared volume).
+		The kernels are not on this host: they have no pid, and their CPU and memory are not measured.
+
+		Parameters:
+		urls (list): Base URLs of the gateways, e.g. ["http://node-1:8888"]
+		kernel_name (str): Name of the kernel spec (default: the default kernel of the gateway)
+		auth_token (str): Token of the gateways (KG_AUTH_TOKEN), if any
+		timeout (float): Number of seconds of an HTTP request to a gateway
+		"""
+		self.urls = [url.rstrip("/") for url in urls]
+		self.kernel_name = kernel_name
+		self.headers = { "Authorization": f"token {auth_token}" } if auth_token else {}
+		self.timeout = timeout
+		self.clients = {}  # url -> httpx.AsyncClient, used from the router loop
+
+	def nodes(self, session_id: str = None) -> list[str]:
+		# Where a kernel may be started (for `session_id`: by order of preference)
+		if session_id is None:
+			return list(self.urls)
+		return sorted(self.urls, key=lambda url: hashlib.sha1(f"{url}|{session_id}".encode()).hexdigest(), reverse=True)
+
+	def _client(self, url: str) -> httpx.AsyncClient:
+		if url not in self.clients:
+			self.clients[url] = httpx.AsyncClient(base_url=url, headers=self.headers, timeout=self.timeout)
+		return self.clients[url]
+
+	async def start(self, node: str, connection_file: str = None) -> dict:
+		response = await self._client(node).post("/api/kernels", json={ "name": self.kernel_name } if self.kernel_name else {})
+		response.raise_for_status()
+		kernel = { 'url': node, 'id': response.json()["id"] }
+		try:
+			router = await self._connect(kernel)
+		except Exception:
+			await self._delete(kernel)
+			raise
+
+		# The connection file of a gateway kernel records where it is, for the other worker processes
+		if connection_file is not None:
+			with open(connection_file, "w") as f:
+				json.dump({ "kernel_gateway": kernel }, f)
+		else:
+			connection_file = f"{node}/api/kernels/{kernel['id']}"
+		return { 'kernel': kernel, 'router': router, 'connection_file': connection_file, 'pid': None, 'node': node }
+
+	async def _connect(self, kernel: dict) -> GatewayKernelRouter:
+		router = GatewayKernelRouter(kernel['url'], kernel['id'], self.headers)
+		try:
+			await router.start(timeout=self.timeout)
+		except BaseException:
+			await router.close()
+			raise
+		return router
+
+	async def attach(self, connection_file: str) -> dict:
+		# Connects to the kernel started by another worker process. Raises a RuntimeError if it is gone.
+		with open(connection_file) as f:
+			kernel = json.load(f).get("kernel_gateway", None)
+		if kernel is None:
+			raise RuntimeError(f"{connection_file} is not the connection file of a gateway kernel")
+		response = await self._client(kernel['url']).get(f"/api/kernels/{kernel['id']}")
+		if response.status_code == 404:
+			raise RuntimeError(f"Kernel {kernel['id']} not found on {kernel['url']}")
+		response.raise_for_status()
+		return {
+			'kernel': kernel, 'router': await self._connect(kernel), 'connection_file': connection_file,
+			'pid': None, 'node': kernel['url']
+		}
+
+	async def interrupt(self, kernel: dict) -> bool:
+		response = await self._client(kernel['kernel']['url']).post(f"/api/kernels/{kernel['kernel']['id']}/interrupt")
+		response.raise_for_status()
+		return True
+
+	async def restart(self, kernel: dict) -> dict:
+		# Returns the new `router` and `pid` of the kernel
+		await kernel['router'].close()
+		response = await self._client(kernel['kernel']['url']).post(f"/api/kernels/{kernel['kernel']['id']}/restart")
+		response.raise_for_status()
+		return { 'router': await self._connect(kernel['kernel']), 'pid': None }
+
+	async def shutdown(self, kernel: dict):
+		await kernel['router'].close()
+		await self._delete(kernel['kernel'])
+
+	async def _delete(self, kernel: dict):
+		response = await self._client(kernel['url']).delete(f"/api/kernels/{kernel['id']}")
+		if response.status_code != 404:
+			response.raise_for_status()
+
+	async def close(self):
+		for client in self.clients.values():
+			await client.aclose()
+		self.clients = {}
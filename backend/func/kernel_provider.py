@@ -0,0 +1,81 @@
+import asyncio, os, signal
+from jupyter_client import KernelManager
+from func.kernel_router import KernelRouter
+
+
+class LocalKernelProvider:
+	def __init__(self, kernel_name: str = None):
+		"""
+		Kernels started on this host by a jupyter_client KernelManager, and reached over ZMQ.
+
+		The kernel providers of the JupyterSandbox (see also GatewayKernelProvider) start, connect to,
+		interrupt, restart and shut down the kernels. Their coroutines run on the router loop of the
+		sandbox. A kernel is a dict of its `kernel` handle (None if started by another worker process),
+		`router`, `connection_file`, `pid` (None if not on this host) and `node`.
+
+		Parameters:
+		kernel_name (str): Name of the kernel spec (default: the default kernel)
+		"""
+		self.kernel_name = kernel_name
+
+	def nodes(self, session_id: str = None) -> list[str]:
+		# Where a kernel may be started (for `session_id`: by order of preference)
+		return ["local"]
+
+	async def start(self, node: str, connection_file: str = None) -> dict:
+		km = KernelManager(kernel_name=self.kernel_name) if self.kernel_name else KernelManager()
+		if connection_file is not None:
+			km.connection_file = connection_file
+		await asyncio.to_thread(km.start_kernel)
+		return { 'kernel': km, 'connection_file': km.connection_file, 'node': node, **await self._connect(km) }
+
+	async def _connect(self, km: KernelManager) -> dict:
+		# Waits for the kernel to be ready
+		router = KernelRouter(km.get_connection_info(), km)
+		await router.start()
+		return { 'router': router, 'pid': getattr(km.provisioner, 'pid', None) }
+
+	async def attach(self, connection_file: str) -> dict:
+		# Connects to the kernel started by another worker process. Raises a RuntimeError if it does not respond.
+		router = KernelRouter({ 'connection_file': connection_file })
+		try:
+			await router.start(timeout=30)
+		except RuntimeError:
+			await router.close()
+			raise
+		return { 'kernel': None, 'router': router, 'connection_file': connection_file, 'pid': None, 'node': "local" }
+
+	async def interrupt(self, kernel: dict) -> bool:
+		if kernel['kernel'] is not None:
+			await asyncio.to_thread(kernel['kernel'].interrupt_kernel)
+		elif kernel.get('pid', None) is not None:
+			os.kill(kernel['pid'], signal.SIGINT)
+		else:
+			return False
+		return True
+
+	async def restart(self, kernel: dict) -> dict:
+		# Returns the new `router` and `pid` of the kernel, or None if it was killed instead
+		if kernel['kernel'] is None:
+			# Started by another worker process: killed, the next cell starts a new kernel
+			if kernel.get('pid', None) is not None:
+				try:
+					os.kill(kernel['pid'], signal.SIGKILL)
+				except ProcessLookupError:
+					pass
+			return None
+		await kernel['router'].close()
+		await asyncio.to_thread(kernel['kernel'].restart_kernel, now=True)
+		return await self._connect(kernel['kernel'])
+
+	async def shutdown(self, kernel: dict):
+		if kernel['kernel'] is not None:
+			await kernel['router'].close()
+			await asyncio.to_thread(kernel['kernel'].shutdown_kernel)
+		else:
+			# Kernel started by another worker process
+			kernel['router'].shutdown_kernel()
+			await kernel['router'].close()
+
+	async def close(self):
+		pass
@@ -0,0 +1,157 @@
+import fcntl, logging, os, threading, time
+import psutil
+
+logger = logging.getLogger(__name__)
+
+
+class KernelReaper:
+	def __init__(self, sandbox, interval: float = 60, max_idle_time: float = 3600,
+			max_kernels: int = None, memory_budget_mb: float = None, snapshot_max_age: float = None):
+		"""
+		Samples the memory (RSS) and CPU of the sandbox kernels in a background thread, and closes
+		the kernels of the sessions idle for longer than `max_idle_time`, then those least recently
+		used beyond `max_kernels` or `memory_budget_mb`. Kernels running a cell (in any worker) are never closed.
+		The pooled kernels count against the limits, but are not closed (the pool would replace them).
+		The variables of the sessions closed are snapshotted (if the sandbox has a `snapshot_dir`).
+
+		With a kernel registry, one worker process at a time reaps the kernels of all the workers.
+
+		Parameters:
+		sandbox (JupyterSandbox): Sandbox of the kernels
+		interval (float): Number of seconds between two rounds
+		max_idle_time (float): Number of seconds a session may stay unused
+		max_kernels (int): Maximum number of live kernels (no limit if None)
+		memory_budget_mb (float): Maximum total RSS of the kernels, in MB (no limit if None)
+		snapshot_max_age (float): Number of seconds the snapshot of a session is kept for it to return (forever if None)
+		"""
+		self.sandbox = sandbox
+		self.interval = interval
+		self.max_idle_time = max_idle_time
+		self.max_kernels = max_kernels
+		self.memory_budget_mb = memory_budget_mb
+		self.snapshot_max_age = snapshot_max_age
+		self.usage = {}  # session id -> last sample
+		self.pooled = {"kernels": 0, "rss_mb": 0}  # pooled kernels, at the last sample
+		self.processes = {}  # pid -> psutil.Process (CPU is measured between two samples)
+		self.counters = {"rounds": 0, "idle": 0, "max_kernels": 0, "memory": 0, "failed": 0, "snapshots_pruned": 0}
+		self._lock = threading.Lock()
+
+	def start(self) -> "KernelReaper":
+		threading.Thread(target=self._run_periodically, name="kernel-reaper", daemon=True).start()
+		return self
+
+	def _run_periodically(self):
+		while True:
+			time.sleep(self.interval)
+			try:
+				self.run_once()
+			except Exception as e:
+				logger.warning("Kernel reaper: %s: %s", type(e).__name__, e)
+
+	def _sample(self, pid: int) -> dict:
+		# RSS and CPU of the kernel and its children (e.g. processes started by the R / Julia code)
+		if pid is None:
+			return {"rss_mb": None, "cpu_percent": None}
+		try:
+			if pid not in self.processes:
+				self.processes[pid] = psutil.Process(pid)
+			process = self.processes[pid]
+			processes = [process, *process.children(recursive=True)]
+			rss = sum(p.memory_info().rss for p in processes)
+			cpu = sum(self.processes.setdefault(p.pid, p).cpu_percent(interval=None) for p in processes)
+			return {"rss_mb": round(rss / 2**20, 1), "cpu_percent": round(cpu, 1)}
+		except psutil.Error:
+			self.processes.pop(pid, None)
+			return {"rss_mb": None, "cpu_percent": None}
+
+	def _exclusive(self):
+		# Returns the open lock file if this process is the one to reap, None otherwise
+		if self.sandbox.registry is None:
+			return open(os.devnull)
+		file = open(os.path.join(self.sandbox.registry.dir, "reaper.lock"), "a+")
+		try:
+			fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+			return file
+		except BlockingIOError:
+			file.close()
+			return None
+
+	def run_once(self) -> list[tuple[str, str]]:
+		"""
+		Returns:
+		list: The sessions closed, and why (`idle`, `max_kernels` or `memory`)
+		"""
+		file = self._exclusive()
+		if file is None:
+			return []
+		with file:
+			now = time.time()
+			kernels = sorted(self.sandbox.kernels(), key=lambda k: k["last_used"])
+			usage = {
+				k["session_id"]: {
+					"pid": k["pid"], "running": k["running"], "last_used": k["last_used"],
+					"idle_seconds": round(now - k["last_used"], 1), **self._sample(k["pid"])
+				} for k in kernels
+			}
+
+			pooled = self.sandbox.pooled_kernels()
+			pooled_mb = sum(self._sample(k["pid"])["rss_mb"] or 0 for k in pooled)
+
+			# Idle sessions first, then the least recently used ones until under the limits
+			reaped = [(k["session_id"], "idle") for k in kernels if now - k["last_used"] > self.max_idle_time and not k["running"]]
+			live = [k for k in kernels if k["session_id"] not in dict(reaped)]
+			total_mb = pooled_mb + sum(usage[k["session_id"]]["rss_mb"] or 0 for k in live)
+			for k in [k for k in live if not k["running"]]:
+				if self.max_kernels is not None and len(live) + len(pooled) > self.max_kernels:
+					reason = "max_kernels"
+				elif self.memory_budget_mb is not None and total_mb > self.memory_budget_mb:
+					reason = "memory"
+				else:
+					break
+				reaped.append((k["session_id"], reason))
+				live.remove(k)
+				total_mb -= usage[k["session_id"]]["rss_mb"] or 0
+
+			closed = []
+			for session_id, reason in reaped:
+				try:
+					if not self.sandbox.close_session(session_id, snapshot=True, if_idle=True):
+						continue  # a cell started since the sample
+					closed.append((session_id, reason))
+					usage.pop(session_id, None)
+					self._count(reason)
+					logger.info("Kernel reaper: closed the kernel of %s (%s)", session_id, reason)
+				except Exception as e:
+					self._count("failed")
+					logger.warning("Kernel reaper: failed to close the kernel of %s: %s: %s", session_id, type(e).__name__, e)
+
+			if self.snapshot_max_age is not None:
+				pruned = self.sandbox.prune_snapshots(self.snapshot_max_age)
+				with self._lock:
+					self.counters["snapshots_pruned"] += pruned
+
+			# Forgets the processes that have exited
+			self.processes = { pid: p for pid, p in self.processes.items() if p.is_running() }
+			with self._lock:
+				self.usage = usage
+				self.pooled = {"kernels": len(pooled), "rss_mb": round(pooled_mb, 1)}
+				self.counters["rounds"] += 1
+			return closed
+
+	def _count(self, key: str):
+		with self._lock:
+			self.counters[key] += 1
+
+	def stats(self) -> dict:
+		# Resource usage of each kernel at the last round, limits, and kernels closed by reason
+		with self._lock:
+			return {
+				"kernels": { k: dict(v) for k, v in self.usage.items() },
+				"pooled": dict(self.pooled),
+				"total_rss_mb": round(self.pooled["rss_mb"] + sum(v["rss_mb"] or 0 for v in self.usage.values()), 1),
+				"limits": {
+					"max_idle_time": self.max_idle_time, "max_kernels": self.max_kernels,
+					"memory_budget_mb": self.memory_budget_mb
+				},
+				"closed": dict(self.counters),
+			}
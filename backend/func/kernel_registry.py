@@ -0,0 +1,186 @@
+import fcntl, hashlib, os, socket, sqlite3, threading, time
+
+
+class SessionLock:
+	def __init__(self, path: str):
+		"""
+		Re-entrant lock of a session, shared by the threads of this process (RLock) and by the
+		other processes on the host (flock of `path`)
+		"""
+		self.path = path
+		self._rlock = threading.RLock()
+		self._depth = 0
+		self._file = None
+
+	def __enter__(self):
+		self._rlock.acquire()
+		if self._depth == 0:
+			self._file = open(self.path, "a+")
+			fcntl.flock(self._file, fcntl.LOCK_EX)
+		self._depth += 1
+		return self
+
+	def __exit__(self, *exc):
+		self._depth -= 1
+		if self._depth == 0:
+			fcntl.flock(self._file, fcntl.LOCK_UN)
+			self._file.close()
+			self._file = None
+		self._rlock.release()
+
+
+class KernelRegistry:
+	def __init__(self, path: str):
+		"""
+		Kernels of the sandbox sessions, shared by the uvicorn workers of a host: a SQLite table
+		of the connection files of the kernels by session id, and a lock file per session.
+		The cells running on each kernel (in any worker) are counted under a lease, so that a worker
+		that exits mid-cell does not keep its kernel marked as running.
+		The pooled kernels of the workers (not assigned to a session yet) are listed in another table.
+
+		Parameters:
+		path (str): Path of the SQLite database. The connection and lock files are kept next to it.
+		"""
+		self.path = path
+		self.dir = os.path.dirname(os.path.abspath(path))
+		self.hostname = socket.gethostname()
+		self.locks = {}
+		self._locks_lock = threading.Lock()
+
+		os.makedirs(self.dir, exist_ok=True)
+		with self._connect() as conn:
+			conn.execute("PRAGMA journal_mode=WAL")
+			conn.execute("""
+				CREATE TABLE IF NOT EXISTS kernels (
+					session_id TEXT PRIMARY KEY, connection_file TEXT NOT NULL, pid INTEGER,
+					hostname TEXT, owner_pid INTEGER, created_at REAL, last_used REAL,
+					running INTEGER NOT NULL DEFAULT 0, running_until REAL
+				)
+			""")
+			columns = [row["name"] for row in conn.execute("PRAGMA table_info(kernels)")]
+			if "running" not in columns:
+				# Registry created before the leases
+				conn.execute("ALTER TABLE kernels ADD COLUMN running INTEGER NOT NULL DEFAULT 0")
+				conn.execute("ALTER TABLE kernels ADD COLUMN running_until REAL")
+			conn.execute("""
+				CREATE TABLE IF NOT EXISTS pool (
+					connection_file TEXT PRIMARY KEY, pid INTEGER, hostname TEXT, owner_pid INTEGER, created_at REAL
+				)
+			""")
+
+	def _connect(self) -> sqlite3.Connection:
+		conn = sqlite3.connect(self.path, timeout=30)
+		conn.row_factory = sqlite3.Row
+		return conn
+
+	def _file_name(self, session_id: str) -> str:
+		# Session ids are client-provided, the file names are derived from a hash
+		return "kernel-" + hashlib.sha1(session_id.encode()).hexdigest()[:16]
+
+	def connection_file(self, session_id: str) -> str:
+		return os.path.join(self.dir, self._file_name(session_id) + ".json")
+
+	def lock(self, session_id: str) -> SessionLock:
+		with self._locks_lock:
+			if session_id not in self.locks:
+				self.locks[session_id] = SessionLock(os.path.join(self.dir, self._file_name(session_id) + ".lock"))
+			return self.locks[session_id]
+
+	def register(self, session_id: str, connection_file: str, pid: int = None):
+		# A kernel restarted mid-cell keeps the lease of the cell
+		now = time.time()
+		with self._connect() as conn:
+			conn.execute(
+				"""
+				INSERT INTO kernels (session_id, connection_file, pid, hostname, owner_pid, created_at, last_used)
+				VALUES (?, ?, ?, ?, ?, ?, ?)
+				ON CONFLICT (session_id) DO UPDATE SET
+					connection_file = excluded.connection_file, pid = excluded.pid, hostname = excluded.hostname,
+					owner_pid = excluded.owner_pid, created_at = excluded.created_at, last_used = excluded.last_used
+				""",
+				(session_id, connection_file, pid, self.hostname, os.getpid(), now, now)
+			)
+
+	def lookup(self, session_id: str) -> dict:
+		# The kernel of the session, if it is still alive
+		with self._connect() as conn:
+			row = conn.execute("SELECT * FROM kernels WHERE session_id = ?", (session_id,)).fetchone()
+		if row is None:
+			return None
+		entry = dict(row)
+		if not os.path.exists(entry["connection_file"]) or not self._alive(entry):
+			self.unregister(session_id)
+			return None
+		return entry
+
+	def _alive(self, entry: dict) -> bool:
+		if entry["pid"] is None or entry["hostname"] != self.hostname:
+			return True  # checked when connecting
+		try:
+			os.kill(entry["pid"], 0)
+			return True
+		except ProcessLookupError:
+			return False
+		except PermissionError:
+			return True
+
+	def touch(self, session_id: str):
+		with self._connect() as conn:
+			conn.execute("UPDATE kernels SET last_used = ? WHERE session_id = ?", (time.time(), session_id))
+
+	def acquire(self, session_id: str, seconds: float):
+		# A cell starts running on the kernel of the session, for at most `seconds`
+		with self._connect() as conn:
+			conn.execute(
+				"UPDATE kernels SET running = running + 1, running_until = MAX(COALESCE(running_until, 0), ?) WHERE session_id = ?",
+				(time.time() + seconds, session_id)
+			)
+
+	def release(self, session_id: str):
+		# The cell finished: the kernel was last used now
+		with self._connect() as conn:
+			conn.execute(
+				"""
+				UPDATE kernels SET running = MAX(running - 1, 0), last_used = ?,
+					running_until = CASE WHEN running > 1 THEN running_until END
+				WHERE session_id = ?
+				""",
+				(time.time(), session_id)
+			)
+
+	def running(self, entry: dict) -> bool:
+		# Whether a cell runs on the kernel of the entry, in any worker
+		return entry["running"] > 0 and (entry["running_until"] or 0) > time.time()
+
+	def unregister(self, session_id: str):
+		with self._connect() as conn:
+			row = conn.execute("SELECT connection_file FROM kernels WHERE session_id = ?", (session_id,)).fetchone()
+			conn.execute("DELETE FROM kernels WHERE session_id = ?", (session_id,))
+		if row is not None and os.path.exists(row["connection_file"]):
+			os.remove(row["connection_file"])
+
+	def sessions(self) -> list[dict]:
+		with self._connect() as conn:
+			return [dict(row) for row in conn.execute("SELECT * FROM kernels ORDER BY last_used")]
+
+	def register_pooled(self, connection_file: str, pid: int = None):
+		with self._connect() as conn:
+			conn.execute(
+				"INSERT OR REPLACE INTO pool VALUES (?, ?, ?, ?, ?)",
+				(connection_file, pid, self.hostname, os.getpid(), time.time())
+			)
+
+	def unregister_pooled(self, connection_file: str):
+		# The connection file is kept: the kernel is handed out to a session, or shut down by its owner
+		with self._connect() as conn:
+			conn.execute("DELETE FROM pool WHERE connection_file = ?", (connection_file,))
+
+	def pooled(self) -> list[dict]:
+		# The pooled kernels that are still alive, of all the worker processes
+		with self._connect() as conn:
+			entries = [dict(row) for row in conn.execute("SELECT * FROM pool")]
+		alive = [entry for entry in entries if os.path.exists(entry["connection_file"]) and self._alive(entry)]
+		for entry in entries:
+			if entry not in alive:
+				self.unregister_pooled(entry["connection_file"])
+		return alive
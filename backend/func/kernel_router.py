@@ -0,0 +1,133 @@
+import asyncio, logging
+from jupyter_client import AsyncKernelClient
+
+logger = logging.getLogger(__name__)
+
+
+class KernelRouter:
+	def __init__(self, connection_info: dict, km=None):
+		"""
+		Reads the IOPub and shell channels of a kernel continuously, and dispatches each message
+		to the execution it belongs to (by the `msg_id` of its parent header). Messages of other
+		executions (e.g. of another worker's client, or of a cell that timed out) are dropped.
+
+		Must be created, started and used from a single event loop.
+
+		Parameters:
+		connection_info (dict): Connection info of the kernel, or {"connection_file": path}
+		km (KernelManager): Manager of the kernel, if started by this process (checks that it is alive
+			while it starts, instead of the heartbeat)
+		"""
+		self.kc = AsyncKernelClient(parent=km) if km is not None else AsyncKernelClient()
+		if "connection_file" in connection_info:
+			self.kc.load_connection_file(connection_info["connection_file"])
+		else:
+			self.kc.load_connection_info(connection_info)
+		self.executions = {}  # msg_id -> {"messages": [...], "started": Future, "done": Future}
+		self.tasks = []
+
+	async def start(self, timeout: float = 60):
+		self.kc.start_channels()
+		# Consumes the kernel_info messages, before the readers start
+		await self.kc.wait_for_ready(timeout=timeout)
+		self.tasks = [
+			asyncio.create_task(self._read(self.kc.get_iopub_msg)),
+			asyncio.create_task(self._read(self.kc.get_shell_msg)),
+		]
+
+	async def _read(self, get_msg):
+		while True:
+			try:
+				msg = await get_msg()
+			except asyncio.CancelledError:
+				raise
+			except Exception as e:
+				logger.warning("Kernel router: failed to read a message: %s: %s", type(e).__name__, e)
+				continue
+
+			self._dispatch(msg)
+
+	def _dispatch(self, msg: dict):
+		execution = self.executions.get(msg["parent_header"].get("msg_id", None), None)
+		if execution is None:
+			return
+		execution["messages"].append(msg)
+		if execution["on_message"] is not None:
+			try:
+				execution["on_message"](msg)
+			except Exception as e:
+				logger.warning("Kernel router: on_message failed: %s: %s", type(e).__name__, e)
+		if msg["msg_type"] == "status":
+			# The kernel runs the requests of all its clients one at a time: busy once it starts this one
+			state = msg["content"]["execution_state"]
+			if state in ["busy", "idle"] and not execution["started"].done():
+				execution["started"].set_result(True)
+			if state == "idle" and not execution["done"].done():
+				execution["done"].set_result(True)
+
+	def _track(self, msg_id: str, on_message=None) -> str:
+		loop = asyncio.get_running_loop()
+		self.executions[msg_id] = {
+			"messages": [], "started": loop.create_future(), "done": loop.create_future(), "on_message": on_message
+		}
+		return msg_id
+
+	def submit(self, code: str, on_message=None) -> str:
+		"""
+		Parameters:
+		on_message (callable): Called with each message of the execution, as it arrives
+
+		Returns:
+		str: The msg_id of the execution, to `wait` for (or `wait_started`) and then `discard`
+		"""
+		return self._track(self.kc.execute(code), on_message)
+
+	async def wait_started(self, msg_id: str, timeout: float) -> bool:
+		"""
+		Returns:
+		bool: Whether the kernel started the execution within `timeout`, i.e. finished the requests queued
+			before it (e.g. by the clients of other worker processes)
+		"""
+		try:
+			await asyncio.wait_for(asyncio.shield(self.executions[msg_id]["started"]), timeout)
+			return True
+		except asyncio.TimeoutError:
+			return False
+
+	def running(self, msg_id: str) -> bool:
+		# Whether the kernel is running the execution (and not another request of its queue)
+		execution = self.executions.get(msg_id, None)
+		return execution is not None and execution["started"].done() and not execution["done"].done()
+
+	async def wait(self, msg_id: str, timeout: float) -> tuple[list[dict], bool]:
+		"""
+		Returns:
+		tuple: The IOPub and shell messages of the execution so far, and whether it completed within `timeout`
+		"""
+		execution = self.executions[msg_id]
+		try:
+			# Shielded, so that the execution can be waited for again (e.g. after an interrupt)
+			await asyncio.wait_for(asyncio.shield(execution["done"]), timeout)
+			return execution["messages"], True
+		except asyncio.TimeoutError:
+			return execution["messages"], False
+
+	def discard(self, msg_id: str):
+		self.executions.pop(msg_id, None)
+
+	async def execute(self, code: str, timeout: float = 120, on_message=None) -> tuple[list[dict], bool]:
+		msg_id = self.submit(code, on_message)
+		try:
+			return await self.wait(msg_id, timeout)
+		finally:
+			self.discard(msg_id)
+
+	def shutdown_kernel(self):
+		# Asks the kernel to shut down (for kernels started by another process)
+		self.kc.shutdown()
+
+	async def close(self):
+		for task in self.tasks:
+			task.cancel()
+		await asyncio.gather(*self.tasks, return_exceptions=True)
+		self.kc.stop_channels()
@@ -0,0 +1,36 @@
+from func.gateway import TokenBucket, LLMGateway
+import os
+from dotenv import load_dotenv
+load_dotenv()
+
+
+# All claude models: https://docs.anthropic.com/en/docs/about-claude/models
+from langchain_google_vertexai.model_garden import ChatAnthropicVertex
+# Initialise the Model
+model_config = {
+	"project": "ksm-rch-sciscigpt",
+	"location": "us-east5",
+	"temperature": 0.0,
+	# Retried by the gateway, which knows whether tokens already reached the client
+	"max_retries": 0
+}
+
+llm_dict = {
+	"claude-3.5": ChatAnthropicVertex(
+		model_name="claude-3-5-sonnet-v2@20241022", max_output_tokens=8192, **model_config
+	),
+	"claude-3.7": ChatAnthropicVertex(
+		model_name="claude-3-7-sonnet@20250219", max_output_tokens=8192 * 4, **model_config
+	),
+	"claude-4.0": ChatAnthropicVertex(
+		model_name="claude-sonnet-4@20250514", max_output_tokens=8192 * 4, **model_config
+	)
+}
+
+gateway = LLMGateway(
+	llm_dict,
+	max_concurrency=int(os.getenv("LLM_MAX_CONCURRENCY", 8)),
+	requests_per_minute=float(os.getenv("LLM_REQUESTS_PER_MINUTE", 60)),
+	# The quota is shared by all the processes calling the models: by default, the uvicorn workers
+	processes=int(os.getenv("LLM_PROCESSES") or os.getenv("WEB_CONCURRENCY") or 1),
+)
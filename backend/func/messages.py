@@ -1,23 +1,19 @@
 import uuid, re
-from langchain_core.messages import HumanMessage, AIMessage, ToolMessage, AnyMessage
+from langchain_core.messages import HumanMessage, AIMessage, ToolMessage, SystemMessage, AnyMessage
 import json
 from typing import Literal, List
 
-from langchain_core.load import dumps, loads
+from langchain_core.load import dumps, loads, load
+from collections import OrderedDict
+from copy import deepcopy
+import hashlib
+import orjson
 import os
 
 
 def convert_to_langchain_messages(data, format: Literal["events", "messages"]) -> List[AnyMessage]:
 	if format == "events":
-		messages = []
-		for event_str in loads(data):
-			output = loads(loads(event_str)["data"])
-			
-			for message in output["messages"]:
-				message.metadata = { "current": output.get("current", None), "next": output.get("next", None), "name": output.get("name", None) }
-				messages.append(message)
-
-		return messages
+		return decode_events(data)
 
 	else:
 		messages = loads(data)
@@ -28,6 +24,99 @@ def convert_to_langchain_messages(data, format: Literal["events", "messages"]) -
 			return messages
 
 
+def _decode_event_with_loads(event_str: str) -> List[AnyMessage]:
+	output = loads(loads(event_str)["data"])
+
+	messages = []
+	for message in output["messages"]:
+		message.metadata = { "current": output.get("current", None), "next": output.get("next", None), "name": output.get("name", None) }
+		messages.append(message)
+	return messages
+
+
+def _convert_events_with_loads(data) -> List[AnyMessage]:
+	# Reference implementation of the "events" format, revives every object through langchain's `loads`
+	return [message for event_str in loads(data) for message in _decode_event_with_loads(event_str)]
+
+
+_message_classes = { cls.__name__: cls for cls in [HumanMessage, AIMessage, ToolMessage, SystemMessage] }
+
+def _decode_message(obj: dict) -> AnyMessage:
+	# Build the message straight from its serialized fields; anything unusual is revived by langchain
+	kwargs = obj.get("kwargs", {})
+	cls = _message_classes.get(obj.get("id", [""])[-1]) if obj.get("type") == "constructor" else None
+	if cls is None or any(isinstance(v, dict) and "lc" in v for v in kwargs.values()):
+		return load(obj)
+	return cls(**kwargs)
+
+
+def _decode_event(event_str: str) -> List[AnyMessage]:
+	output = orjson.loads(event_str)["data"]
+	output = orjson.loads(output) if isinstance(output, (str, bytes)) else output
+
+	messages = []
+	for message in output["messages"]:
+		message = _decode_message(message)
+		message.metadata = { "current": output.get("current", None), "next": output.get("next", None), "name": output.get("name", None) }
+		messages.append(message)
+	return messages
+
+
+# Decoded events keyed by content hash. The history is resent on every turn of a session,
+# so all but the newest events are hits. Bounded by the total size of the cached events, and
+# events above `_event_cache_max_event_bytes` (e.g. with base64 images) are not cached.
+_event_cache: OrderedDict = OrderedDict()  # key -> (messages, size of the event)
+_event_cache_maxbytes = 64 * 1024 * 1024
+_event_cache_max_event_bytes = 256 * 1024
+_event_cache_bytes = 0
+
+_mutable_fields = ["content", "additional_kwargs", "response_metadata", "tool_calls", "invalid_tool_calls", "artifact", "metadata"]
+
+def _copy_message(message: AnyMessage) -> AnyMessage:
+	# Copy of a cached message that shares none of its lists / dicts (e.g. edited in place downstream)
+	fields = {**message.__dict__, **(message.__pydantic_extra__ or {})}
+	mutable = {name: fields[name] for name in _mutable_fields if isinstance(fields.get(name, None), (list, dict))}
+	try:
+		mutable = orjson.loads(orjson.dumps(mutable))
+	except TypeError:
+		mutable = deepcopy(mutable)
+	return message.model_copy(update=mutable)
+
+def _decode_event_or_load(event_str: str) -> List[AnyMessage]:
+	try:
+		return _decode_event(event_str)
+	except Exception:
+		return _decode_event_with_loads(event_str)
+
+def _clear_event_cache():
+	global _event_cache_bytes
+	_event_cache.clear()
+	_event_cache_bytes = 0
+
+def decode_events(data) -> List[AnyMessage]:
+	global _event_cache_bytes
+	messages = []
+	for event_str in orjson.loads(data):
+		size = len(event_str)
+		if size > _event_cache_max_event_bytes:
+			messages.extend(_decode_event_or_load(event_str))
+			continue
+
+		key = hashlib.blake2b(event_str.encode(), digest_size=16).digest()
+		cached = _event_cache.get(key)
+		if cached is None:
+			cached = _decode_event_or_load(event_str)
+			_event_cache[key] = (cached, size)
+			_event_cache_bytes += size
+			while _event_cache_bytes > _event_cache_maxbytes:
+				_event_cache_bytes -= _event_cache.popitem(last=False)[1][1]
+		else:
+			cached = cached[0]
+			_event_cache.move_to_end(key)
+
+		messages.extend(_copy_message(message) for message in cached)
+	return messages
+
 import json
 from langchain_core.messages import HumanMessage, AIMessage, ToolMessage
 
@@ -79,11 +168,9 @@ def display_message(message):
 
 from langchain_core.messages import HumanMessage, AIMessage, ToolMessage, SystemMessage, AnyMessage
 import json
-from copy import deepcopy
 def reformat_messages(messages: list[AnyMessage]):
 	# If the last message is an AIMessage, reformat the messages
 	# by adding the content of the last message to the second last message (ToolMessage)
-	messages = deepcopy(messages)
 	if isinstance(messages[-1], AIMessage):
 		message_0_content = messages[-1].content
 		message_0_content = [{"type": "text", "text": message_0_content}] if isinstance(message_0_content, str) else message_0_content
@@ -92,12 +179,10 @@ def reformat_messages(messages: list[AnyMessage]):
 		content = message_1_content + message_0_content
 		content = [{"type": "text", "text": i['text']} for i in content]
 		
-		temp_message = deepcopy(messages[-2])
-		temp_message.content = content
-		messages[-2] = temp_message
-		return messages[:-1]
+		temp_message = messages[-2].model_copy(update={"content": content})
+		return [*messages[:-2], temp_message]
 	else:
-		return messages
+		return list(messages)
 
 
 def to_human_message(message: AnyMessage):
@@ -119,24 +204,25 @@ def system_to_human(messages: list[AnyMessage]):
 	
 
 from langchain_core.messages import HumanMessage, AIMessage, AnyMessage
-from copy import deepcopy
 import re
 def remove_inner_monologue(messages: list[AnyMessage], monologue_tags: list[str]):
-	messages = deepcopy(messages)
-	
-	for tag in monologue_tags:
-		pattern = re.compile(fr'<{tag}>(.*?)</{tag}>', re.DOTALL)
-		for message in messages:
-			if isinstance(message, AIMessage):
-				message.content = pattern.sub("", message.text()).strip()
+	# Copy-on-write: only the AIMessages are (shallowly) copied, the others are shared with the input
+	patterns = [re.compile(fr'<{tag}>(.*?)</{tag}>', re.DOTALL) for tag in monologue_tags]
 
-	return messages
+	messages_2 = []
+	for message in messages:
+		if isinstance(message, AIMessage) and patterns:
+			content = message.text()
+			for pattern in patterns:
+				content = pattern.sub("", content).strip()
+			message = message.model_copy(update={"content": content})
+		messages_2.append(message)
 
+	return messages_2
 
 
-def remove_bad_tool_call_responses(messages: list[AnyMessage]):
-	messages = deepcopy(messages)
 
+def remove_bad_tool_call_responses(messages: list[AnyMessage]):
 	all_tool_calls = []
 	all_tool_responses = []
 
@@ -153,6 +239,7 @@ def remove_bad_tool_call_responses(messages: list[AnyMessage]):
 	# remove tool calls that are not in the response and all responses that are not in the tool call
 	to_be_removed = (all_tool_call_ids - all_tool_response_ids) | (all_tool_response_ids - all_tool_call_ids)
 
+	# Copy-on-write: only AIMessages that lose a tool call are (shallowly) copied
 	messages_2 = []
 	for message in messages:
 		if isinstance(message, ToolMessage):
@@ -160,11 +247,54 @@ def remove_bad_tool_call_responses(messages: list[AnyMessage]):
 				messages_2.append(message)
 
 		elif isinstance(message, AIMessage):
-			if message.tool_calls:
-				message.tool_calls = [call for call in message.tool_calls if call["id"] not in to_be_removed]
+			if message.tool_calls and any(call["id"] in to_be_removed for call in message.tool_calls):
+				tool_calls = [call for call in message.tool_calls if call["id"] not in to_be_removed]
+				message = message.model_copy(update={"tool_calls": tool_calls})
 			messages_2.append(message)
 
 		else:
 			messages_2.append(message)
 
-	return messages_2
\ No newline at end of file
+	return messages_2
+
+
+if __name__ == "__main__":
+	# Benchmark of the "events" decoders: python -m func.messages
+	import time
+
+	def synthetic_events(n: int) -> str:
+		events = []
+		for i in range(n):
+			if i % 3 == 0:
+				message = AIMessage(content=f"<thinking>Step {i}</thinking> Querying the database.", tool_calls=[
+					{"name": "sql_query", "args": {"query": f"SELECT * FROM papers LIMIT {i}"}, "id": f"call_{i}"}])
+				name = "call_specialist"
+			elif i % 3 == 1:
+				table = "\n".join(f"| {j} | paper_{j} | {j * 0.5} |" for j in range(10))
+				message = ToolMessage(content=[{"type": "text", "text": json.dumps({"response": table})}], tool_call_id=f"call_{i - 1}")
+				name = "call_toolset"
+			else:
+				message = AIMessage(content="<reflection>The query returned the expected rows.</reflection><reward>0.9</reward>")
+				name = "call_evaluation"
+			state = { "messages": [message], "current": "database_specialist", "next": "node_toolset", "name": name }
+			events.append(json.dumps({ "event": "on_custom_event", "name": name, "data": dumps(state) }))
+		return json.dumps(events)
+
+	def timeit(func, data, repeat=3):
+		best = float("inf")
+		for _ in range(repeat):
+			start = time.perf_counter()
+			func(data)
+			best = min(best, time.perf_counter() - start)
+		return best
+
+	for n in [1000, 10000]:
+		data = synthetic_events(n)
+		expected = [(type(m), m.dict()) for m in _convert_events_with_loads(data)]
+		for _ in range(2):  # decoded, then from the cache
+			assert [(type(m), m.dict()) for m in decode_events(data)] == expected
+
+		baseline = timeit(_convert_events_with_loads, data)
+		cold = timeit(lambda d: (_clear_event_cache(), decode_events(d)), data)
+		warm = timeit(decode_events, data)
+		print(f"{n:>6} events | loads: {baseline * 1000:8.1f} ms | fast (cold): {cold * 1000:8.1f} ms ({baseline / cold:4.1f}x) | fast (cached): {warm * 1000:8.1f} ms ({baseline / warm:4.1f}x)")
@@ -0,0 +1,133 @@
+import asyncio, logging, threading, time
+from typing import Optional
+from func.executors import tool_executors
+
+logger = logging.getLogger(__name__)
+
+
+class Prefetcher:
+	def __init__(self):
+		"""
+		Speculative warmups (e.g. schema reflection, kernel startup) started in the background when
+		a task is assigned to a specialist, while its LLM is still thinking.
+
+		A warmup is a tuple (key, tool_class, func): `func` runs on the `tool_class` pool of the tool
+		executors, and the tool that later uses the warmed resource calls `consume(key)`. A key
+		requested by several sessions (e.g. the schema of a table) is warmed once, and cancelled
+		once none of them still needs it.
+		"""
+		self.warmups = {}  # specialist name -> [func(task, state) -> list of warmups]
+		self.tasks = {}  # key -> asyncio.Task
+		self.sessions = {}  # key -> ids of the sessions that requested it
+		self.finished = {}  # key -> threading.Event, set once its warmup ends
+		self.prefetched = {}  # key -> "running" / "done", until consumed or cancelled
+		self.counters = {
+			"started": 0, "completed": 0, "failed": 0, "cancelled": 0,
+			"hits": 0, "partial_hits": 0, "wasted": 0, "seconds": 0.0
+		}
+		self._lock = threading.Lock()
+
+	def register(self, specialist: str, warmups):
+		self.warmups.setdefault(specialist, []).append(warmups)
+
+	def _count(self, **deltas):
+		with self._lock:
+			for k, v in deltas.items():
+				self.counters[k] += v
+
+	def prefetch(self, specialist: str, task: str, state: dict):
+		# Called from the event loop when `task` is assigned to `specialist`
+		session_id = state["metadata"].get("session_id", None)
+
+		for warmups in self.warmups.get(specialist, []):
+			try:
+				warmups = warmups(task, state)
+			except Exception as e:
+				logger.warning("Prefetch of %s failed: %s: %s", specialist, type(e).__name__, e)
+				continue
+
+			for key, tool_class, func in warmups:
+				with self._lock:
+					if key in self.prefetched:
+						self.sessions[key].add(session_id)
+						continue
+					self.prefetched[key] = "running"
+					self.sessions[key] = {session_id}
+					self.finished[key] = threading.Event()
+					self.counters["started"] += 1
+					self.tasks[key] = asyncio.create_task(self._run(key, tool_class, func, self.finished[key]))
+
+	async def _run(self, key, tool_class: str, func, finished: threading.Event):
+		started = time.monotonic()
+		try:
+			await tool_executors.run(tool_class, func)
+			with self._lock:
+				if self.tasks.get(key, None) is asyncio.current_task():
+					self.prefetched[key] = "done"
+			self._count(completed=1, seconds=time.monotonic() - started)
+		except Exception as e:
+			with self._lock:
+				if self.tasks.get(key, None) is asyncio.current_task():
+					self._forget(key)
+			self._count(failed=1)
+			logger.warning("Prefetch of %s failed: %s: %s", key, type(e).__name__, e)
+		finally:
+			finished.set()
+
+	def _forget(self, key) -> Optional[str]:
+		# Under the lock
+		self.tasks.pop(key, None)
+		self.sessions.pop(key, None)
+		self.finished.pop(key, None)
+		return self.prefetched.pop(key, None)
+
+	def consume(self, key, timeout: float = 0) -> bool:
+		"""
+		Called (from any thread) by the tool that uses the resource of `key`
+
+		Parameters:
+		key: Key of the warmup
+		timeout (float): Number of seconds to wait for the warmup, if still running (e.g. rather than
+			doing the same work twice)
+
+		Returns:
+		bool: Whether it was prefetched
+		"""
+		with self._lock:
+			finished = self.finished.get(key, None)
+			status = self._forget(key)
+			if status is None:
+				return False
+			self.counters["hits" if status == "done" else "partial_hits"] += 1
+		if status == "running" and timeout > 0:
+			finished.wait(timeout)
+		return True
+
+	def cancel(self, session_id: str):
+		# Cancels the warmups of the session that have not completed, unless another session still needs them.
+		# Warmed resources that were never used by the sessions' tools count as wasted.
+		# A warmup already running in a worker thread runs to completion, only its result is dropped.
+		with self._lock:
+			for key in [key for key, sessions in self.sessions.items() if session_id in sessions]:
+				self.sessions[key].discard(session_id)
+				if self.sessions[key]:
+					continue
+				task = self.tasks.get(key, None)
+				status = self._forget(key)
+				if status == "running" and task is not None and not task.done():
+					task.cancel()
+					self.counters["cancelled"] += 1
+				elif status == "done":
+					self.counters["wasted"] += 1
+
+	def stats(self) -> dict:
+		with self._lock:
+			used = self.counters["hits"] + self.counters["partial_hits"]
+			return {
+				**self.counters,
+				"pending": len(self.prefetched),
+				"hit_rate": used / self.counters["started"] if self.counters["started"] else None,
+			}
+
+
+prefetcher = Prefetcher()
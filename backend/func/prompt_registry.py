@@ -0,0 +1,181 @@
+"""
+Prompts pinned to LangChain Hub commits, resolved from a local on-disk bundle instead of the hub
+
+	python -m func.prompt_registry sync         # refresh every prompt of the bundle from the hub
+	python -m func.prompt_registry sync REF...  # add / refresh specific prompts, e.g. owner/name:commit
+	python -m func.prompt_registry list
+	python -m func.prompt_registry check        # fails if a prompt of the bundle has no file
+
+The bundle is a directory of one JSON file per prompt commit, and a `manifest.json` mapping each
+reference (with or without a commit hash) to its file.
+"""
+import fcntl, json, logging, os, tempfile, threading
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from langchain_core.load import dumpd, load
+from dotenv import load_dotenv
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUNDLE_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "prompts")
+
+
+def _split_ref(ref: str) -> tuple[str, str]:
+	# "owner/name:commit" -> ("owner/name", "commit"), the commit is optional
+	name, _, commit = ref.partition(":")
+	return name, commit or None
+
+
+def _dump(path: str, obj: dict, **kwargs):
+	# Written to a temporary file of the same directory, then renamed: readers never see a partial file
+	fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-", suffix=".json")
+	try:
+		with os.fdopen(fd, "w") as f:
+			json.dump(obj, f, indent=1, **kwargs)
+		os.replace(tmp_path, path)
+	except BaseException:
+		os.unlink(tmp_path)
+		raise
+
+
+class PromptRegistry:
+	def __init__(self, bundle_dir: str = DEFAULT_BUNDLE_DIR, hub_fallback: bool = True):
+		"""
+		Parameters:
+		bundle_dir (str): Directory of the prompt bundle
+		hub_fallback (bool): Pull (and add to the bundle) the prompts missing from the bundle, instead of raising
+		"""
+		self.bundle_dir = bundle_dir
+		self.hub_fallback = hub_fallback
+		self.prompts = {}
+		self._lock = threading.Lock()
+
+	@property
+	def manifest_path(self) -> str:
+		return os.path.join(self.bundle_dir, "manifest.json")
+
+	def manifest(self) -> dict:
+		if not os.path.exists(self.manifest_path):
+			return {"prompts": {}}
+		with open(self.manifest_path) as f:
+			return json.load(f)
+
+	@contextmanager
+	def _manifest_lock(self):
+		# Serializes the updates of the manifest across the worker processes
+		os.makedirs(self.bundle_dir, exist_ok=True)
+		with open(os.path.join(self.bundle_dir, ".manifest.lock"), "a") as lock_file:
+			fcntl.flock(lock_file, fcntl.LOCK_EX)
+			try:
+				yield
+			finally:
+				fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+	def missing(self) -> list[str]:
+		# The references of the manifest without a prompt file in the bundle
+		return [
+			ref for ref, entry in self.manifest()["prompts"].items()
+			if not entry.get("file", None) or not os.path.exists(os.path.join(self.bundle_dir, entry["file"]))
+		]
+
+	def check(self):
+		# Raises if a prompt of the bundle has no file and can't be pulled from the hub, warns if it will be
+		missing = self.missing()
+		if missing and not self.hub_fallback:
+			raise RuntimeError(
+				f"Prompts missing from the bundle {self.bundle_dir}: {', '.join(missing)}, "
+				f"run `python -m func.prompt_registry sync`"
+			)
+		if missing:
+			logger.warning(
+				"Prompts missing from the bundle %s, pulled from the hub on first use: %s "
+				"(run `python -m func.prompt_registry sync` to pin them)", self.bundle_dir, ", ".join(missing))
+
+	def _read(self, ref: str):
+		entry = self.manifest()["prompts"].get(ref, None)
+		if not entry or not entry.get("file", None):
+			return None
+		with open(os.path.join(self.bundle_dir, entry["file"])) as f:
+			return load(json.load(f)["prompt"])
+
+	def _write(self, ref: str, prompt) -> dict:
+		# Stored under its commit, so that an unpinned reference is pinned to the commit it was synced at
+		name, commit = _split_ref(ref)
+		commit = commit or (getattr(prompt, "metadata", None) or {}).get("lc_hub_commit_hash", None) or "latest"
+		file = f"{name.replace('/', '__')}@{commit[:8]}.json"
+		synced_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+		with self._manifest_lock():
+			_dump(os.path.join(self.bundle_dir, file), {"ref": ref, "commit": commit, "synced_at": synced_at, "prompt": dumpd(prompt)})
+			manifest = self.manifest()
+			manifest["prompts"][ref] = {"file": file, "commit": commit, "synced_at": synced_at}
+			_dump(self.manifest_path, manifest, sort_keys=True)
+		return manifest["prompts"][ref]
+
+	def _pull(self, ref: str):
+		from langchain.hub import pull
+		return pull(ref)
+
+	def get(self, ref: str):
+		# Loaded on first use, from the bundle (or the hub, only if missing from the bundle and allowed)
+		with self._lock:
+			if ref not in self.prompts:
+				prompt = self._read(ref)
+				if prompt is None:
+					if not self.hub_fallback:
+						raise KeyError(f"Prompt {ref} is not in the bundle {self.bundle_dir}, run `python -m func.prompt_registry sync {ref}`")
+					prompt = self._pull(ref)
+					self._write(ref, prompt)
+				self.prompts[ref] = prompt
+			return self.prompts[ref]
+
+	def lazy(self, ref: str) -> "LazyPrompt":
+		return LazyPrompt(self, ref)
+
+	def sync(self, refs: list[str] = None) -> dict:
+		# Pulls `refs` (by default every prompt of the bundle) from the hub into the bundle
+		refs = refs or list(self.manifest()["prompts"].keys())
+		synced = {}
+		for ref in refs:
+			synced[ref] = self._write(ref, self._pull(ref))
+			self.prompts.pop(ref, None)
+		return synced
+
+
+class LazyPrompt:
+	"""Stands in for the prompt of `ref` (e.g. `prompt.invoke(...)`), which is loaded on first use"""
+	def __init__(self, registry: PromptRegistry, ref: str):
+		self.registry = registry
+		self.ref = ref
+
+	def __getattr__(self, name: str):
+		return getattr(self.registry.get(self.ref), name)
+
+	def __repr__(self) -> str:
+		return f"LazyPrompt({self.ref!r})"
+
+
+prompt_registry = PromptRegistry(
+	bundle_dir=os.getenv("PROMPT_BUNDLE_DIR", DEFAULT_BUNDLE_DIR),
+	hub_fallback=os.getenv("PROMPT_HUB_FALLBACK", "true").lower() == "true",
+)
+
+
+if __name__ == "__main__":
+	import argparse
+	parser = argparse.ArgumentParser(description="Manage the local prompt bundle")
+	parser.add_argument("command", choices=["sync", "list", "check"])
+	parser.add_argument("refs", nargs="*", help="Prompt references, e.g. owner/name:commit (default: the whole bundle)")
+	args = parser.parse_args()
+
+	if args.command == "sync":
+		for ref, entry in prompt_registry.sync(args.refs).items():
+			print(f"{ref} -> {entry['file']}")
+	elif args.command == "list":
+		for ref, entry in prompt_registry.manifest()["prompts"].items():
+			print(f"{ref} -> {entry.get('file', None)} ({entry.get('synced_at', None)})")
+	else:
+		prompt_registry.hub_fallback = False
+		prompt_registry.check()
+		print(f"All {len(prompt_registry.manifest()['prompts'])} prompts are in the bundle")
@@ -0,0 +1,80 @@
+import asyncio, logging, threading, time
+from func.executors import tool_executors
+
+logger = logging.getLogger(__name__)
+
+
+class LazyResource:
+	def __init__(self, name: str, factory, tool_class: str):
+		"""
+		Handle of a slow-to-build dependency of the tools (database engine, vector store client,
+		Jupyter sandbox), built on first use or by the background warmup, whichever comes first
+
+		Parameters:
+		name (str): Name of the dependency, as reported by `/ready`
+		factory (callable): Builds the dependency
+		tool_class (str): Pool of the tool executors the warmup runs on
+		"""
+		self.name = name
+		self.factory = factory
+		self.tool_class = tool_class
+		self.status = "pending"  # pending / loading / ready / failed
+		self.seconds = None
+		self.error = None
+		self._value = None
+		self._lock = threading.Lock()
+
+	def get(self):
+		# A failed build is retried by the next call
+		if self.status == "ready":
+			return self._value
+		with self._lock:
+			if self.status != "ready":
+				self.status = "loading"
+				started = time.monotonic()
+				try:
+					self._value = self.factory()
+					self.status, self.error = "ready", None
+				except Exception as e:
+					self.status, self.error = "failed", "{}: {}".format(type(e).__name__, str(e))
+					raise
+				finally:
+					self.seconds = round(time.monotonic() - started, 3)
+			return self._value
+
+	def stats(self) -> dict:
+		return { "status": self.status, "seconds": self.seconds, "error": self.error }
+
+
+class ResourceRegistry:
+	def __init__(self):
+		self.resources = {}
+		self.warmup_seconds = None
+
+	def register(self, name: str, factory, tool_class: str) -> LazyResource:
+		resource = self.resources[name] = LazyResource(name, factory, tool_class)
+		return resource
+
+	async def warmup(self):
+		# Builds all dependencies in parallel, each on the pool of its tool class
+		started = time.monotonic()
+
+		async def build(resource):
+			try:
+				await tool_executors.run(resource.tool_class, resource.get)
+			except Exception as e:
+				logger.warning("Warmup of %s failed: %s: %s", resource.name, type(e).__name__, e)
+
+		await asyncio.gather(*[build(resource) for resource in self.resources.values()])
+		self.warmup_seconds = round(time.monotonic() - started, 3)
+
+	def stats(self) -> dict:
+		resources = { name: resource.stats() for name, resource in self.resources.items() }
+		return {
+			"ready": all(r["status"] == "ready" for r in resources.values()),
+			"warmup_seconds": self.warmup_seconds,
+			"resources": resources,
+		}
+
+
+resources = ResourceRegistry()
@@ -0,0 +1,74 @@
+import asyncio, json, logging, threading
+from langchain_core.callbacks.manager import adispatch_custom_event
+
+logger = logging.getLogger(__name__)
+
+
+class ToolOutputStream:
+	def __init__(self, tool: str, interval: float = 0.25, max_buffer: int = 16384):
+		"""
+		Partial output of a running tool (e.g. the stdout of a Jupyter cell, the progress of a SQL
+		query), sent to the client as `tool_output` custom events of the tool's run, while it runs.
+		The events are transient: the complete response still comes with the tool's messages.
+
+		`write` and `progress` may be called from any thread. The output is coalesced into at most
+		one event per `interval`, and a flush waits for the previous event to be sent. Output that
+		piles up faster than it is sent is dropped beyond `max_buffer` characters (oldest first),
+		so that the tool itself is never slowed down.
+
+		Parameters:
+		tool (str): Name of the tool
+		interval (float): Minimum number of seconds between two events
+		max_buffer (int): Maximum number of characters of output waiting to be sent
+		"""
+		self.tool = tool
+		self.interval = interval
+		self.max_buffer = max_buffer
+		self.buffer = ""
+		self.skipped = 0
+		self.latest_progress = None
+		self.enabled = True
+		self._lock = threading.Lock()
+		self._task = None
+
+	def write(self, text: str):
+		with self._lock:
+			self.buffer += text
+			if len(self.buffer) > self.max_buffer:
+				self.skipped += len(self.buffer) - self.max_buffer
+				self.buffer = self.buffer[-self.max_buffer:]
+
+	def progress(self, text: str):
+		# Latest status of the tool, e.g. the number of rows fetched (replaces the previous one)
+		with self._lock:
+			self.latest_progress = text
+
+	async def _flush(self, done: bool = False):
+		with self._lock:
+			output, skipped, progress = self.buffer, self.skipped, self.latest_progress
+			self.buffer, self.skipped, self.latest_progress = "", 0, None
+		if not self.enabled or not (output or progress or done):
+			return
+		if skipped:
+			output = f"[... {skipped} characters skipped ...]\n" + output
+		try:
+			await adispatch_custom_event(
+				"tool_output", json.dumps({ "tool": self.tool, "output": output, "progress": progress, "done": done }))
+		except Exception as e:
+			# Outside of a run (e.g. a tool invoked directly): nothing to stream to
+			logger.warning("Streaming of %s output disabled: %s: %s", self.tool, type(e).__name__, e)
+			self.enabled = False
+
+	async def _flush_periodically(self):
+		while True:
+			await asyncio.sleep(self.interval)
+			await self._flush()
+
+	async def __aenter__(self):
+		self._task = asyncio.create_task(self._flush_periodically())
+		return self
+
+	async def __aexit__(self, *exc):
+		self._task.cancel()
+		await asyncio.gather(self._task, return_exceptions=True)
+		await self._flush(done=True)
@@ -0,0 +1,132 @@
+import json, sys, types, uuid
+from typing import Any, Optional, Type
+
+from pydantic import BaseModel, Field
+from typing_extensions import Annotated
+from langchain_core.tools import BaseTool
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.outputs import ChatGeneration, ChatResult
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AnyMessage, HumanMessage, SystemMessage, ToolMessage
+from langgraph.prebuilt import InjectedState
+
+# Offline stand-ins for the Claude models, the hub prompts and the external tools (BigQuery,
+# Pinecone, Jupyter, Cloud Storage), e.g. to run the batch runner without network access.
+
+
+def _text(message: AnyMessage) -> str:
+	content = message.content
+	return content if isinstance(content, str) else "".join(item.get("text", "") for item in content if item.get("type", None) == "text")
+
+
+class StubChatModel(BaseChatModel):
+	"""
+	Deterministic chat model: the research manager delegates the question to one specialist and
+	answers once it has reported back, a specialist calls its first tool once and then reports,
+	an evaluator always accepts.
+	"""
+	specialist: str = "database_specialist"
+
+	@property
+	def _llm_type(self) -> str:
+		return "stub"
+
+	def bind_tools(self, tools: list, **kwargs):
+		return self.bind(tool_names=[tool.name for tool in tools])
+
+	def _generate(self, messages: list[AnyMessage], stop=None, run_manager=None, tool_names: list[str] = None, **kwargs) -> ChatResult:
+		tool_names = tool_names or []
+		tool_call_ids = [m.tool_call_id for m in messages if isinstance(m, ToolMessage)]
+		question = next((_text(m) for m in messages if isinstance(m, HumanMessage) and _text(m).strip()), "")
+
+		tool_calls = []
+		if self.specialist in tool_names:
+			# Research manager
+			if any(i.startswith("stub-task") for i in tool_call_ids):
+				content = f"[stub] Final answer to: {question}"
+			else:
+				content = "[stub] Delegating the question."
+				tool_calls = [{"name": self.specialist, "args": {"task": question, "memory": False}, "id": f"stub-task-{uuid.uuid4()}"}]
+		elif "evaluation_specialist" in tool_names:
+			# Specialist
+			if any(i.startswith("stub-tool") for i in tool_call_ids):
+				content = "[stub] The task is complete."
+			else:
+				content = "[stub] Calling a tool."
+				tool_name = next(name for name in tool_names if name != "evaluation_specialist")
+				tool_calls = [{"name": tool_name, "args": {"query": ""}, "id": f"stub-tool-{uuid.uuid4()}"}]
+		elif tool_names:
+			# Evaluator (bound to the specialist's tools)
+			content = "<reflection>[stub] The result is as expected.</reflection>\n<reward>1.0</reward>\n<thinking>[stub]</thinking>"
+		else:
+			content = "[stub]"
+
+		message = AIMessage(content=content, tool_calls=tool_calls)
+		return ChatResult(generations=[ChatGeneration(message=message)])
+
+
+def stub_llm_dict(model_names: list[str] = ["claude-3.5", "claude-3.7", "claude-4.0"]) -> dict:
+	return { model_name: StubChatModel() for model_name in model_names }
+
+
+class StubToolInput(BaseModel):
+	query: str = Field("", description="Input of the tool")
+	state: Annotated[dict, InjectedState] = Field(None, description="Agent state")
+
+class StubTool(BaseTool):
+	name: str
+	description: str = "Offline stub of a SciSciGPT tool"
+	args_schema: Type[BaseModel] = StubToolInput
+
+	def _run(self, query: str = "", state: dict = None) -> dict:
+		return {"response": f"[stub {self.name}] {query}".strip()}
+
+	def warmups(self, task: str, state: dict = None) -> list:
+		return []
+
+
+def stub_tools_module() -> types.ModuleType:
+	# Mirrors the names exported by the `tools` package
+	module = types.ModuleType("tools")
+	for attr, name in [
+		("sql_list_table_tool", "sql_list_table"), ("sql_get_schema_tool", "sql_get_schema"), ("sql_query_tool", "sql_query"),
+		("search_name_tool", "search_name"),
+		("python_jupyter_tool", "python"), ("r_jupyter_tool", "r"), ("julia_jupyter_tool", "julia"),
+		("search_literature_advanced_tool", "search_literature"),
+	]:
+		setattr(module, attr, StubTool(name=name))
+	module.kernel_warmups = lambda task, state=None: []
+	module.tools = module.enabled_tools = [
+		module.sql_list_table_tool, module.sql_get_schema_tool, module.sql_query_tool, module.search_name_tool,
+		module.python_jupyter_tool, module.r_jupyter_tool, module.julia_jupyter_tool, module.search_literature_advanced_tool
+	]
+	return module
+
+
+def stub_prompts_module() -> types.ModuleType:
+	# Mirrors the prompts exported by `agents.prompts`
+	prompt = lambda name: ChatPromptTemplate.from_messages([("system", f"[stub] {name} prompt")])
+	module = types.ModuleType("agents.prompts")
+	module.research_manager_prompt = prompt("research_manager")
+	module.specialist_prompt_dict = {
+		name: prompt(name) for name in ["database_specialist", "analytics_specialist", "literature_specialist"]
+	}
+	module.tool_eval_prompt = prompt("tool_eval")
+	module.visual_eval_prompt = prompt("visual_eval")
+	module.task_eval_prompt = prompt("task_eval")
+	return module
+
+
+def stub_gcp_module() -> types.ModuleType:
+	# Mirrors `func.gcp`, without the Google Cloud client: nothing is uploaded
+	module = types.ModuleType("func.gcp")
+	module.upload_file_to_gcp = lambda local_path, gcp_path=None, gcs_bucket_name=None: f"stub://{gcp_path or local_path}"
+	return module
+
+
+def install_offline_stubs():
+	# Must run before `agents.sciscigpt` is imported
+	assert "agents.sciscigpt" not in sys.modules, "install_offline_stubs() must be called before importing agents.sciscigpt"
+	sys.modules["tools"] = stub_tools_module()
+	sys.modules["agents.prompts"] = stub_prompts_module()
+	sys.modules["func.gcp"] = stub_gcp_module()
@@ -1,4 +1,5 @@
 #!/bin/bash
 
-# uvicorn app:app --host 0.0.0.0 --port 8080 --workers 4
-uvicorn app:app --host 0.0.0.0 --port 8080 --reload
\ No newline at end of file
+# The workers share the sandbox kernels (KERNEL_REGISTRY_PATH) and, with CHECKPOINT_DB_PATH, the checkpoints
+# uvicorn app:app --host 0.0.0.0 --port 8080 --workers 4  # with LLM_PROCESSES=4
+uvicorn app:app --host 0.0.0.0 --port 8080 --reload
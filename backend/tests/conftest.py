@@ -0,0 +1,8 @@
+import os, sys
+
+# The tests import the backend modules (func, agents, tools) as the app does, from the backend directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# and run offline: stub models, hub prompts and tools (BigQuery, Pinecone, Cloud Storage)
+from func.stubs import install_offline_stubs
+install_offline_stubs()
@@ -0,0 +1,54 @@
+"""
+The R / Julia bridges of a session, loaded by its first cell of that language (requires ipykernel)
+"""
+import asyncio
+import pytest
+
+pytest.importorskip("ipykernel")
+
+from func import jupyter
+from func.jupyter import JupyterSandbox
+
+# Counts its loads in the kernel, in place of the rpy2 extension (not needed by the test)
+COUNTING_BRIDGE = "_bridge_loads = globals().get('_bridge_loads', 0) + 1"
+
+
+def text(outputs: list) -> str:
+	return "".join(o["text"] for o in outputs if o["type"] == "text")
+
+
+@pytest.fixture
+def sandbox(tmp_path, monkeypatch):
+	monkeypatch.setitem(jupyter.BRIDGES, "r", COUNTING_BRIDGE)
+	sandbox = JupyterSandbox(str(tmp_path))
+	yield sandbox
+	sandbox.close_all_sessions()
+
+
+def test_bridge_is_loaded_once(sandbox):
+	# Not by the kernel setup
+	assert text(sandbox.execute_code("print('_bridge_loads' in dir())", "session", "cell-1")) == "False\n"
+
+	async def cells():
+		return await asyncio.gather(*[
+			sandbox.aexecute_code("print(_bridge_loads)", "session", f"cell-{i}", bridge="r") for i in range(4)])
+	assert [text(outputs) for outputs in asyncio.run(cells())] == ["1\n"] * 4
+	assert text(sandbox.execute_code("print(_bridge_loads)", "session", "cell-5", bridge="r")) == "1\n"
+	assert sandbox.sessions["session"]["bridges"] == {"r"}
+
+
+def test_bridges_are_per_session(sandbox):
+	sandbox.execute_code("pass", "session-1", "cell", bridge="r")
+	assert text(sandbox.execute_code("print('_bridge_loads' in dir())", "session-2", "cell")) == "False\n"
+	assert text(sandbox.execute_code("print(_bridge_loads)", "session-2", "cell", bridge="r")) == "1\n"
+
+
+def test_failed_bridge_is_retried(sandbox, monkeypatch):
+	monkeypatch.setitem(jupyter.BRIDGES, "julia", "raise ImportError('No module named juliacall')")
+	outputs = sandbox.execute_code("print('not run')", "session", "cell-1", bridge="julia")
+	assert "ImportError: No module named juliacall" in text(outputs) and "not run" not in text(outputs)
+	assert "julia" not in sandbox.sessions["session"]["bridges"]
+
+	monkeypatch.setitem(jupyter.BRIDGES, "julia", "jl = 'loaded'")
+	assert text(sandbox.execute_code("print(jl)", "session", "cell-2", bridge="julia")) == "loaded\n"
+
@@ -0,0 +1,118 @@
+import asyncio, json
+from functools import partial
+from langchain_core.messages import AIMessage, ToolMessage
+from langchain_core.runnables import RunnableLambda
+
+from func.gateway import LLMGateway
+from func.stubs import stub_llm_dict
+from agents.context import build_node_context
+from agents.evaluation import call_evaluation
+from agents.utils.evaluation_policy import EvaluationPolicy, check_tool_message
+from agents.utils.messages import _index_messages
+
+
+def tool_message(tool_name: str, response: str, **results) -> ToolMessage:
+	# As built by call_toolset
+	message = ToolMessage(content=[{"type": "text", "text": json.dumps({"response": response, **results})}], tool_call_id=f"call-{tool_name}")
+	message.metadata = {"current": tool_name, "name": "call_toolset"}
+	return message
+
+
+PYTHON_ERROR = "Traceback (most recent call last):\n  File \"<cell>\", line 1\nZeroDivisionError: division by zero"
+TIMEOUT = "\nExecution timeout after 120 seconds: the cell was interrupted. The variables of the session are kept."
+
+
+def test_verdicts():
+	assert check_tool_message(tool_message("python", PYTHON_ERROR))["verdict"] == "error"
+	assert check_tool_message(tool_message("r", "Error in library(foo): there is no package called 'foo'"))["verdict"] == "error"
+	assert check_tool_message(tool_message("sql_query", "BadRequest: 400 Unrecognized name: foo"))["verdict"] == "error"
+	# An invalid tool call: the toolset answered
+	assert check_tool_message(tool_message("toolset", "AssertionError: Invalid tool: foo"))["verdict"] == "error"
+
+	assert check_tool_message(tool_message("python", "partial output" + TIMEOUT))["verdict"] == "timeout"
+	assert check_tool_message(tool_message("sql_query", "FunctionTimedOut: Function read_sql timed out"))["verdict"] == "timeout"
+
+	assert check_tool_message(tool_message("sql_query", "Empty DataFrame\nColumns: [a, b]\nIndex: []"))["verdict"] == "empty"
+	assert check_tool_message(tool_message("search_literature", ""))["verdict"] == "empty"
+	# A cell without output has run without error
+	assert check_tool_message(tool_message("python", ""))["verdict"] == "ok"
+	assert check_tool_message(tool_message("python", "", images=["image.png"]))["verdict"] == "ok"
+	assert check_tool_message(tool_message("sql_query", "   a  b\n0  1  2"))["verdict"] == "ok"
+
+
+def test_adaptive_skips_conclusive_checks():
+	policy = EvaluationPolicy(mode="adaptive")
+	for response in [PYTHON_ERROR, "output" + TIMEOUT]:
+		evaluate, checks = policy.decide("tool_eval", [tool_message("python", response)])
+		assert not evaluate
+	evaluate, checks = policy.decide("tool_eval", [tool_message("sql_query", "Empty DataFrame\nColumns: [a]\nIndex: []")])
+	assert not evaluate and checks[0]["verdict"] == "empty"
+
+	# Lookups are not evaluated by the LLM, queries and cells are
+	assert not policy.decide("tool_eval", [tool_message("sql_get_schema", "CREATE TABLE papers (...)")])[0]
+	assert policy.decide("tool_eval", [tool_message("sql_query", "   a\n0  1")])[0]
+	assert policy.decide("tool_eval", [tool_message("python", "42")])[0]
+	# One successful response of an evaluated tool is enough
+	assert policy.decide("tool_eval", [tool_message("python", PYTHON_ERROR), tool_message("sql_query", "   a\n0  1")])[0]
+
+
+def test_visual_eval_captions_figures():
+	policy = EvaluationPolicy(mode="adaptive")
+	assert policy.decide("visual_eval", [tool_message("sql_get_schema", "ok"), tool_message("python", "", images=["plot.png"])])[0]
+	# Unless every response failed
+	assert not policy.decide("visual_eval", [tool_message("python", PYTHON_ERROR)])[0]
+
+
+def test_modes():
+	messages = [tool_message("python", PYTHON_ERROR)]
+	assert EvaluationPolicy(mode="always").decide("tool_eval", messages)[0]
+	assert not EvaluationPolicy(mode="never").decide("tool_eval", [tool_message("python", "42")])[0]
+	# Nothing to check
+	assert EvaluationPolicy(mode="adaptive").decide("tool_eval", [])[0]
+
+
+def test_evaluation_message():
+	policy = EvaluationPolicy(mode="adaptive")
+	_, checks = policy.decide("tool_eval", [tool_message("python", PYTHON_ERROR), tool_message("sql_get_schema", "CREATE TABLE t")])
+	text = policy.evaluation_message(checks).content
+	assert "`python` failed (error): Traceback" in text
+	assert "`sql_get_schema` completed successfully." in text
+	assert "<reward>0.5</reward>" in text
+
+
+def test_stats():
+	policy = EvaluationPolicy(mode="adaptive", max_sessions=2)
+	for session_id in ["a", "a", "b", "c"]:
+		evaluate, checks = policy.decide("tool_eval", [tool_message("python", PYTHON_ERROR)])
+		policy.record(session_id, evaluate, checks)
+	assert policy.stats("a") == {"evaluated": 0, "skipped": 0, "verdicts": {}}  # evicted
+	assert policy.stats("c") == {"evaluated": 0, "skipped": 1, "verdicts": {"error": 1}}
+	assert policy.stats()["skipped"] == 2
+
+
+class FailingGateway(LLMGateway):
+	async def ainvoke(self, *args, **kwargs):
+		raise AssertionError("The LLM evaluator was called")
+
+
+def test_skipped_evaluation_does_not_call_the_llm():
+	gateway = FailingGateway(stub_llm_dict(["claude-4.0"]))
+	contexts = {"database_specialist": build_node_context(gateway, [], {})}
+	assignment = AIMessage(content="", tool_calls=[
+		{"name": "database_specialist", "args": {"task": "Count the papers", "memory": False}, "id": "call-task"}])
+	assignment.metadata = {"current": "research_manager", "name": "call_research_manager"}
+	messages = [assignment, tool_message("sql_query", "NotFound: 404 Table papers")]
+	state = {
+		"messages": messages, "index": _index_messages(messages), "metadata": {"model_name": "claude-4.0", "session_id": "a"},
+		"current": "toolset", "next": "node_evaluation_specialist:tool_eval",
+	}
+	policy = EvaluationPolicy(mode="adaptive")
+
+	node = RunnableLambda(partial(call_evaluation, gateway, contexts, lambda messages, model_name: (messages, None), policy))
+	result = asyncio.run(node.ainvoke(state))
+
+	message = result["messages"][0]
+	assert message.response_metadata["evaluation_policy"] == {"skipped": True, "verdicts": ["error"]}
+	assert "`sql_query` failed (error): NotFound: 404 Table papers" in message.text()
+	assert result["next"] == "node_database_specialist"
+	assert policy.stats("a")["skipped"] == 1
@@ -0,0 +1,110 @@
+"""
+The sandbox on kernels of local Jupyter Kernel Gateways (`pip install jupyter_kernel_gateway`)
+"""
+import socket, subprocess, sys, time
+import httpx, pytest
+
+pytest.importorskip("kernel_gateway")
+
+from func.jupyter import JupyterSandbox
+from func.kernel_gateway import GatewayKernelProvider
+
+TOKEN = "test-token"
+
+
+def _free_port() -> int:
+	with socket.socket() as s:
+		s.bind(("127.0.0.1", 0))
+		return s.getsockname()[1]
+
+
+def _text(outputs: list) -> str:
+	return "".join(o["text"] for o in outputs if o["type"] == "text")
+
+
+@pytest.fixture(scope="module")
+def gateway_urls():
+	# Two gateways, as two nodes
+	processes, urls = [], []
+	for _ in range(2):
+		port = _free_port()
+		processes.append(subprocess.Popen(
+			[sys.executable, "-m", "kernel_gateway", "--KernelGatewayApp.ip=127.0.0.1", f"--KernelGatewayApp.port={port}",
+			 f"--KernelGatewayApp.auth_token={TOKEN}"],
+			stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+		))
+		urls.append(f"http://127.0.0.1:{port}")
+	try:
+		for url in urls:
+			deadline = time.monotonic() + 60
+			while True:
+				try:
+					httpx.get(f"{url}/api/kernels", headers={"Authorization": f"token {TOKEN}"}).raise_for_status()
+					break
+				except httpx.HTTPError:
+					if time.monotonic() > deadline:
+						raise
+					time.sleep(0.5)
+		yield urls
+	finally:
+		for process in processes:
+			process.terminate()
+			process.wait(timeout=30)
+
+
+@pytest.fixture
+def sandbox(gateway_urls, tmp_path):
+	sandbox = JupyterSandbox(str(tmp_path), interrupt_grace=3, provider=GatewayKernelProvider(gateway_urls, auth_token=TOKEN))
+	yield sandbox
+	sandbox.close_all_sessions()
+
+
+def test_execute_and_shutdown(sandbox, tmp_path):
+	outputs = sandbox.execute_code("import os\nx = 41\nprint(os.getcwd(), x + 1)", "session-1", "cell-1")
+	assert _text(outputs) == f"{tmp_path} 42\n"
+	assert _text(sandbox.execute_code("print(x)", "session-1", "cell-2")) == "41\n"
+
+	kernel = sandbox.sessions["session-1"]["kernel"]
+	sandbox.close_session("session-1")
+	assert "session-1" not in sandbox.sessions
+	kernels = httpx.get(f"{kernel['url']}/api/kernels", headers={"Authorization": f"token {TOKEN}"}).json()
+	assert kernel["id"] not in [k["id"] for k in kernels]
+
+
+def test_interrupt_keeps_the_variables(sandbox):
+	sandbox.execute_code("x = 1", "session-2", "cell-1")
+	outputs = sandbox.execute_code("import time\nwhile True: time.sleep(0.1)", "session-2", "cell-2", timeout=1)
+	assert "KeyboardInterrupt" in _text(outputs)
+	assert "Execution timeout after 1 seconds: the cell was interrupted" in _text(outputs)
+	assert _text(sandbox.execute_code("print(x)", "session-2", "cell-3")) == "1\n"
+
+
+def test_restart_when_the_interrupt_is_ignored(sandbox, tmp_path):
+	sandbox.execute_code("x = 1", "session-3", "cell-1")
+	code = "import signal\nsignal.signal(signal.SIGINT, signal.SIG_IGN)\nwhile True: pass"
+	outputs = sandbox.execute_code(code, "session-3", "cell-2", timeout=1)
+	assert "the kernel was restarted" in _text(outputs)
+	# A new kernel, set up again
+	assert _text(sandbox.execute_code("import os\nprint('x' in dir(), os.getcwd())", "session-3", "cell-3")) == f"False {tmp_path}\n"
+
+
+def test_sessions_stay_on_their_node(gateway_urls, tmp_path):
+	# Rendezvous hashing: whatever the order of the nodes, in every process
+	session_ids = [f"session-{i}" for i in range(16)]
+	provider = GatewayKernelProvider(gateway_urls, auth_token=TOKEN)
+	reordered = GatewayKernelProvider(gateway_urls[::-1], auth_token=TOKEN)
+	assert [provider.nodes(s) for s in session_ids] == [reordered.nodes(s) for s in session_ids]
+	assert {provider.nodes(s)[0] for s in session_ids} == set(gateway_urls)
+
+	# Removing a node only moves its sessions
+	remaining = GatewayKernelProvider(gateway_urls[:1], auth_token=TOKEN)
+	assert all(remaining.nodes(s)[0] == provider.nodes(s)[0] for s in session_ids if provider.nodes(s)[0] == gateway_urls[0])
+
+	sandboxes = [JupyterSandbox(str(tmp_path), provider=provider), JupyterSandbox(str(tmp_path), provider=reordered)]
+	try:
+		for session_id in session_ids[:4]:
+			nodes = [sandbox.get_or_create_session(session_id)["node"] for sandbox in sandboxes]
+			assert nodes == [provider.nodes(session_id)[0]] * 2
+	finally:
+		for sandbox in sandboxes:
+			sandbox.close_all_sessions()
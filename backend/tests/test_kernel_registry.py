@@ -0,0 +1,115 @@
+"""
+Kernels shared by the worker processes of a host, through the kernel registry (requires ipykernel)
+"""
+import os, subprocess, sys, textwrap, time
+import pytest
+
+pytest.importorskip("ipykernel")
+
+from func.jupyter import JupyterSandbox
+from func.kernel_registry import KernelRegistry, SessionLock
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def worker(tmp_path, code: str) -> subprocess.Popen:
+	# Another worker process, with a sandbox on the same registry
+	code = textwrap.dedent(f"""
+		import json, sys
+		sys.path.insert(0, {BACKEND_DIR!r})
+		from func.jupyter import JupyterSandbox
+		from func.kernel_registry import KernelRegistry
+		sandbox = JupyterSandbox({str(tmp_path)!r}, registry=KernelRegistry({str(tmp_path / "kernels" / "registry.sqlite")!r}))
+		def text(outputs):
+			return "".join(o["text"] for o in outputs if o["type"] == "text")
+	""") + textwrap.dedent(code)
+	return subprocess.Popen([sys.executable, "-c", code], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+
+
+def text(outputs: list) -> str:
+	return "".join(o["text"] for o in outputs if o["type"] == "text")
+
+
+@pytest.fixture
+def registry(tmp_path):
+	return KernelRegistry(str(tmp_path / "kernels" / "registry.sqlite"))
+
+
+@pytest.fixture
+def sandbox(tmp_path, registry):
+	sandbox = JupyterSandbox(str(tmp_path), registry=registry)
+	yield sandbox
+	sandbox.close_all_sessions()
+
+
+def test_session_lock_across_processes(tmp_path):
+	path = str(tmp_path / "session.lock")
+	holder = subprocess.Popen([sys.executable, "-c", textwrap.dedent(f"""
+		import sys, time
+		sys.path.insert(0, {BACKEND_DIR!r})
+		from func.kernel_registry import SessionLock
+		with SessionLock({path!r}):
+			print("locked", flush=True)
+			time.sleep(1)
+	""")], stdout=subprocess.PIPE, text=True)
+	assert holder.stdout.readline().strip() == "locked"
+
+	lock = SessionLock(path)
+	started = time.monotonic()
+	with lock:
+		waited = time.monotonic() - started
+		# Re-entrant in this process
+		with lock:
+			pass
+	holder.wait()
+	assert waited > 0.5
+
+
+def test_two_processes_attach_to_one_session(sandbox, registry, tmp_path):
+	sandbox.execute_code("x = 41", "session", "cell-1")
+	entry = registry.lookup("session")
+
+	other = worker(tmp_path, """
+		print(text(sandbox.execute_code("import os\\nprint(x + 1, os.getpid())\\ny = 7", "session", "cell-2")), end="", flush=True)
+	""")
+	answer, pid = other.communicate(timeout=120)[0].split()
+	# The kernel started by this process, not a new one
+	assert answer == "42" and int(pid) == entry["pid"]
+	assert [e["session_id"] for e in registry.sessions()] == ["session"]
+
+	# The exit of the other worker leaves the kernel running
+	assert text(sandbox.execute_code("print(y)", "session", "cell-3")) == "7\n"
+	assert registry.lookup("session")["connection_file"] == entry["connection_file"]
+
+
+def test_concurrent_first_cells_start_one_kernel(registry, tmp_path):
+	workers = [
+		worker(tmp_path, """
+			print(text(sandbox.execute_code("import os\\nprint(os.getpid())", "session", "cell")), end="", flush=True)
+		""")
+		for _ in range(2)
+	]
+	pids = [int(w.communicate(timeout=120)[0]) for w in workers]
+	assert pids[0] == pids[1]
+	assert [(e["session_id"], e["pid"]) for e in registry.sessions()] == [("session", pids[0])]
+
+	# Closed from any worker
+	sandbox = JupyterSandbox(str(tmp_path), registry=registry)
+	sandbox.close_session("session")
+	sandbox.close_all_sessions()
+	assert registry.sessions() == []
+	with pytest.raises(ProcessLookupError):
+		for _ in range(50):
+			os.kill(pids[0], 0)
+			time.sleep(0.1)
+
+
+def test_dead_kernel_is_replaced(sandbox, registry):
+	sandbox.execute_code("x = 1", "session", "cell-1")
+	entry = registry.lookup("session")
+	sandbox.sessions["session"]["kernel"].shutdown_kernel(now=True)
+	assert registry.lookup("session") is None
+
+	outputs = sandbox.execute_code("print('x' in dir())", "session", "cell-2")
+	assert text(outputs) == "False\n"
+	assert registry.lookup("session")["pid"] != entry["pid"]
@@ -0,0 +1,106 @@
+import asyncio, json, threading, time
+import pytest
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.runnables import RunnableLambda
+
+from func.streaming import ToolOutputStream
+
+
+class Events(BaseCallbackHandler):
+	# The `tool_output` events of a run
+	run_inline = True
+
+	def __init__(self):
+		self.events = []
+
+	def on_custom_event(self, name, data, **kwargs):
+		if name == "tool_output":
+			self.events.append(json.loads(data))
+
+
+def run_with_events(func) -> tuple:
+	# Runs `func` (async) in a run, as a tool does, returns its result and the events it dispatched
+	events = Events()
+	result = asyncio.run(RunnableLambda(func).ainvoke(None, {"callbacks": [events]}))
+	return result, events.events
+
+
+def test_writes_are_coalesced():
+	async def tool(_):
+		async with ToolOutputStream("python", interval=0.1) as stream:
+			# From another thread, as the outputs of a cell
+			def cell():
+				for i in range(5000):
+					stream.write(f"{i}\n")
+					if i % 500 == 0:
+						time.sleep(0.02)
+			started = time.monotonic()
+			await asyncio.to_thread(cell)
+			return time.monotonic() - started
+
+	seconds, events = run_with_events(tool)
+	assert len(events) <= seconds / 0.1 + 2
+	assert "".join(e["output"] for e in events) == "".join(f"{i}\n" for i in range(5000))
+	assert [e["done"] for e in events] == [False] * (len(events) - 1) + [True]
+	assert all(e["tool"] == "python" for e in events)
+
+
+def test_buffer_is_bounded():
+	async def tool(_):
+		async with ToolOutputStream("python", interval=10, max_buffer=100) as stream:
+			for i in range(1000):
+				stream.write(f"{i:04d}\n")
+
+	_, events = run_with_events(tool)
+	# One event (the interval never elapsed): the latest output, and how much was dropped
+	assert len(events) == 1 and events[0]["done"]
+	assert events[0]["output"] == "[... 4900 characters skipped ...]\n" + "".join(f"{i:04d}\n" for i in range(980, 1000))
+
+
+def test_progress_replaces_the_previous_one():
+	async def tool(_):
+		async with ToolOutputStream("sql_query", interval=10) as stream:
+			for rows in [1000, 2000, 3000]:
+				stream.progress(f"{rows} rows fetched")
+
+	_, events = run_with_events(tool)
+	assert events == [{"tool": "sql_query", "output": "", "progress": "3000 rows fetched", "done": True}]
+
+
+def test_outside_of_a_run():
+	async def tool():
+		async with ToolOutputStream("python", interval=0.01) as stream:
+			stream.write("output")
+			await asyncio.sleep(0.05)
+		return stream.enabled
+	assert asyncio.run(tool()) is False
+
+
+def test_fast_printing_cell(tmp_path):
+	pytest.importorskip("ipykernel")
+	from func.jupyter import JupyterSandbox
+	sandbox = JupyterSandbox(str(tmp_path))
+	# One output per print
+	code = "for i in range(3000):\n    print(i, flush=True)"
+	writes = []
+
+	async def tool(_):
+		async with ToolOutputStream("python", interval=0.1, max_buffer=4096) as stream:
+			def on_output(output):
+				if output["type"] == "text":
+					writes.append(output["text"])
+					stream.write(output["text"])
+			started = time.monotonic()
+			outputs = await sandbox.aexecute_code(code, "session", "cell", on_output=on_output)
+			return outputs, time.monotonic() - started
+
+	try:
+		(outputs, seconds), events = run_with_events(tool)
+	finally:
+		sandbox.close_all_sessions()
+
+	assert "".join(o["text"] for o in outputs if o["type"] == "text") == "".join(f"{i}\n" for i in range(3000))
+	# Far fewer events than outputs, each bounded, and the end of the output last
+	assert len(events) <= seconds / 0.1 + 2 and len(events) < len(writes)
+	assert all(len(e["output"]) <= 4096 + len("[... 99999999 characters skipped ...]\n") for e in events)
+	assert events[-1]["done"] and "".join(e["output"] for e in events).endswith("2999\n")
@@ -0,0 +1,114 @@
+import asyncio, json
+from functools import partial
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import RunnableLambda
+
+from func.stubs import StubTool
+from agents.context import build_node_context
+from agents.nodes import call_toolset
+from agents.utils.tool_limits import ToolLimiter
+
+
+class Concurrency:
+	# Calls running at the same time, by key
+	def __init__(self):
+		self.running, self.max = {}, {}
+
+	async def run(self, key, delay: float):
+		self.running[key] = self.running.get(key, 0) + 1
+		self.max[key] = max(self.max.get(key, 0), self.running[key])
+		await asyncio.sleep(delay)
+		self.running[key] -= 1
+
+
+class SlowTool(StubTool):
+	delay: float = 0.05
+	concurrency: Concurrency = None
+
+	model_config = {"arbitrary_types_allowed": True}
+
+	async def _arun(self, query: str = "", state: dict = None) -> dict:
+		await self.concurrency.run(self.name, self.delay)
+		return {"response": f"{self.name} {query}"}
+
+
+def kernel_limiter() -> ToolLimiter:
+	# As in agents/sciscigpt.py
+	return ToolLimiter(limits={"kernel": 1}, groups={"python": "kernel", "r": "kernel", "julia": "kernel"}, default=None)
+
+
+async def limited(limiter, concurrency, session_id, tool_name, delay=0.02):
+	async with limiter.limit(session_id, tool_name):
+		await concurrency.run((session_id, limiter.groups.get(tool_name, tool_name)), delay)
+
+
+def test_group_limit_per_session():
+	limiter, concurrency = kernel_limiter(), Concurrency()
+
+	async def main():
+		await asyncio.gather(*[
+			limited(limiter, concurrency, session_id, tool_name)
+			for session_id in ["a", "b"] for tool_name in ["python", "r", "julia", "python"]
+		])
+	asyncio.run(main())
+	# The Jupyter tools of a session share one kernel, the sessions are independent
+	assert concurrency.max == {("a", "kernel"): 1, ("b", "kernel"): 1}
+
+
+def test_unlimited_tools():
+	limiter, concurrency = kernel_limiter(), Concurrency()
+
+	async def main():
+		await asyncio.gather(*[limited(limiter, concurrency, "a", "sql_query") for _ in range(4)])
+	asyncio.run(main())
+	assert concurrency.max == {("a", "sql_query"): 4}
+
+
+def test_default_limit():
+	limiter, concurrency = ToolLimiter(limits={"python": 1}, default=2), Concurrency()
+
+	async def main():
+		await asyncio.gather(*[limited(limiter, concurrency, "a", name) for name in ["sql_query"] * 4 + ["python"] * 2])
+	asyncio.run(main())
+	assert concurrency.max == {("a", "sql_query"): 2, ("a", "python"): 1}
+
+
+def test_semaphores_are_dropped():
+	limiter, concurrency = kernel_limiter(), Concurrency()
+	asyncio.run(limited(limiter, concurrency, "a", "python"))
+	assert len(limiter._semaphores) == 0
+
+
+def test_batch_keeps_the_order_of_the_tool_calls():
+	concurrency = Concurrency()
+	tools = [
+		SlowTool(name="python", delay=0.05, concurrency=concurrency),
+		SlowTool(name="r", delay=0.01, concurrency=concurrency),
+		SlowTool(name="sql_query", delay=0.03, concurrency=concurrency),
+	]
+	context = build_node_context(tools=tools)
+	tool_calls = [
+		{"name": "python", "args": {"query": "1"}, "id": "call-1"},
+		{"name": "sql_query", "args": {"query": "2"}, "id": "call-2"},
+		{"name": "r", "args": {"query": "3"}, "id": "call-3"},
+		{"name": "missing", "args": {}, "id": "call-4"},
+		{"name": "sql_query", "args": {"query": "5"}, "id": "call-5"},
+		{"name": "python", "args": {"query": "6"}, "id": "call-6"},
+	]
+	state = {"messages": [AIMessage(content="", tool_calls=tool_calls)], "metadata": {"session_id": "a"}}
+
+	# In a run, as the node dispatches its messages as custom events
+	node = RunnableLambda(partial(call_toolset, context, kernel_limiter()))
+	result = asyncio.run(node.ainvoke(state))
+
+	messages = result["messages"]
+	assert [m.tool_call_id for m in messages] == [call["id"] for call in tool_calls]
+	responses = [json.loads(m.content[0]["text"])["response"] for m in messages]
+	assert responses[:3] == ["python 1", "sql_query 2", "r 3"]
+	assert responses[3].startswith("AssertionError: Invalid tool: missing")
+	assert responses[4:] == ["sql_query 5", "python 6"]
+	assert [m.metadata["current"] for m in messages] == ["python", "sql_query", "r", "toolset", "sql_query", "python"]
+
+	# The kernel tools ran one at a time, the SQL queries together
+	assert concurrency.max == {"python": 1, "r": 1, "sql_query": 2}
+	assert result["next"] == "node_evaluation_specialist:tool_eval"
@@ -1,6 +1,6 @@
 ##### Data Extraction Tools
 from tools.sql import SQLListTableTool, SQLGetSchemaTool, SQLQueryTool
-from langchain_community.utilities import SQLDatabase
+from func.resources import resources
 import os
 
 
@@ -9,12 +9,17 @@ load_dotenv()
 
 bigquery_uri = os.getenv("GOOGLE_BIGQUERY_URI")
 db_name = bigquery_uri.split("/")[-1]
-# Initialize tools
-db_dict = {
-	db_name: SQLDatabase.from_uri(
+
+def _connect_database():
+	from langchain_community.utilities import SQLDatabase
+	return SQLDatabase.from_uri(
 		database_uri=bigquery_uri, 
 		sample_rows_in_table_info=0, 
 	)
+
+# Initialize tools (the database is connected on first use, or by the warmup of `app.py`)
+db_dict = {
+	db_name: resources.register(f"sql:{db_name}", _connect_database, "sql")
 }
 
 sql_list_table_tool = SQLListTableTool(db_dict=db_dict)
@@ -24,7 +29,7 @@ sql_query_tool = SQLQueryTool(db_dict=db_dict)
 from tools.name import search_name_tool
 
 ##### Data Analysis Tools
-from tools.sandbox import python_jupyter_tool, r_jupyter_tool, julia_jupyter_tool
+from tools.sandbox import python_jupyter_tool, r_jupyter_tool, julia_jupyter_tool, kernel_warmups
 
 ##### Literature Review
 from tools.literature import search_literature_advanced_tool
@@ -5,12 +5,15 @@ from pydantic import BaseModel, Field
 from typing import Annotated
 from langgraph.prebuilt import InjectedState
 import pandas as pd
-import re, os
+import re, os, asyncio
+from func.executors import tool_executors
+from func.resources import LazyResource, resources
+from func.llm import LLMGateway
 
 from langchain_core.prompts import ChatPromptTemplate
-from langchain.hub import pull
-HyDE_pre_retrieval_xml = pull("erzhuoshao/sciscigpt_literature_specialist_hyde_pre")
-HyDE_post_retrieval_xml = pull("erzhuoshao/sciscigpt_literature_specialist_hyde_post")
+from func.prompt_registry import prompt_registry
+HyDE_pre_retrieval_xml = prompt_registry.lazy("erzhuoshao/sciscigpt_literature_specialist_hyde_pre")
+HyDE_post_retrieval_xml = prompt_registry.lazy("erzhuoshao/sciscigpt_literature_specialist_hyde_post")
 
 from dotenv import load_dotenv
 load_dotenv()
@@ -39,28 +42,28 @@ def __dict_to_bibtex__(entry):
 
 from langchain_core.output_parsers import JsonOutputParser, XMLOutputParser
 
-def pre_retrieval_processing(llm, query):
+async def pre_retrieval_processing(gateway, model_name, query):
     parser = XMLOutputParser()
-    PreRetrievalChain = HyDE_pre_retrieval_xml | llm
-    hypo_y = PreRetrievalChain.invoke({
+    prompt = HyDE_pre_retrieval_xml.invoke({
         "query": query, 
         "format_instructions": parser.get_format_instructions()
-    }).text()
+    })
+    hypo_y = (await gateway.ainvoke(model_name, prompt, streaming=False)).text()
 
     hypo_y = re.findall(r'<section>(.*?)</section>', hypo_y, re.DOTALL)
     hypo_y = [i.strip() for i in hypo_y]
     return hypo_y
 
-def post_retrieval_processing_xml(llm, query, search_results):
+async def post_retrieval_processing_xml(gateway, model_name, query, search_results):
 	"""Process search results into XML format literature review"""
 
 	parser = XMLOutputParser()
-	PostRetrievalChain = HyDE_post_retrieval_xml | llm
-	response = PostRetrievalChain.invoke({
+	prompt = HyDE_post_retrieval_xml.invoke({
 		"search_results": search_results,
 		"query": query,
 		"format_instructions": parser.get_format_instructions()
-	}).text()
+	})
+	response = (await gateway.ainvoke(model_name, prompt, streaming=False)).text()
 	
 	references_match = re.search(r'<references>(.*?)</references>', response, re.DOTALL)
 	summary_match = re.search(r'<summary>(.*?)</summary>', response, re.DOTALL)
@@ -191,13 +194,13 @@ ConstraintTemplate = ChatPromptTemplate([
 	""")
 ])
 
-def __create_search_constraints__(llm, query):
+async def __create_search_constraints__(gateway, model_name, query):
 	parser = JsonOutputParser(pydantic_object=SearchConstraints)
-	SearchConstraintsChain = ConstraintTemplate | llm | parser
-	search_constraints = SearchConstraintsChain.invoke({
+	prompt = ConstraintTemplate.invoke({
 		"query": query,
 		"format_instructions": parser.get_format_instructions()
 	})
+	search_constraints = parser.invoke(await gateway.ainvoke(model_name, prompt, streaming=False))
 	return search_constraints
 
 
@@ -226,34 +229,44 @@ class SearchLiteratureAdvancedTool(BaseTool):
 	Note: This tool specializes in Science of Science literature only.
 	"""
 	args_schema: Type[BaseModel] = SearchLiteratureAdvancedInput
-	vs: VectorStore
-	llm_dict: dict
+	vs: LazyResource  # handle of the vector store of the corpus
+	gateway: LLMGateway
 
 	def _run(
 		self, query: str, k: int, state: Annotated[dict, InjectedState], **kwargs
+	):
+		return self.gateway.run_sync(self._arun(query, k, state, **kwargs))
+
+	async def _arun(
+		self, query: str, k: int, state: Annotated[dict, InjectedState], **kwargs
 		# section: str = None, title: str = None, authors: list = None, 
 		# section_id: int = None, venue: str = None
 	):
-		llm = self.llm_dict[state["metadata"]["model_name"]]
+		model_name = state["metadata"]["model_name"]
 
 		response = {}
 		try:
 			# hypo_ys = [ query ]
-			hypo_ys = pre_retrieval_processing(llm, query)
-
-			search_constraints = __create_search_constraints__(llm, query)
+			# The hypothetical documents and the search constraints are independent LLM calls
+			hypo_ys, search_constraints = await asyncio.gather(
+				pre_retrieval_processing(self.gateway, model_name, query),
+				__create_search_constraints__(self.gateway, model_name, query),
+			)
 
-			raw_results = __search_and_format__(
-				self.vs, 
-				hypo_ys, 
-				k, **search_constraints
+			# The vector store is resolved in the worker thread, in case it is still connecting
+			raw_results = await tool_executors.run(
+				"vector_search", lambda: __search_and_format__(
+					self.vs.get(), 
+					hypo_ys, 
+					k, **search_constraints
+				)
 			)
 
 			if raw_results == "No search results found.":
 				response['response'] = raw_results
 			else:
-				response['response'] = post_retrieval_processing_xml(
-					llm, query, raw_results)
+				response['response'] = await post_retrieval_processing_xml(
+					self.gateway, model_name, query, raw_results)
 				# response['response'] = raw_results
 				# response['bibtex'] = [i['bibtex'] for i in raw_results]
 
@@ -264,35 +277,18 @@ class SearchLiteratureAdvancedTool(BaseTool):
 			return response
 
 
-from langchain_openai import OpenAIEmbeddings
-from langchain_pinecone import PineconeVectorStore
-vs = PineconeVectorStore.from_existing_index(
-	embedding = OpenAIEmbeddings(model="text-embedding-3-large", api_key=openai_api_key),
-	index_name = sciscicorpus_index,
-	namespace = sciscicorpus_namespace,
-)
-
-
-from langchain_google_vertexai.model_garden import ChatAnthropicVertex
-llm_dict = {
-	"claude-3.5": ChatAnthropicVertex(
-		model_name="claude-3-5-sonnet-v2@20241022", 
-		project="ksm-rch-sciscigpt", 
-		location="us-east5", 
-		temperature=0.0, max_output_tokens=8192, disable_streaming=True
-	),
-	"claude-3.7": ChatAnthropicVertex(
-		model_name="claude-3-7-sonnet@20250219", 
-		project="ksm-rch-sciscigpt", 
-		location="us-east5", 
-		temperature=0.0, max_output_tokens=8192 * 4, disable_streaming=True
-	),
-	"claude-4.0": ChatAnthropicVertex(
-		model_name="claude-sonnet-4@20250514", 
-		project="ksm-rch-sciscigpt", 
-		location="us-east5", 
-		temperature=0.0, max_output_tokens=8192 * 4, disable_streaming=True
+def _connect_vectorstore():
+	from langchain_openai import OpenAIEmbeddings
+	from langchain_pinecone import PineconeVectorStore
+	return PineconeVectorStore.from_existing_index(
+		embedding = OpenAIEmbeddings(model="text-embedding-3-large", api_key=openai_api_key),
+		index_name = sciscicorpus_index,
+		namespace = sciscicorpus_namespace,
 	)
-}
 
-search_literature_advanced_tool = SearchLiteratureAdvancedTool(vs=vs, llm_dict=llm_dict)
\ No newline at end of file
+# Connected on first use, or by the warmup of `app.py`
+vs = resources.register("pinecone:sciscicorpus", _connect_vectorstore, "vector_search")
+
+
+from func.llm import gateway
+search_literature_advanced_tool = SearchLiteratureAdvancedTool(vs=vs, gateway=gateway)
\ No newline at end of file
@@ -4,6 +4,9 @@ from langchain.tools import BaseTool
 from pydantic import BaseModel, Field
 import pandas as pd
 import json
+from functools import partial
+from func.executors import tool_executors
+from func.resources import resources
 
 import os
 from dotenv import load_dotenv
@@ -24,7 +27,7 @@ class SearchNameTool(BaseTool):
 	"""
 	args_schema: Type[BaseModel] = SearchNameInput
 
-	vectorstore_dict: dict
+	vectorstore_dict: dict  # column -> handle of the vector store
 	type_dict: dict
 	
 
@@ -32,7 +35,7 @@ class SearchNameTool(BaseTool):
 		response = {}
 		try:
 			search_filter = json.loads(search_filter)
-			output = self.vectorstore_dict[column].similarity_search(value, filter=search_filter, k=10)
+			output = self.vectorstore_dict[column].get().similarity_search(value, filter=search_filter, k=10)
 			output = [result.metadata for result in output]
 			output = pd.DataFrame(output)
 			response['response'] = output.astype(self.type_dict[column]).to_markdown(floatfmt="")
@@ -40,6 +43,9 @@ class SearchNameTool(BaseTool):
 			response['response'] = "{}: {}".format(type(e).__name__, str(e))
 		finally:
 			return response
+
+	async def _arun(self, column: str, value: str, search_filter: str="{}"):
+		return await tool_executors.run("vector_search", self._run, column, value, search_filter)
 		
 
 
@@ -60,15 +66,19 @@ type_dict = {
 }
 		
 
-# Initialize tools
-from langchain_pinecone import PineconeVectorStore
-from langchain_openai import OpenAIEmbeddings
-vectorstore_dict = {
-	namespace: PineconeVectorStore.from_existing_index(
+# Initialize tools (the vector stores are connected on first use, or by the warmup of `app.py`)
+def _connect_vectorstore(namespace: str):
+	from langchain_pinecone import PineconeVectorStore
+	from langchain_openai import OpenAIEmbeddings
+	return PineconeVectorStore.from_existing_index(
 		embedding = OpenAIEmbeddings(model="text-embedding-3-small"),
 		namespace = namespace,
 		index_name = os.getenv("NAME_SEARCH_INDEX")
-	) for namespace in ["field_name", "institution_name"]
+	)
+
+vectorstore_dict = {
+	namespace: resources.register(f"pinecone:{namespace}", partial(_connect_vectorstore, namespace), "vector_search")
+	for namespace in ["field_name", "institution_name"]
 }
 
 search_name_tool = SearchNameTool(vectorstore_dict=vectorstore_dict, type_dict=type_dict)
\ No newline at end of file
@@ -5,8 +5,12 @@ from pydantic import BaseModel, Field
 from typing import Type
 from typing_extensions import Annotated
 
-from func.jupyter import JupyterSandbox
+from func.executors import tool_executors
+from func.resources import LazyResource, resources
+from func.prefetch import prefetcher
+from func.streaming import ToolOutputStream
 from func.image import upload_image
+from functools import partial
 
 from langgraph.prebuilt import InjectedState
 
@@ -20,6 +24,9 @@ def _parse_jupyter_results(results: list[dict]) -> dict:
 
 	response = {}
 	response["response"] = "".join([r["text"] for r in text_responses])
+	for r in results:
+		if r['type'] == 'timing':
+			response["timing"] = { "wall_seconds": r["wall_seconds"], "cpu_seconds": r["cpu_seconds"] }
 
 	if len(image_responses) > 0:
 		response["images"] = []
@@ -37,6 +44,29 @@ def _parse_jupyter_results(results: list[dict]) -> dict:
 
 
 
+def _stream_jupyter_output(stream: ToolOutputStream, output: dict):
+	stream.write(output["text"] if output["type"] == "text" else "[figure]\n")
+
+async def _arun_jupyter(handle: LazyResource, name: str, code: str, state: dict, timeout: int, bridge: str = None) -> dict:
+	# Awaits the execution on the kernel router of the sandbox, without holding a thread of the sandbox pool
+	try:
+		session_id = state["metadata"]["session_id"] if state else "test"
+
+		prefetcher.consume(("kernel", session_id))
+		sandbox = handle.get() if handle.status == "ready" else await tool_executors.run("sandbox", handle.get)
+		# The outputs are streamed to the client as the cell runs
+		async with ToolOutputStream(name) as stream:
+			results = await sandbox.aexecute_code(
+				code, session_id=session_id, cell_id=uuid.uuid4(), timeout=timeout, bridge=bridge,
+				on_output=partial(_stream_jupyter_output, stream))
+		# The images are written and uploaded in the sandbox pool
+		response = await tool_executors.run("sandbox", _parse_jupyter_results, results)
+	except Exception as e:
+		response = {"response": "{}: {}".format(type(e).__name__, str(e))}
+	return response
+
+
+
 class RJupyterInput(BaseModel):
 	query: str = Field(..., description="R code snippet to run")
 	state: Annotated[dict, InjectedState] = Field(None, description="Agent state")
@@ -46,15 +76,16 @@ class RJupyterTool(BaseTool):
 	description: str = """Execute R code in a persistent Jupyter environment. Input: Any valid R code snippet to run. Output: Standard output and error messages. Note: you need to call `print(p)` to render the figure."""
 	args_schema: Type[BaseModel] = RJupyterInput
 
-	sandbox: JupyterSandbox = None
+	sandbox: LazyResource = None  # handle of the JupyterSandbox
 	timeout: int = 120  # seconds
 
 	def _run(self, query, state = None) -> str:
 		try:
 			session_id = state["metadata"]["session_id"] if state else "test"
 		
+			prefetcher.consume(("kernel", session_id))
 			cell_id = uuid.uuid4()
-			results = self.sandbox.execute_code(f"%%R\n\n{query}", session_id=session_id, cell_id=cell_id, timeout=self.timeout)
+			results = self.sandbox.get().execute_code(f"%%R\n\n{query}", session_id=session_id, cell_id=cell_id, timeout=self.timeout, bridge="r")
 			results = [r for r in results if r["session_id"] == session_id and r["cell_id"] == cell_id]
 
 			response = _parse_jupyter_results(results)
@@ -62,6 +93,9 @@ class RJupyterTool(BaseTool):
 			response = {"response": "{}: {}".format(type(e).__name__, str(e))}
 		return response
 
+	async def _arun(self, query, state = None) -> str:
+		return await _arun_jupyter(self.sandbox, self.name, f"%%R\n\n{query}", state, self.timeout, bridge="r")
+
 
 
 class PythonJupyterInput(BaseModel):
@@ -74,7 +108,7 @@ class PythonJupyterTool(BaseTool):
 	
 	args_schema: Type[BaseModel] = PythonJupyterInput
 
-	sandbox: JupyterSandbox = None
+	sandbox: LazyResource = None  # handle of the JupyterSandbox
 
 	timeout: int = 120  # seconds
 
@@ -82,14 +116,18 @@ class PythonJupyterTool(BaseTool):
 		try:
 			session_id = state["metadata"]["session_id"] if state else "test"
 			
+			prefetcher.consume(("kernel", session_id))
 			cell_id = uuid.uuid4()
-			results = self.sandbox.execute_code(query, session_id=session_id, cell_id=cell_id, timeout=self.timeout)
+			results = self.sandbox.get().execute_code(query, session_id=session_id, cell_id=cell_id, timeout=self.timeout)
 			results = [r for r in results if r["session_id"] == session_id and r["cell_id"] == cell_id]
 			response = _parse_jupyter_results(results)
 		except Exception as e:
 			response = {"response": "{}: {}".format(type(e).__name__, str(e))}
 		return response
 
+	async def _arun(self, query, state = None) -> str:
+		return await _arun_jupyter(self.sandbox, self.name, query, state, self.timeout)
+
 
 
 class JuliaJupyterInput(BaseModel):
@@ -101,16 +139,17 @@ class JuliaJupyterTool(BaseTool):
 	description: str = """Execute Julia code in a persistent Jupyter environment. Input: Any valid Julia code snippet to run. Output: Standard output and error messages. Note: you need to call `display(p)` to render the figure."""
 	args_schema: Type[BaseModel] = JuliaJupyterInput
 
-	sandbox: JupyterSandbox = None
+	sandbox: LazyResource = None  # handle of the JupyterSandbox
 	timeout: int = 120  # seconds
 
 	def _run(self, query, state = None) -> str:
 		try:
 			session_id = state["metadata"]["session_id"] if state else "test"
 		
+			prefetcher.consume(("kernel", session_id))
 			cell_id = uuid.uuid4()
-			results = self.sandbox.execute_code(
-				f"%%julia\n\n{query}", session_id=session_id, cell_id=cell_id, timeout=self.timeout)
+			results = self.sandbox.get().execute_code(
+				f"%%julia\n\n{query}", session_id=session_id, cell_id=cell_id, timeout=self.timeout, bridge="julia")
 			print(results)
 			results = [r for r in results if r["session_id"] == session_id and r["cell_id"] == cell_id]
 			response = _parse_jupyter_results(results)
@@ -119,11 +158,59 @@ class JuliaJupyterTool(BaseTool):
 			response = {"response": "{}: {}".format(type(e).__name__, str(e))}
 		return response
 
+	async def _arun(self, query, state = None) -> str:
+		return await _arun_jupyter(self.sandbox, self.name, f"%%julia\n\n{query}", state, self.timeout, bridge="julia")
+
 
 # from func.env import python_env_setup, python_env_setup_string
 # python_env_setup() # Setup the python environment in system level
-jupyter_sandbox = JupyterSandbox(working_dir=working_dir)
+def _create_sandbox():
+	from func.jupyter import JupyterSandbox
+	from func.kernel_registry import KernelRegistry
+	# The kernels are shared by the uvicorn workers through the registry
+	registry = KernelRegistry(os.getenv("KERNEL_REGISTRY_PATH", f"{working_dir}/kernels/registry.sqlite"))
+	# The variables of the evicted sessions are snapshotted there, and restored when the session returns ("" to disable)
+	snapshot_dir = os.getenv("KERNEL_SNAPSHOT_DIR", f"{working_dir}/kernels/snapshots") or None
+	return JupyterSandbox(
+		working_dir=working_dir, registry=registry, pool_size=int(os.getenv("KERNEL_POOL_SIZE", 0)), snapshot_dir=snapshot_dir,
+		provider=_kernel_provider())
+
+def _kernel_provider():
+	# The kernels run on the Jupyter Kernel Gateways of KERNEL_GATEWAY_URLS (comma-separated), if any, or on this host.
+	# The gateway nodes must mount LOCAL_STORAGE_PATH at the same path.
+	urls = [url.strip() for url in os.getenv("KERNEL_GATEWAY_URLS", "").split(",") if url.strip()]
+	if not urls:
+		return None
+	from func.kernel_gateway import GatewayKernelProvider
+	return GatewayKernelProvider(
+		urls, kernel_name=os.getenv("KERNEL_GATEWAY_KERNEL_NAME") or None, auth_token=os.getenv("KERNEL_GATEWAY_AUTH_TOKEN") or None)
+
+# Created on first use, or by the warmup of `app.py`
+jupyter_sandbox = resources.register("jupyter_sandbox", _create_sandbox, "sandbox")
+
+def _start_reaper():
+	from func.kernel_reaper import KernelReaper
+	optional = lambda name, type: type(os.getenv(name)) if os.getenv(name) else None
+	return KernelReaper(
+		jupyter_sandbox.get(),
+		interval=float(os.getenv("KERNEL_REAPER_INTERVAL", 60)),
+		max_idle_time=float(os.getenv("KERNEL_MAX_IDLE_TIME", 3600)),
+		max_kernels=optional("KERNEL_MAX_KERNELS", int),
+		memory_budget_mb=optional("KERNEL_MEMORY_BUDGET_MB", float),
+		snapshot_max_age=optional("KERNEL_SNAPSHOT_MAX_AGE", float),
+	).start()
+
+# Closes the idle kernels, and the least recently used ones beyond the limits
+kernel_reaper = resources.register("kernel_reaper", _start_reaper, "sandbox")
 python_jupyter_tool = PythonJupyterTool(sandbox=jupyter_sandbox)
+
+def kernel_warmups(task: str, state: dict = None) -> list:
+	# Starts the kernel of the session ahead of its first cell
+	session_id = state["metadata"]["session_id"] if state else "test"
+	if jupyter_sandbox.status == "ready" and session_id in jupyter_sandbox.get().sessions:
+		return []
+	return [(("kernel", session_id), "sandbox", lambda: jupyter_sandbox.get().get_or_create_session(session_id))]
+
 r_jupyter_tool = RJupyterTool(sandbox=jupyter_sandbox)
 julia_jupyter_tool = JuliaJupyterTool(sandbox=jupyter_sandbox)
 
@@ -5,13 +5,19 @@ pd.set_option('display.float_format', lambda x: '%.2f' % x)
 import uuid, json, base64
 from tools.display_dataframe import display_dataframe
 from functools import lru_cache
+from collections import OrderedDict
+import threading, time
 from langchain.tools import BaseTool
 from typing import Any, Dict, Optional, Sequence, Type, Union
 from langchain_community.utilities import SQLDatabase
 from pydantic import BaseModel, Field, ConfigDict
 from langchain_core.tools import BaseTool
 
-from langchain_core.runnables.config import run_in_executor
+from func.executors import tool_executors
+from func.resources import LazyResource
+from func.prefetch import prefetcher
+from func.streaming import ToolOutputStream
+from functools import partial
 
 from langchain_core.tools import InjectedToolArg
 from typing_extensions import Annotated
@@ -24,7 +30,7 @@ workspace = os.getenv("LOCAL_STORAGE_PATH")
 
 
 class BaseSQLDatabaseTool(BaseModel):
-	db_dict: Dict[str, SQLDatabase] = Field(exclude=True)
+	db_dict: Dict[str, LazyResource] = Field(exclude=True)  # db name -> handle of the SQLDatabase
 	model_config = ConfigDict(
 		arbitrary_types_allowed=True,
 	)
@@ -52,7 +58,7 @@ class SQLListTableTool(BaseSQLDatabaseTool, BaseTool):
 			table_dict = [{
 				"TableName": table.name, 
 				"TableDescription": table.comment
-			} for table in self.db_dict[self.db_name]._metadata.sorted_tables]
+			} for table in self.db_dict[self.db_name].get()._metadata.sorted_tables]
 
 			if self.display_mode == "markdown":
 				output = pd.DataFrame(table_dict).to_markdown(index=False)
@@ -67,7 +73,7 @@ class SQLListTableTool(BaseSQLDatabaseTool, BaseTool):
 		return response, response
 
 	async def _arun(self, query:str):
-		return await run_in_executor(None, self._run, query)
+		return await tool_executors.run("sql", self._run, query)
 
 
 @lru_cache(maxsize=32)
@@ -79,9 +85,40 @@ def cached_get_table_info(db, table_names_tuple):
 def clear_table_info_cache():
 	cached_get_table_info.cache_clear()
 
-def read_sql(query: str, db: SQLDatabase, chunksize: int=1000, timeout: int=120):
+# Sample rows prefetched for the next `sql_get_schema` of a table, used once (the samples are random anyway)
+# within `_prefetched_samples_ttl` seconds. Least recently prefetched first out, as the warmups of cancelled
+# sessions are never used.
+_prefetched_samples = OrderedDict()  # (db name, table name) -> (sample, time)
+_prefetched_samples_maxsize = 64
+_prefetched_samples_ttl = 300
+_prefetched_samples_lock = threading.Lock()
+
+def _put_prefetched_sample(key: tuple, sample: str):
+	with _prefetched_samples_lock:
+		_prefetched_samples[key] = (sample, time.monotonic())
+		_prefetched_samples.move_to_end(key)
+		while len(_prefetched_samples) > _prefetched_samples_maxsize:
+			_prefetched_samples.popitem(last=False)
+
+def _pop_prefetched_sample(key: tuple) -> Optional[str]:
+	with _prefetched_samples_lock:
+		sample, sampled_at = _prefetched_samples.pop(key, (None, None))
+	if sample is None or time.monotonic() - sampled_at > _prefetched_samples_ttl:
+		return None
+	return sample
+
+def read_sql(query: str, db: SQLDatabase, chunksize: int=1000, timeout: int=120, on_progress=None):
 	df_list = func_timeout(timeout, pd.read_sql, kwargs={"sql":query, "con":db._engine.connect(), "chunksize":chunksize})
-	df = df_list if isinstance(df_list, pd.DataFrame) else pd.concat([i for i in df_list])
+	if isinstance(df_list, pd.DataFrame):
+		df = df_list
+	else:
+		chunks, rows = [], 0
+		for chunk in df_list:
+			chunks.append(chunk)
+			rows += len(chunk)
+			if on_progress is not None:
+				on_progress(rows)
+		df = pd.concat(chunks)
 	for col in df.columns:
 		if df[col].dtype == list:
 			df[col] = df[col].apply(lambda x: np.array(x))
@@ -105,14 +142,14 @@ class SQLGetSchemaTool(BaseSQLDatabaseTool, BaseTool):
 	args_schema: Type[BaseModel] = SQLGetSchemaInput
 
 	sample_rows: int = 3
+	prefetch_wait: float = 30
 
 	db_name: str = "SciSciNet_US_V5"
 
 	def _run(self, query:str):
-		db = self.db_dict[self.db_name]
-
 		response = {}
 		try:
+			db = self.db_dict[self.db_name].get()
 			if query == "":
 				table_names = db.get_usable_table_names()
 			else:
@@ -124,22 +161,44 @@ class SQLGetSchemaTool(BaseSQLDatabaseTool, BaseTool):
 
 			table_info_list = []
 			for table_name in table_names_tuple:
+				# A warmup of the table still running is waited for, rather than sampling the table twice
+				prefetcher.consume(("sql_get_schema", self.db_name, table_name), timeout=self.prefetch_wait)
 				single_table_info = cached_get_table_info(db, (table_name,))
 				table_info_list.append(single_table_info)
-			
-				df = read_sql(f"SELECT * FROM (SELECT * FROM {table_name} LIMIT 1000) AS t ORDER BY RAND() LIMIT {self.sample_rows}", db)
-				#df_string = display_dataframe(df, mode="markdown", display_rows=100, decimal_precision=4)
-				#df_string = "\n".join(df_string.split("\n")[:-1])
-				df_string = display_dataframe(df, mode="string", display_rows=100, decimal_precision=4)
-				table_info_list.append(f"\n/*\n{self.sample_rows} rows from {table_name} table:\n{df_string}\n*/\n")
+
+				sample = _pop_prefetched_sample((self.db_name, table_name))
+				table_info_list.append(sample or self._sample_rows(db, table_name))
 
 			response["response"] = "\n".join(table_info_list)
 		except Exception as e:
 			response["response"] = "{}: {}".format(type(e).__name__, str(e))
 		return response, response
 
+	def _sample_rows(self, db: SQLDatabase, table_name: str) -> str:
+		df = read_sql(f"SELECT * FROM (SELECT * FROM {table_name} LIMIT 1000) AS t ORDER BY RAND() LIMIT {self.sample_rows}", db)
+		#df_string = display_dataframe(df, mode="markdown", display_rows=100, decimal_precision=4)
+		#df_string = "\n".join(df_string.split("\n")[:-1])
+		df_string = display_dataframe(df, mode="string", display_rows=100, decimal_precision=4)
+		return f"\n/*\n{self.sample_rows} rows from {table_name} table:\n{df_string}\n*/\n"
+
+	def _warm(self, table_name: str):
+		db = self.db_dict[self.db_name].get()
+		cached_get_table_info(db, (table_name,))
+		_put_prefetched_sample((self.db_name, table_name), self._sample_rows(db, table_name))
+
+	def warmups(self, task: str, state: dict = None) -> list:
+		# Reflects the schema and samples the rows of the tables named in the task. Called from the event loop:
+		# nothing to prefetch until the database is connected, as connecting would block the loop.
+		if self.db_dict[self.db_name].status != "ready":
+			return []
+		db = self.db_dict[self.db_name].get()
+		return [
+			(("sql_get_schema", self.db_name, table_name), "sql", partial(self._warm, table_name))
+			for table_name in db.get_usable_table_names() if re.search(fr"\b{re.escape(table_name)}\b", task)
+		]
+
 	async def _arun(self, query:str):
-		return await run_in_executor(None, self.run, query)
+		return await tool_executors.run("sql", self._run, query)
 
 
 
@@ -201,15 +260,15 @@ class SQLQueryTool(BaseSQLDatabaseTool, BaseTool):
 	display_rows_complete: int = 200
 	demical_precision: int = 4
 
-	def _run(self, query: str, display_rows: int=10, display_mode: Literal["preview", "complete"]="preview"):
+	def _run(self, query: str, display_rows: int=10, display_mode: Literal["preview", "complete"]="preview", on_progress=None):
 		try:
 			# display_rows = self.display_rows_preview if display_mode == "preview" else self.display_rows_complete
 
 			response = {}
 			os.makedirs(self.workspace, exist_ok=True)
 
-			db = self.db_dict[self.db_name]
-			df = read_sql(query, db, self.chunksize, self.timeout)
+			db = self.db_dict[self.db_name].get()
+			df = read_sql(query, db, self.chunksize, self.timeout, on_progress)
 			
 			df_string = display_dataframe(
 				df, mode=self.display_mode,
@@ -243,7 +302,11 @@ class SQLQueryTool(BaseSQLDatabaseTool, BaseTool):
 		return response, response
 
 	async def _arun(self, query:str):
-		return await run_in_executor(None, self.run, query)
+		# The number of rows fetched is streamed to the client as the query runs
+		async with ToolOutputStream(self.name) as stream:
+			stream.progress("Running query...")
+			return await tool_executors.run(
+				"sql", self._run, query, on_progress=lambda rows: stream.progress(f"{rows} rows fetched"))
 	
 
 
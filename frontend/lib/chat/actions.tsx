@@ -16,17 +16,46 @@ import {
 	render_tool_response_event, 
 	render_user_message, 
 	render_bot_stream, render_separator, 
+	render_tool_output_stream,
 	render_event
 } from '@/lib/chat/render'
 
 import { Separator } from '@/components/ui/separator'
 
 import { RemoteRunnable } from "@langchain/core/runnables/remote";
+import { createHash } from 'crypto'
+const langserveUrl = process.env.LANGSERVE_URL || "http://localhost:8080/sciscigpt"
 const remoteChain = new RemoteRunnable({
-	url: process.env.LANGSERVE_URL || "http://localhost:8080/sciscigpt",
+	url: langserveUrl,
 	options: { timeout: 3600000 } // 60 minutes
 });
 
+// Whether the server keeps checkpoints of the sessions, i.e. accepts only the new turn (`delta`), from its /ready
+let serverCheckpointer = { enabled: false, checkedAt: 0 }
+async function hasCheckpointer(): Promise<boolean> {
+	if (Date.now() - serverCheckpointer.checkedAt > 60000) {
+		let enabled = false
+		try {
+			const response = await fetch(new URL("ready", langserveUrl))
+			enabled = (await response.json()).checkpointer === true
+		} catch (e: any) { console.error(e) }
+		serverCheckpointer = { enabled: enabled, checkedAt: Date.now() }
+	}
+	return serverCheckpointer.enabled
+}
+
+// Fingerprint of the events of a history, checked by the server against its checkpoint (func/checkpoint.py)
+function historyFingerprint(events: string[]) {
+	if (events.length === 0) {
+		return { length: 0, last: null }
+	}
+	const data = JSON.parse(events[events.length - 1]).data
+	return {
+		length: events.length,
+		last: createHash('sha256').update(typeof data === 'string' ? data : JSON.stringify(data)).digest('hex')
+	}
+}
+
 
 async function submitUserMessage(
 	content: string, 
@@ -67,9 +96,71 @@ async function submitUserMessage(
 
 	let textStream: undefined | ReturnType<typeof createStreamableValue<string>>
 	let temp_node: undefined | React.ReactNode
+	// Partial outputs of the running tools, by run id
+	const toolStreams: Record<string, ReturnType<typeof createStreamableValue<string>>> = {}
 
 	const streamableUI = createStreamableUI();
-	
+
+	const handleEvent = (event: any) => {
+		// console.log(event)
+		const metadata = event.metadata;
+
+		if (event.event === "on_custom_event" && event.name === "tool_output") {
+			// Shown while the tool runs, not kept in the chat history (the tool's messages follow)
+			const data = JSON.parse(event.data)
+			let toolStream = toolStreams[event.run_id]
+			if (toolStream === undefined) {
+				toolStream = toolStreams[event.run_id] = createStreamableValue<string>("")
+				streamableUI.append(render_separator("on_tool_start"));
+				streamableUI.append(render_tool_output_stream(toolStream.value, data.tool));
+				toolStream.update("```\n")
+			}
+			const delta = data.output + (data.progress ? data.progress + "\n" : "")
+			if (delta !== "") {
+				toolStream.update(delta)
+			}
+			if (data.done) {
+				toolStream.update("\n```")
+				toolStream.done()
+				delete toolStreams[event.run_id]
+			}
+			return
+		}
+		
+		if (event.event === "on_chat_model_stream" || event.event === "on_llm_stream") {
+			const delta = event.data.chunk?.content?.[0]?.text ?? event.data.chunk?.content ?? '';
+
+			if (delta !== undefined && delta !== "" && typeof delta === 'string') {
+				if (textStream === undefined) {
+					textStream = createStreamableValue<string>("");
+					temp_node = render_bot_stream(textStream.value, metadata);
+					streamableUI.append(render_separator("on_chat_model_end"));
+					streamableUI.append(temp_node);
+				} 
+				textStream.update(delta);
+			}
+		} else if (textStream !== undefined) {
+			textStream.done();
+			textStream = undefined;
+		}
+
+		if (event.event === "on_tool_start") {
+			temp_node = render_tool_call_event(event)
+			streamableUI.append(render_separator(event.event));
+			streamableUI.append(temp_node);
+		}
+
+		if (event.event === "on_tool_end") {
+			temp_node = render_tool_response_event(event)
+			streamableUI.append(render_separator(event.event));
+			streamableUI.append(temp_node);
+		}
+
+		if (event.event === "on_custom_event") {
+			aiState.update({ ...aiState.get(), messages: [ ...aiState.get().messages, JSON.stringify(event) ] });
+		}
+	}
+
 	(async () => {
 		try {
 			if (aiState.get().messages.length > 1) {
@@ -79,46 +170,29 @@ async function submitUserMessage(
 
 			aiState.update({ ...aiState.get(), messages: [ ...aiState.get().messages, JSON.stringify(human_event) ] });
 
-			const metadata_str = JSON.stringify(metadata, null, 4)
-			const messages_str = JSON.stringify(aiState.get().messages, null, 4)
-			const eventStream = remoteChain.streamEvents(
-				{ messages_str: messages_str, metadata_str: metadata_str }, { version: "v2" }); 
-
-			for await (const event of eventStream) {
-				// console.log(event)
-				const metadata = event.metadata;
-				
-				if (event.event === "on_chat_model_stream" || event.event === "on_llm_stream") {
-					const delta = event.data.chunk?.content?.[0]?.text ?? event.data.chunk?.content ?? '';
-
-					if (delta !== undefined && delta !== "" && typeof delta === 'string') {
-						if (textStream === undefined) {
-							textStream = createStreamableValue<string>("");
-							temp_node = render_bot_stream(textStream.value, metadata);
-							streamableUI.append(render_separator("on_chat_model_end"));
-							streamableUI.append(temp_node);
-						} 
-						textStream.update(delta);
-					}
-				} else if (textStream !== undefined) {
-					textStream.done();
-					textStream = undefined;
-				}
-
-				if (event.event === "on_tool_start") {
-					temp_node = render_tool_call_event(event)
-					streamableUI.append(render_separator(event.event));
-					streamableUI.append(temp_node);
-				}
-
-				if (event.event === "on_tool_end") {
-					temp_node = render_tool_response_event(event)
-					streamableUI.append(render_separator(event.event));
-					streamableUI.append(temp_node);
+			// Send only the new turn if the server may hold a checkpoint of this session, with the fingerprint
+			// of the history before it, and fall back to the full history if it reports a `checkpoint_miss`.
+			const history = aiState.get().messages
+			const delta = history.length > 1 && await hasCheckpointer()
+			let checkpoint_miss = false
+			const streamHistory = (messages: any[], delta: boolean) => remoteChain.streamEvents({
+				messages_str: JSON.stringify(messages, null, 4),
+				metadata_str: JSON.stringify({
+					...metadata, delta: delta, history: historyFingerprint(delta ? history.slice(0, -1) : [])
+				}, null, 4)
+			}, { version: "v2" });
+
+			for await (const event of streamHistory(delta ? [ JSON.stringify(human_event) ] : history, delta)) {
+				if (event.event === "on_custom_event" && event.name === "checkpoint_miss") {
+					checkpoint_miss = true
+					continue
 				}
+				handleEvent(event)
+			}
 
-				if (event.event === "on_custom_event") {
-					aiState.update({ ...aiState.get(), messages: [ ...aiState.get().messages, JSON.stringify(event) ] });
+			if (checkpoint_miss) {
+				for await (const event of streamHistory(history, false)) {
+					handleEvent(event)
 				}
 			}
 
@@ -132,6 +206,7 @@ async function submitUserMessage(
 		
 		try { aiState.done(aiState.get()) } catch (e: any) { console.error(e) }
 		try { if (textStream !== undefined) { textStream.done() } } catch (e: any) { console.error(e) }
+		try { Object.values(toolStreams).forEach(toolStream => toolStream.done()) } catch (e: any) { console.error(e) }
 		try {
 			console.log('streaming finished')
 			streamableUI.done(<DoneMarker />)
@@ -155,6 +155,11 @@ export function render_bot_stream(stream: any, metadata: any={}) {
 	return <BotMessage content={stream} name={name} header={name} icon_invisible={false} icon={<IconCSSI/>}/>;
 }
 
+export function render_tool_output_stream(stream: any, name: string) {
+	// Partial output of a running tool
+	return <BotMessage content={stream} header={`Running ${name}...`}/>;
+}
+
 export function render_ai_message(message: any, name: string) {
 	const text_ = typeof message.content === 'string' ? message.content : message.content[0]?.text
 	const text = process_xml(text_)